@@ -0,0 +1,81 @@
+"""
+Deterministic synthetic fleets for benchmarking the battle engine. The same arguments always generate the same fleet,
+so benchmarks run at different times, or on different versions of the engine, battle the same fleets.
+
+The worker code has to be on the path, as the benchmark scripts put it there before importing this.
+"""
+
+import math
+import random
+
+from constants import UNIT_TYPE_SPECS
+
+UNIT_TYPES = list(UNIT_TYPE_SPECS.keys())
+
+# Mixes of unit types, as the weight of each type. Types that aren't in a mix are never picked.
+TYPE_MIXES = {
+  # Every type is as likely as any other
+  'uniform': None,
+  # Mostly flacks and slugs, which skip battles after they've battled, so most collisions are skipped
+  'skip_heavy': {'flack': 4, 'slug': 4, 'bomber': 1, 'fighter': 1, 'frigate': 1, 'dreadnought': 1},
+  # Only the types that counter each other, so most collisions are even fights
+  'counters': {'bomber': 1, 'fighter': 1, 'frigate': 1},
+  # Units that are destroyed by a single hit, so formations empty out quickly
+  'fragile': {'civilian': 1, 'mine': 1, 'flack': 1},
+}
+
+
+
+def generate_fleet(num_units, seed, type_mix='uniform', sparsity=0.0, grid_width=None):
+  """
+  Generates a fleet with a number of units of random types from a mix. Units fill a grid row by row, which is square
+  unless it has a width. With sparsity, that fraction of the grid's slots are left empty at random, so the grid is
+  bigger, otherwise only the end of the last row is empty.
+  """
+
+  if type_mix not in TYPE_MIXES:
+    raise ValueError(f'unknown type mix {type_mix}, not one of {", ".join(TYPE_MIXES)}')
+  if not 0 <= sparsity < 1:
+    raise ValueError(f'sparsity must be at least 0 and less than 1, not {sparsity}')
+
+  rng = random.Random(seed)
+
+  # Types are picked one at a time from a uniform mix, which keeps the fleets the same as earlier benchmarks battled
+  weights = TYPE_MIXES[type_mix]
+  if weights is None:
+    unit_types = [rng.choice(UNIT_TYPES) for _ in range(num_units)]
+  else:
+    unit_types = rng.choices(list(weights), weights=list(weights.values()), k=num_units)
+
+  num_slots = math.ceil(num_units / (1 - sparsity))
+  width = grid_width or max(math.ceil(math.sqrt(num_slots)), 1)
+  num_slots = math.ceil(num_slots / width) * width
+
+  if sparsity:
+    empty_slots = set(rng.sample(range(num_slots), num_slots - num_units))
+  else:
+    empty_slots = set(range(num_units, num_slots))
+
+  formation = []
+  manifest = {}
+  unit_types = iter(unit_types)
+  for slot in range(num_slots):
+    if slot % width == 0:
+      formation.append([])
+    if slot in empty_slots:
+      formation[-1].append(None)
+      continue
+    unit_id = str(len(manifest) + 1)
+    formation[-1].append(unit_id)
+    manifest[unit_id] = {'type': next(unit_types)}
+
+  return {'formation': formation, 'manifest': manifest}
+
+
+
+def generate_battle(num_units, seed, type_mix='uniform', sparsity=0.0, grid_width=None):
+  """ Generates the challenger and challengee fleets of a battle, which are alike but not the same """
+  return (
+    generate_fleet(num_units, seed, type_mix, sparsity, grid_width),
+    generate_fleet(num_units, seed + 1, type_mix, sparsity, grid_width)
+  )
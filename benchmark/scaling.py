@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Regression benchmark that times battles between fleets of increasing size, to show how the battle engine scales.
+
+Run from the project directory:
+  python3 benchmark/scaling.py
+"""
+
+import sys
+import time
+import argparse
+
+from pathlib import Path
+
+# The worker code isn't a package, so it is imported the same way the worker runs it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'worker'))
+
+from fleets import generate_fleet
+from waves import WAVE_FORMAT_DELTA, WAVE_FORMATS
+from worker import determine_battle_result
+
+FLEET_SIZES = (1000, 10000, 50000)
+
+
+def time_battle(num_units, wave_format, repeats):
+  """ Returns the fastest time out of a number of battles between two fleets of the same size """
+
+  challenger_fleet = generate_fleet(num_units, seed=num_units)
+  challengee_fleet = generate_fleet(num_units, seed=num_units + 1)
+
+  fastest = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    determine_battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format)
+    elapsed = time.perf_counter() - start
+    fastest = elapsed if fastest is None else min(fastest, elapsed)
+
+  return fastest
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--sizes', type=int, nargs='+', default=FLEET_SIZES, help='Number of ships in each fleet')
+  parser.add_argument('--wave-format', type=int, choices=WAVE_FORMATS, default=WAVE_FORMAT_DELTA)
+  parser.add_argument('--repeats', type=int, default=1, help='Battles per size, the fastest is reported')
+  parser.add_argument('--max-seconds', type=float, help='Fail if any battle takes longer than this')
+  args = parser.parse_args()
+
+  print(f'{"ships":>8} {"seconds":>10} {"us/ship":>10} {"growth":>8}')
+
+  previous = None
+  failed = False
+  for num_units in args.sizes:
+    elapsed = time_battle(num_units, args.wave_format, args.repeats)
+
+    # How much longer the battle took than the previous size, relative to how many more ships it has
+    growth = f'{(elapsed / previous[1]) / (num_units / previous[0]):.2f}x' if previous else '-'
+    print(f'{num_units:>8} {elapsed:>10.3f} {elapsed / num_units * 1e6:>10.1f} {growth:>8}')
+    previous = (num_units, elapsed)
+
+    if args.max_seconds is not None and elapsed > args.max_seconds:
+      failed = True
+
+  if failed:
+    print(f'FAILED: a battle took longer than {args.max_seconds} seconds')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
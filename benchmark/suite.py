@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite that measures the time, peak memory and result size of battles between synthetic fleets (see fleets.py)
+from 10 to 100k ships, and compares them with a saved baseline to flag regressions.
+
+Run from the project directory:
+  python3 benchmark/suite.py --save-baseline benchmark/baseline.json
+  python3 benchmark/suite.py --baseline benchmark/baseline.json
+
+Every case is run in a fresh process, so its peak memory isn't hidden by the cases run before it. Timings depend on the
+machine, so a baseline should only be compared with runs on the machine it was saved on.
+"""
+
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import NamedTuple
+
+# The worker code isn't a package, so it is imported the same way the worker runs it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'worker'))
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+from fleets import TYPE_MIXES, generate_battle
+from kernel import is_kernel_available
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, WAVE_FORMATS
+from worker import determine_battle_result
+
+BASELINE_VERSION = 1
+
+FLEET_SIZES = (10, 100, 1000, 10000, 50000, 100000)
+DEFAULT_TYPE_MIXES = ('uniform', 'skip_heavy')
+WAVE_FORMAT_NAMES = {WAVE_FORMAT_SNAPSHOT: 'snapshot', WAVE_FORMAT_DELTA: 'delta'}
+
+# Snapshot results hold the whole of both fleets in every wave, so they grow too large to measure past this size
+MAX_SNAPSHOT_UNITS = 10000
+
+# Battles are repeated, and the fastest is kept, until they've taken this long in all
+REPEAT_SECONDS = 5
+
+# How much worse than the baseline a case can be before it's flagged, as a fraction of the baseline. Small differences
+# are never flagged, as they're mostly noise.
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.25
+MIN_SECONDS_DIFFERENCE = 0.05
+MIN_BYTES_DIFFERENCE = 1024 ** 2
+
+
+class BenchmarkCase(NamedTuple):
+  """ A battle between two generated fleets of the same size """
+  num_units: int
+  type_mix: str
+  sparsity: float
+  wave_format: int
+
+  @property
+  def name(self):
+    return f'{self.num_units}-{self.type_mix}-{self.sparsity:g}-{WAVE_FORMAT_NAMES[self.wave_format]}'
+
+
+
+def build_cases(sizes, type_mixes, sparsities, wave_formats):
+  """ Every combination of the case parameters, smallest first, leaving out snapshot battles too large to measure """
+  return [
+    BenchmarkCase(num_units, type_mix, sparsity, wave_format)
+    for num_units, type_mix, sparsity, wave_format in itertools.product(sorted(sizes), type_mixes, sparsities, wave_formats)
+    if wave_format != WAVE_FORMAT_SNAPSHOT or num_units <= MAX_SNAPSHOT_UNITS
+  ]
+
+
+
+def run_case(case, max_repeats):
+  """
+  Measures a case in a process of its own, returning its measurements, or None if the process died, which is most often
+  because it ran out of memory
+  """
+  try:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+      return pool.submit(measure_case, case, max_repeats).result()
+  except (BrokenProcessPool, MemoryError):
+    return None
+
+
+
+def measure_case(case, max_repeats):
+  """
+  Returns the fastest time of the battle in a case, how much more memory the process used while running it, and the
+  size of its result as JSON
+  """
+
+  challenger_fleet, challengee_fleet = generate_battle(case.num_units, case.num_units, case.type_mix, case.sparsity)
+  gc.collect()
+  start_peak_bytes = peak_memory_bytes()
+
+  fastest = None
+  total = 0
+  result = None
+  for _ in range(max_repeats):
+    result = None
+    start = time.perf_counter()
+    result = determine_battle_result(challenger_fleet, challengee_fleet, wave_format=case.wave_format)
+    elapsed = time.perf_counter() - start
+    fastest = elapsed if fastest is None else min(fastest, elapsed)
+    total += elapsed
+    if total >= REPEAT_SECONDS:
+      break
+
+  end_peak_bytes = peak_memory_bytes()
+  return {
+    'seconds': fastest,
+    'peakBytes': None if start_peak_bytes is None else end_peak_bytes - start_peak_bytes,
+    'resultBytes': result_size(result)
+  }
+
+
+
+def peak_memory_bytes():
+  """ The most memory this process has used so far, or None where it can't be measured """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+def result_size(result):
+  """ The size of a battle result as JSON, without building all of the JSON at once """
+
+  # The JSON of a list is its items, separated by ', ', between the brackets of the empty list
+  waves = result['waves']
+  size = len(json.dumps(dict(result, waves={view: [] for view in waves})))
+  for view_waves in waves.values():
+    size += sum(len(json.dumps(wave)) for wave in view_waves) + 2 * max(len(view_waves) - 1, 0)
+  return size
+
+
+
+def find_regressions(case, measurements, baseline_measurements):
+  """ Returns a description of each way a case is worse than its baseline """
+
+  regressions = []
+
+  seconds, baseline_seconds = measurements['seconds'], baseline_measurements['seconds']
+  if seconds > baseline_seconds * (1 + TIME_TOLERANCE) and seconds - baseline_seconds > MIN_SECONDS_DIFFERENCE:
+    regressions.append(f'{case.name} took {seconds:.3f}s, up from {baseline_seconds:.3f}s')
+
+  peak_bytes, baseline_peak_bytes = measurements['peakBytes'], baseline_measurements['peakBytes']
+  if peak_bytes is not None and baseline_peak_bytes is not None:
+    if peak_bytes > baseline_peak_bytes * (1 + MEMORY_TOLERANCE) and peak_bytes - baseline_peak_bytes > MIN_BYTES_DIFFERENCE:
+      regressions.append(f'{case.name} used {megabytes(peak_bytes)}MB, up from {megabytes(baseline_peak_bytes)}MB')
+
+  # The fleets are always the same, so a result of a different size means the engine's results changed
+  if measurements['resultBytes'] != baseline_measurements['resultBytes']:
+    regressions.append(f'{case.name} result is {measurements["resultBytes"]} bytes, not {baseline_measurements["resultBytes"]}')
+
+  return regressions
+
+
+
+def read_baseline(baseline_path):
+  with open(baseline_path) as f:
+    baseline = json.load(f)
+  if baseline.get('version') != BASELINE_VERSION:
+    raise ValueError(f'baseline version {baseline.get("version")} is not supported')
+  return baseline
+
+
+
+def write_baseline(baseline_path, case_measurements):
+  """ Saves the measurements of cases to a baseline, keeping the cases in it that weren't run. Failed cases are null. """
+
+  baseline = read_baseline(baseline_path) if Path(baseline_path).exists() else {'cases': {}}
+  baseline.update(version=BASELINE_VERSION, environment=environment())
+  baseline['cases'].update((case.name, measurements) for case, measurements in case_measurements)
+
+  with open(baseline_path, 'w') as f:
+    json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+
+def environment():
+  """ What the measurements depend on besides the code """
+  return {'python': platform.python_version(), 'machine': platform.machine(), 'kernel': is_kernel_available()}
+
+
+
+def change(value, baseline_value):
+  """ A value relative to its baseline, as a percentage """
+  if value is None or not baseline_value:
+    return '-'
+  return f'{(value / baseline_value - 1) * 100:+.0f}%'
+
+
+
+def megabytes(num_bytes):
+  return '-' if num_bytes is None else f'{num_bytes / 1024 ** 2:.1f}'
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--sizes', type=int, nargs='+', default=FLEET_SIZES, help='Number of ships in each fleet')
+  parser.add_argument('--max-size', type=int, help='Leave out sizes larger than this')
+  parser.add_argument('--type-mixes', nargs='+', choices=TYPE_MIXES, default=DEFAULT_TYPE_MIXES, help='Mixes of unit types in the fleets')
+  parser.add_argument('--sparsities', type=float, nargs='+', default=[0.0], help='Fractions of the grid left empty')
+  parser.add_argument('--wave-formats', type=int, nargs='+', choices=WAVE_FORMATS, default=list(WAVE_FORMATS))
+  parser.add_argument('--repeats', type=int, default=5, help=f'Battles per case, the fastest is reported. Cases stop repeating after {REPEAT_SECONDS} seconds.')
+  parser.add_argument('--baseline', help='Compare with the baseline in this file, and fail if any case regressed')
+  parser.add_argument('--save-baseline', help='Save the measurements as the baseline in this file')
+  args = parser.parse_args()
+
+  sizes = [num_units for num_units in args.sizes if args.max_size is None or num_units <= args.max_size]
+  cases = build_cases(sizes, args.type_mixes, args.sparsities, args.wave_formats)
+
+  baseline_cases = {}
+  if args.baseline:
+    baseline = read_baseline(args.baseline)
+    baseline_cases = baseline['cases']
+    if baseline.get('environment') != environment():
+      print(f'WARNING: the baseline was saved with {baseline.get("environment")}, not {environment()}')
+
+  print(f'{"case":<32} {"seconds":>10} {"change":>8} {"peak MB":>10} {"change":>8} {"result MB":>10}')
+
+  case_measurements = []
+  regressions = []
+  for case in cases:
+    measurements = run_case(case, args.repeats)
+    case_measurements.append((case, measurements))
+
+    # Cases that failed in the baseline too aren't compared
+    baseline_measurements = baseline_cases.get(case.name) or {}
+    if measurements is None:
+      print(f'{case.name:<32} FAILED: the process died, most likely out of memory', flush=True)
+      if baseline_measurements:
+        regressions.append(f'{case.name} failed')
+      continue
+
+    print(
+      f'{case.name:<32} {measurements["seconds"]:>10.3f} {change(measurements["seconds"], baseline_measurements.get("seconds")):>8} '
+      f'{megabytes(measurements["peakBytes"]):>10} {change(measurements["peakBytes"], baseline_measurements.get("peakBytes")):>8} '
+      f'{megabytes(measurements["resultBytes"]):>10}', flush=True)
+
+    if baseline_measurements:
+      regressions += find_regressions(case, measurements, baseline_measurements)
+
+  if args.save_baseline:
+    write_baseline(args.save_baseline, case_measurements)
+    print(f'BASELINE SAVED TO {args.save_baseline}')
+
+  if regressions:
+    print(f'FAILED: {len(regressions)} regressions from the baseline')
+    for regression in regressions:
+      print(f'  {regression}')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,100 @@
+"""
+Claiming challenges before getting their results, so several requestors can run side by side without paying Golem
+to run the same battle twice
+"""
+
+import uuid
+import pytz
+
+from collections import OrderedDict
+from datetime import datetime
+from pynamodb.exceptions import UpdateError
+
+from models.challenge import Challenge
+
+
+class ChallengeClaims:
+  """
+  Claims the oldest challenges that need a result, by moving them from the 'prepared' state to 'processing' with a
+  conditional update, so only one requestor ever wins a challenge. A claim is a lease: a challenge that is still
+  'processing' when its lease runs out, because its requestor stopped or its battle failed, can be claimed again.
+  Every claim is counted in the challenge's lease_attempts, so challenges that keep failing can be given up on.
+  """
+
+  def __init__(self, lease_duration, page_size=50, max_unclaimable_ids=10000):
+    self.owner = uuid.uuid4().hex
+    self.lease_duration = lease_duration
+    self.page_size = page_size
+
+    # Prepared challenges that couldn't be claimed. They were either claimed by another requestor, or already had a result,
+    # and won't be 'prepared' and need a result again, so they aren't tried again. They only stay in the index until it
+    # catches up, so the ids least recently seen in it are forgotten once there are too many, and trying one of those
+    # again only costs a failed update.
+    self.unclaimable_ids = OrderedDict()
+    self.max_unclaimable_ids = max_unclaimable_ids
+
+  def claim(self, max_challenges):
+    """ Claims up to a maximum number of challenges, oldest first, returning them with the attributes the battle needs """
+
+    now = datetime.now(pytz.timezone('UTC'))
+    claimed = []
+
+    # The index is read a page at a time, and only as far as is needed to claim enough challenges
+    candidates = self.candidates(now)
+    while len(claimed) < max_challenges:
+      candidate = next(candidates, None)
+      if candidate is None:
+        break
+      challenge = self.try_claim(candidate, now)
+      if challenge:
+        claimed.append(challenge)
+
+    return claimed
+
+  def candidates(self, now):
+    """ Challenges that were claimed but whose lease ran out, then prepared challenges, each oldest first """
+
+    yield from Challenge.state_index.query(
+      'processing', filter_condition=Challenge.lease_expires < now, page_size=self.page_size)
+
+    for candidate in Challenge.state_index.query('prepared', page_size=self.page_size):
+      if candidate.id in self.unclaimable_ids:
+        self.unclaimable_ids.move_to_end(candidate.id)
+      else:
+        yield candidate
+
+  def try_claim(self, candidate, now):
+    """ Claims a challenge found in the index, returning it, or None if it can't be claimed """
+
+    # Only the challenge's keys and lease are read from the index. The claim returns the rest of it, without a result.
+    if candidate.state == 'processing':
+      condition = (Challenge.state == 'processing') & (Challenge.lease_expires == candidate.lease_expires)
+    else:
+      condition = (
+        (Challenge.state == 'prepared') & Challenge.result.does_not_exist()
+        & Challenge.result_compressed.does_not_exist() & Challenge.result_location.does_not_exist())
+
+    challenge = Challenge(candidate.id)
+    try:
+      challenge.update(
+        actions=[
+          Challenge.state.set('processing'),
+          Challenge.lease_owner.set(self.owner),
+          Challenge.lease_expires.set(now + self.lease_duration),
+          Challenge.lease_attempts.add(1),
+        ],
+        condition=condition)
+
+    except UpdateError as e:
+      if e.cause_response_code != 'ConditionalCheckFailedException':
+        raise
+      if candidate.state == 'prepared':
+        self.add_unclaimable_id(candidate.id)
+      return None
+
+    return challenge
+
+  def add_unclaimable_id(self, challenge_id):
+    self.unclaimable_ids[challenge_id] = None
+    if len(self.unclaimable_ids) > self.max_unclaimable_ids:
+      self.unclaimable_ids.popitem(last=False)
@@ -0,0 +1,36 @@
+import os
+import boto3
+
+from models.challenge import Challenge
+
+
+def create_table():
+  """ Creates the Challenge Table and its stream, if it doesn't exist. Used with DynamoDB Local, as AWS tables are created by deploy_aws.sh. """
+
+  if Challenge.exists():
+    print(f'TABLE {Challenge.Meta.table_name} ALREADY EXISTS')
+    return
+
+  Challenge.create_table(wait=True)
+  print(f'CREATED TABLE {Challenge.Meta.table_name}')
+
+
+def create_results_bucket():
+  """ Creates the bucket for results too big for DynamoDB, if RESULTS_BUCKET is set. Used with a local S3 stand-in at S3_HOST. """
+
+  bucket = os.environ.get('RESULTS_BUCKET')
+  if not bucket:
+    return
+
+  s3 = boto3.client('s3', region_name=Challenge.Meta.region, endpoint_url=os.environ.get('S3_HOST'))
+  if bucket in [b['Name'] for b in s3.list_buckets()['Buckets']]:
+    print(f'BUCKET {bucket} ALREADY EXISTS')
+    return
+
+  s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': Challenge.Meta.region})
+  print(f'CREATED BUCKET {bucket}')
+
+
+if __name__ == "__main__":
+  create_table()
+  create_results_bucket()
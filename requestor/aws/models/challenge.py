@@ -3,8 +3,8 @@ import json
 import logging
 
 from pynamodb.models import Model
-from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
-from pynamodb.attributes import UnicodeAttribute, NumberAttribute, JSONAttribute, UTCDateTimeAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, IncludeProjection
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute, JSONAttribute, UTCDateTimeAttribute, BinaryAttribute
 
 
 logging.basicConfig()
@@ -18,8 +18,9 @@ class StateIndex(GlobalSecondaryIndex):
     StateIndex global secondary index
     """
     class Meta:
-      index_name = 'StateIndex'
-      projection = AllProjection()
+      # Only the keys and lease are projected, so finding challenges to claim doesn't read their fleets or results
+      index_name = 'StateLeaseIndex'
+      projection = IncludeProjection(['lease_expires'])
 
       # Ignored, but required due to a bug in pynamoDB
       # https://github.com/pynamodb/PynamoDB/issues/429
@@ -31,6 +32,9 @@ class StateIndex(GlobalSecondaryIndex):
     # in the model
     state = UnicodeAttribute(hash_key=True)
 
+    # Challenges in a state are sorted by when they were created, oldest first
+    created = UTCDateTimeAttribute(range_key=True)
+
 
 class Challenge(Model):
   """
@@ -39,7 +43,14 @@ class Challenge(Model):
 
   class Meta:
       table_name = f'golem-fleet-battle-simulator-example.Challenge'
-      region = 'us-west-2'
+      region = os.environ.get('AWS_REGION', 'us-west-2')
+
+      # Set DYNAMODB_HOST to use another endpoint than AWS, such as DynamoDB Local at http://localhost:8000
+      host = os.environ.get('DYNAMODB_HOST')
+
+      # Tables created from the model have a stream the requestor listens to for prepared challenges
+      stream_view_type = 'NEW_IMAGE'
+      billing_mode = 'PAY_PER_REQUEST'
 
   # Id
   id = UnicodeAttribute(hash_key=True)
@@ -53,6 +64,16 @@ class Challenge(Model):
   # Current State of the Challenge
   state = UnicodeAttribute(default='created')
 
+  # The requestor that claimed the challenge to get its result, while it's in the 'processing' state,
+  # and when its claim runs out and another requestor can claim it
+  lease_owner = UnicodeAttribute(null=True)
+  lease_expires = UTCDateTimeAttribute(null=True)
+
+  # How many times the challenge has been claimed. Challenges whose battle never gets a result are moved to the 'failed'
+  # state after a few claims, with the last error in battle_error, so they aren't run and paid for again forever.
+  lease_attempts = NumberAttribute(null=True)
+  battle_error = UnicodeAttribute(null=True)
+
   # The game type of the Challenge (vs, cpu)
   game_type = UnicodeAttribute(default='vs')
 
@@ -79,8 +100,20 @@ class Challenge(Model):
   terms_specials = JSONAttribute(null=True)
   terms_cpu_options = JSONAttribute(null=True)
 
-  # Result
+  # The format of the waves in the result requested by the client (1 = snapshots, 2 = deltas)
+  wave_format = NumberAttribute(null=True)
+
+  # Result. Results too big for the item are gzipped JSON in result_compressed instead, or if they're still too big,
+  # gzipped JSON in S3 with its 's3://bucket/key' url in result_location. Those also have a replay in S3 (see
+  # worker/replay.py) with its url in replay_location, for reading single waves.
   result = JSONAttribute(null=True)
+  result_compressed = BinaryAttribute(null=True)
+  result_location = UnicodeAttribute(null=True)
+  replay_location = UnicodeAttribute(null=True)
+
+  # Challenges with fleets that can't battle are moved to the 'invalid' state instead of getting a result, with the
+  # problems found in their fleets (see worker/validation.py)
+  validation_problems = JSONAttribute(null=True)
 
   # Indexes
   state_index = StateIndex()
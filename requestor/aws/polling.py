@@ -0,0 +1,135 @@
+"""
+Finding prepared challenges quickly without hammering the table: a poll interval that adapts to how much work there is,
+and a listener for the table's DynamoDB Stream that wakes the poller as soon as a challenge is prepared.
+"""
+
+import boto3
+import asyncio
+
+
+class PollInterval:
+  """
+  How long to wait before the next poll. Polls that find work are followed straight away by another, so a backlog
+  is drained without waiting, and every empty poll doubles the wait, from the minimum up to the maximum.
+  """
+
+  def __init__(self, min_sec, max_sec):
+    self.min_sec = min_sec
+    self.max_sec = max_sec
+    self.sec = min_sec
+
+  def next(self, found_work):
+    """ Returns how long to wait after a poll that did or didn't find work """
+    if found_work:
+      self.reset()
+      return 0
+    sec = self.sec
+    self.sec = min(self.max_sec, self.sec * 2)
+    return sec
+
+  def reset(self):
+    self.sec = self.min_sec
+
+
+
+class ChallengeStream:
+  """
+  Listens to the DynamoDB Stream of the challenge table, and calls back whenever a challenge is saved in the 'prepared' state.
+  The stream needs a view type that includes new images. Shards that are open when listening starts are read from their
+  latest records, and shards that are added later, as the stream splits them, are read from their start.
+  """
+
+  # How often each shard is read, which DynamoDB limits to 5 times a second per shard, and how often new shards are looked for
+  RECORDS_INTERVAL_SEC = 0.25
+  SHARDS_INTERVAL_SEC = 30
+
+  def __init__(self, table_name, region, host=None):
+    self.table_name = table_name
+    self.dynamodb = boto3.client('dynamodb', region_name=region, endpoint_url=host)
+    self.streams = boto3.client('dynamodbstreams', region_name=region, endpoint_url=host)
+    self.stream_arn = None
+
+    # The iterator each open shard is read from next, and the shards that have been read to their end
+    self.shard_iterators = {}
+    self.finished_shards = set()
+
+  def is_enabled(self):
+    """ Checks if the table has a stream, remembering it to listen to """
+    self.stream_arn = self.dynamodb.describe_table(TableName=self.table_name)['Table'].get('LatestStreamArn')
+    return self.stream_arn is not None
+
+  async def listen(self, on_prepared):
+    """ Calls on_prepared with the id of every challenge saved in the 'prepared' state, forever """
+
+    loop = asyncio.get_event_loop()
+    first_refresh = True
+    next_refresh = 0
+
+    while True:
+      try:
+        # boto3 blocks, so requests are made off the event loop
+        if loop.time() >= next_refresh:
+          await loop.run_in_executor(None, self.refresh_shards, first_refresh)
+          first_refresh = False
+          next_refresh = loop.time() + self.SHARDS_INTERVAL_SEC
+
+        for shard_id in list(self.shard_iterators):
+          for challenge_id in await loop.run_in_executor(None, self.read_shard, shard_id):
+            on_prepared(challenge_id)
+
+      # Records missed while the stream can't be read are found by the next regular poll, so listening just starts again
+      except Exception as e:
+        print(f'STREAM ERROR: {e}')
+        self.shard_iterators.clear()
+        first_refresh = True
+        next_refresh = 0
+
+      await asyncio.sleep(self.RECORDS_INTERVAL_SEC)
+
+  def refresh_shards(self, from_latest):
+    """ Gets an iterator for every shard that isn't being read yet """
+
+    shards = []
+    describe_args = {'StreamArn': self.stream_arn}
+    while True:
+      description = self.streams.describe_stream(**describe_args)['StreamDescription']
+      shards += description['Shards']
+      if 'LastEvaluatedShardId' not in description:
+        break
+      describe_args['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+
+    for shard in shards:
+      shard_id = shard['ShardId']
+      is_open = 'EndingSequenceNumber' not in shard['SequenceNumberRange']
+      if shard_id in self.shard_iterators or shard_id in self.finished_shards:
+        continue
+
+      # Closed shards only hold records from before listening started
+      if from_latest and not is_open:
+        self.finished_shards.add(shard_id)
+        continue
+
+      self.shard_iterators[shard_id] = self.streams.get_shard_iterator(
+        StreamArn=self.stream_arn,
+        ShardId=shard_id,
+        ShardIteratorType='LATEST' if from_latest else 'TRIM_HORIZON'
+      )['ShardIterator']
+
+  def read_shard(self, shard_id):
+    """ Reads the records added to a shard since it was last read, returning the ids of challenges that were prepared """
+
+    response = self.streams.get_records(ShardIterator=self.shard_iterators[shard_id])
+
+    # A shard that has been closed and read to its end has no next iterator
+    if response.get('NextShardIterator'):
+      self.shard_iterators[shard_id] = response['NextShardIterator']
+    else:
+      del self.shard_iterators[shard_id]
+      self.finished_shards.add(shard_id)
+
+    return [
+      record['dynamodb']['Keys']['id']['S']
+      for record in response['Records']
+      if record['eventName'] in ('INSERT', 'MODIFY')
+      and record['dynamodb'].get('NewImage', {}).get('state', {}).get('S') == 'prepared'
+    ]
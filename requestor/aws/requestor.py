@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import boto3
 import json
 import uuid
 import copy
-import time
+import math
 import pytz
 import asyncio
 
 from datetime import datetime
 from typing import NamedTuple
 from pynamodb.exceptions import DoesNotExist
-from models.challenge import Challenge
 
 from datetime import timedelta
 from pathlib import Path
@@ -22,15 +23,45 @@ from yapapi import Executor, Task, WorkContext
 from yapapi.log import enable_default_logger, log_event_repr, log_summary
 from yapapi.package import vm
 
+# Challenges' fleets are checked against their terms, and their battles cached or run on this machine, by the worker code
+sys.path.append(str(Path(__file__).resolve().parents[2] / "worker"))
+from battle_cache import BattleCache
+from backends import get_backend, worker_image_hash
+from waves import WAVE_FORMAT_SNAPSHOT
+from metrics import MetricsAggregator
+from result_encoding import supported_result_encodings, decode_battle_result
+from validation import BattleTerms, InvalidBattleError, normalize_fleets
+
+from models.challenge import Challenge
+from polling import PollInterval, ChallengeStream
+from claims import ChallengeClaims
+from results import result_writer_from_env
 
 # Worker paths
-FLEETS_PATH = Path("/golem/input/fleets.json")
-RESULT_PATH = Path("/golem/output/result.json")
+BATTLES_PATH = Path("/golem/input/battles.jsonl")
+RESULTS_PATH = Path("/golem/output/results.jsonl")
 ENTRYPOINT_PATH = Path("/golem/entrypoint/worker.py")
 
-# Data paths
-DATA_PATH = Path("data/fleets.json")
-OUTPUT_PATH = Path("data/result.json")
+# Results are sent back in the most compact encoding both sides support, and decoded as they're downloaded
+RESULT_ENCODINGS = supported_result_encodings()
+
+# The most challenges packed into a single Golem task
+BATCH_SIZE = 50
+
+# Results of battles that were already run are reused from the cache, which is kept under a size limit
+CACHE_DIR = Path("data/cache")
+CACHE_MAX_BYTES = 1024 ** 3
+
+# With COLLECT_METRICS set, every battle collects its metrics, which are totalled by provider and saved after every run
+COLLECT_METRICS = bool(os.environ.get('COLLECT_METRICS'))
+METRICS_PATH = Path("data/metrics.json")
+
+# Polls that find nothing wait longer and longer before the next, between the bounds. While the table's stream is
+# being listened to, prepared challenges wake the poller straight away, so polls can be much further apart.
+MIN_POLL_INTERVAL_SEC = 0.1
+MAX_POLL_INTERVAL_SEC = 1
+MAX_STREAM_POLL_INTERVAL_SEC = 30
+LISTEN_TO_STREAM = True
 
 # Golem Executor args
 NETWORK = "rinkeby"
@@ -39,69 +70,223 @@ DRIVER = "zksync"
 BUDGET = 0.1
 TASK_TIMEOUT = timedelta(minutes=10)
 
+# The most providers the challenges of a poll are spread across
+MAX_WORKERS = 5
+
+# The most challenges claimed by a poll, and how long a claim lasts before another requestor can claim the challenge.
+# Claims last longer than a run can take, so a challenge is only claimed again if its requestor stopped or its battle failed.
+MAX_CLAIMS_PER_POLL = BATCH_SIZE * MAX_WORKERS
+LEASE_DURATION = TASK_TIMEOUT + timedelta(minutes=5)
+
+# The most runs getting results at once. Each run has its own Executor and BUDGET, so this caps what the requestor can
+# spend at once, and how much of the backlog it claims: challenges beyond what it's running are left for other requestors,
+# instead of waiting on a claim that may run out before they're run.
+MAX_CONCURRENT_RUNS = 2
+
+# Challenges whose battle still has no result after this many claims are moved to the 'failed' state, so a battle that
+# errors or crashes the worker every time isn't claimed and paid for again every LEASE_DURATION, forever
+MAX_BATTLE_ATTEMPTS = 3
+
 
 def main():
   
   print('STARTING TO POLL FOR PREPARED CHALLENGES...')
+
+  # yapapi debug logging to a file
+  enable_default_logger(log_file="yapapi.log")
+
+  loop = asyncio.get_event_loop()
+  task = loop.create_task(poll_challenges())
+
+  try:
+    loop.run_until_complete(task)
+  except KeyboardInterrupt:
+    # Make sure Executor is closed gracefully before exiting
+    task.cancel()
+    loop.run_until_complete(task)
+
+
+
+async def poll_challenges():
+  ''' 
+  Polls for prepared challenges and gets their results, forever
+  '''
+
+  loop = asyncio.get_event_loop()
+
+  # The backend runs the battles of every poll
+  backend = get_backend(GolemBackend)
+
+  # Challenges are claimed before they're run, so other requestors polling the same table don't run them too
+  claims = ChallengeClaims(LEASE_DURATION)
+  result_writer = result_writer_from_env()
+  cache = BattleCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+  metrics = MetricsAggregator() if COLLECT_METRICS else None
+  runs = set()
+
+  # Listen to the table's stream, if it has one, to poll as soon as a challenge is prepared
+  wake = asyncio.Event()
+  poll_interval = PollInterval(MIN_POLL_INTERVAL_SEC, MAX_POLL_INTERVAL_SEC)
+  if LISTEN_TO_STREAM:
+    stream_task = await listen_to_stream(wake)
+    if stream_task:
+      poll_interval.max_sec = MAX_STREAM_POLL_INTERVAL_SEC
   
   # Loop forever
   while True:
+
+    # Nothing more is claimed until a run finishes, once as many as are allowed are running
+    while len(runs) >= MAX_CONCURRENT_RUNS:
+      done, _ = await asyncio.wait(runs, return_when=asyncio.FIRST_COMPLETED)
+      runs.difference_update(done)
+
+    found_challenges = False
+    wake.clear()
     
     try:
-      
-      print(f'POLLING!\n')
 
-      # Get prepared challenges
-      prepared_challenges = get_prepared_challenges()
+      # Claim the oldest challenges that need a result
+      claimed_challenges = await loop.run_in_executor(None, claims.claim, MAX_CLAIMS_PER_POLL)
       
-      if prepared_challenges:
+      if claimed_challenges:
+        found_challenges = True
+        print(f'CLAIMED {len(claimed_challenges)} CHALLENGES')
       
-        # Get results using Golem
-        get_results(prepared_challenges)
+        # Get results using Golem, while polling carries on for more challenges
+        run = loop.create_task(get_results(claimed_challenges, backend, result_writer, cache, metrics))
+        runs.add(run)
+        run.add_done_callback(lambda run: finish_run(run, runs))
 
     except Exception as e:
       print(f'GENERAL ERROR: {e}')
       
-    # Sleep for 10 seconds
-    print(f'SLEEPING...\n\n')
-    time.sleep(10) 
-        
+    # Wait until the next poll, or until the stream says a challenge was prepared. The index is updated a little after
+    # the stream, so polls after a wake up start again from the shortest wait in case the first one is too early.
+    delay = poll_interval.next(found_challenges)
+    if delay:
+      try:
+        await asyncio.wait_for(wake.wait(), delay)
+        poll_interval.reset()
+      except asyncio.TimeoutError:
+        pass
+
 
 
-def get_prepared_challenges():
+async def listen_to_stream(wake):
   ''' 
-  Checks our challenge index for challenges in the 'prepared' state the search parameters and returns them
+  Starts listening to the challenge table's stream, setting the wake event whenever a challenge is prepared.
+  Returns the listening task, or None if the table has no stream.
   '''
-  
-  # Query our index for matching challenges
-  challenges_in_prepared_state = Challenge.state_index.query('prepared')
 
-  print(f'PREPARED CHALLENGES: challenges_in_prepared_state')
+  stream = ChallengeStream(Challenge.Meta.table_name, Challenge.Meta.region, Challenge.Meta.host)
+
+  try:
+    enabled = await asyncio.get_event_loop().run_in_executor(None, stream.is_enabled)
+  except Exception as e:
+    print(f'STREAM ERROR: {e}')
+    enabled = False
+
+  if not enabled:
+    print('NO STREAM ON THE CHALLENGE TABLE, ONLY POLLING')
+    return None
+
+  print(f'LISTENING TO {stream.stream_arn}')
+  return asyncio.get_event_loop().create_task(stream.listen(lambda challenge_id: wake.set()))
+
+
+
+def finish_run(run, runs):
+  ''' 
+  Forgets a finished run. Any of its challenges that didn't get a result are claimed again once their lease runs out.
+  '''
+
+  runs.discard(run)
+  if not run.cancelled() and run.exception():
+    print(f'GENERAL ERROR: {run.exception()}')
 
-  # Return the matching challenge models
-  return challenges_in_prepared_state
-  
 
 
-def get_results(prepared_challenges):
+async def get_results(claimed_challenges, backend, result_writer, cache, metrics=None):
   ''' 
   Get fleet battle results
   '''
 
-  for challenge in prepared_challenges:
-    
-    if not challenge.result:
-      
-      print(f'CHALLENGE {challenge.id} NEEDS A RESULT')
-      
-      determine_battle_result_w_golem(
-        challenge=challenge,
-        challenger_fleet=copy.deepcopy(challenge.challenger_fleet),
-        challengee_fleet=copy.deepcopy(challenge.challengee_fleet)
-      )
+  loop = asyncio.get_event_loop()
+
+  # Challenges with fleets that can't battle are turned away before anything is spent on them
+  claimed_challenges, invalid_challenges = await loop.run_in_executor(None, validate_challenges, claimed_challenges)
+  if invalid_challenges:
+    rejected = await loop.run_in_executor(None, result_writer.reject_all, invalid_challenges)
+    print(f"{rejected} OF {len(invalid_challenges)} INVALID CHALLENGES REJECTED")
+
+  # Challenges whose last claim ran out without a result or an error, such as when the requestor or its run died,
+  # are given up on once they've had all their attempts
+  exhausted_challenges = [
+    (challenge, f'no battle result after {MAX_BATTLE_ATTEMPTS} attempts')
+    for challenge in claimed_challenges if (challenge.lease_attempts or 0) > MAX_BATTLE_ATTEMPTS
+  ]
+  if exhausted_challenges:
+    await fail_challenges(exhausted_challenges, result_writer)
+    exhausted_challenge_ids = {challenge.id for challenge, error in exhausted_challenges}
+    claimed_challenges = [challenge for challenge in claimed_challenges if challenge.id not in exhausted_challenge_ids]
+
+  # Battles that were already run get their results from the cache, without being run again
+  cached_results = await loop.run_in_executor(None, get_cached_results, claimed_challenges, cache)
+  if cached_results:
+    await save_results(cached_results, result_writer)
 
-    else:
-      print(f'CHALLENGE {challenge.id} HAD RESULT')
+  # Claimed challenges never have a result yet
+  cached_challenge_ids = {challenge.id for challenge, result in cached_results}
+  challenges = {challenge.id: challenge for challenge in claimed_challenges if challenge.id not in cached_challenge_ids}
+
+  # All of the battles are sent to the backend together
+  if challenges:
+    await run_battles(challenges, backend, result_writer, cache, metrics)
+
+
+
+def validate_challenges(challenges):
+  ''' 
+  Checks the fleets of challenges against their terms, returning the valid challenges and a list of (challenge, problems)
+  pairs for the rest. The fleets of valid challenges are normalized in place, so the cache and the worker see the same
+  fleets. They're never saved back to the challenge, which only ever has its result or problems saved.
+  '''
+
+  valid_challenges = []
+  invalid_challenges = []
+  for challenge in challenges:
+    try:
+      challenge.challenger_fleet, challenge.challengee_fleet = normalize_fleets(
+        challenge.challenger_fleet, challenge.challengee_fleet, challenge_terms(challenge))
+    except InvalidBattleError as e:
+      print(f"INVALID FLEETS FOR {challenge.id}: {e}")
+      invalid_challenges.append((challenge, e.problem_dicts()))
+      continue
+    valid_challenges.append(challenge)
+
+  return valid_challenges, invalid_challenges
+
+
+
+def get_cached_results(challenges, cache):
+  ''' 
+  Returns a list of (challenge, result) pairs for the challenges whose battles are in the cache
+  '''
+
+  cached_results = []
+  for challenge in challenges:
+    result = cache.get(challenge.challenger_fleet, challenge.challengee_fleet, battle_wave_format(challenge))
+    if result:
+      print(f"CACHED BATTLE RESULT FOR {challenge.id}")
+      cached_results.append((challenge, result))
+
+  return cached_results
+
+
+
+def cache_results(challenge_results, cache):
+  for challenge, result in challenge_results:
+    cache.put(challenge.challenger_fleet, challenge.challengee_fleet, battle_wave_format(challenge), result)
 
 
 ####################
@@ -109,35 +294,60 @@ def get_results(prepared_challenges):
 ####################
 
 
-def determine_battle_result_w_golem(challenge, challenger_fleet, challengee_fleet):
+def build_battle(challenge):
   ''' 
-  Use Golem to get the battle result
+  Builds a line of a batch of battles for the worker from a challenge
   '''
-  
-  with open(str(DATA_PATH), 'w') as outfile:
-    json.dump({'challenger':challenger_fleet, 'challengee': challengee_fleet}, outfile)
-  
-  loop = asyncio.get_event_loop()
-  task = loop.create_task(run_golem(challenge))
 
-  # yapapi debug logging to a file
-  enable_default_logger(log_file="yapapi.log")
+  battle = {
+    'id': challenge.id,
+    'challenger': copy.deepcopy(challenge.challenger_fleet),
+    'challengee': copy.deepcopy(challenge.challengee_fleet)
+  }
 
-  try:
-    loop.run_until_complete(task)
-  except KeyboardInterrupt:
-    # Make sure Executor is closed gracefully before exiting
-    task.cancel()
-    loop.run_until_complete(task)
-    
-    
-    
-def data(fleets_file: Path) -> Iterator[Task]:
+  # Only request a wave format if the client chose one, otherwise the worker's default is used
+  if challenge.wave_format:
+    battle['waveFormat'] = int(challenge.wave_format)
+
+  # The worker checks the fleets against the terms again before running the battle
+  terms = challenge_terms(challenge)
+  if terms:
+    battle['terms'] = terms.to_dict()
+
+  if COLLECT_METRICS:
+    battle['collectMetrics'] = True
+
+  return battle
+
+
+
+def challenge_terms(challenge):
+  ''' 
+  The terms of a challenge that its fleets are checked against, or None if it has none
+  '''
+  terms = [challenge.terms_units, challenge.terms_grid_width, challenge.terms_grid_height]
+  if all(term is None for term in terms):
+    return None
+  return BattleTerms(*(None if term is None else int(term) for term in terms))
+
+
+
+def battle_wave_format(challenge):
+  ''' 
+  The wave format of a challenge's battle result, which is the worker's default if the client didn't choose one
+  '''
+  return int(challenge.wave_format) if challenge.wave_format else WAVE_FORMAT_SNAPSHOT
+
+
+
+def data(battles) -> Iterator[Task]:
   """
-  Return an iterator of `Task` objects.
+  Return an iterator of `Task` objects, each holding a batch of battles.
+  The battles are split into enough tasks to keep every worker busy.
   """
-  with fleets_file.open() as f:
-    yield Task(data=json.load(f))
+  batch_size = min(BATCH_SIZE, math.ceil(len(battles) / MAX_WORKERS))
+  for batch_start in range(0, len(battles), batch_size):
+    yield Task(data=battles[batch_start:batch_start + batch_size])
 
 
 
@@ -149,63 +359,132 @@ async def steps(context: WorkContext, tasks: AsyncIterable[Task]):
   The signature of this function cannot change, as it's used internally by `Executor`.
   """
   
-  context.send_file(str(DATA_PATH), str(FLEETS_PATH))
-
   async for task in tasks:
-    
-    context.run(str(ENTRYPOINT_PATH))
+
+    # Every task has its own batch of battles to send
+    battles_file = NamedTemporaryFile(mode='w', suffix='.jsonl')
+    for battle in task.data:
+      battles_file.write(json.dumps(dict(battle, resultEncodings=RESULT_ENCODINGS)) + '\n')
+    battles_file.flush()
+    context.send_file(battles_file.name, str(BATTLES_PATH))
+
+    context.run(str(ENTRYPOINT_PATH), '--batch')
 
     output_file = NamedTemporaryFile()
-    context.download_file(str(RESULT_PATH), output_file.name)
+    context.download_file(str(RESULTS_PATH), output_file.name)
     yield context.commit()
 
-    task.accept_result(result=json.load(output_file))
+    battle_results = [decode_battle_result(json.loads(line)) for line in output_file if line.strip()]
+
+    # Metrics are compared by the provider that ran the battles
+    for battle_result in battle_results:
+      if 'metrics' in battle_result:
+        battle_result['metrics']['provider'] = context.provider_name
+
+    task.accept_result(result=battle_results)
     output_file.close()
+    battles_file.close()
 
 
 
-async def run_golem(challenge):
+class GolemBackend:
+  """ Runs battles on Golem, with a single Executor spreading them across as many providers as there are workers """
 
-  # Set of parameters for the VM run by each of the providers
-  package = await vm.repo(
-    image_hash="29a71cc7cdddfbfb911c04ac981296acae18651723516d58888fd01e",
-    min_mem_gib=1.0,
-    min_storage_gib=1.0,
-  )
+  name = 'golem'
 
-  executor = Executor(
-    package=package,
-    max_workers=1,
-    budget=BUDGET,
-    network=NETWORK,
-    driver=DRIVER,
-    subnet_tag=SUBNET,
-    event_consumer=log_summary(log_event_repr),
-    timeout=TASK_TIMEOUT,
-  )
+  def __init__(self):
+    self.package = None
 
-  result = ""
-  async with executor:
-    async for task in executor.submit(steps, data(DATA_PATH)):
-      # Every task object we receive here represents a computed task
-      if task.result:
-        result = task.result
-        break
+  async def run_battles(self, battles):
 
-    if result:
-      print(f"GOLEM BATTLE RESULT: {result}")
-      set_result(result, challenge)
-    else:
-      print("NO GOLEM BATTLE RESULT.")
+    # The parameters for the VM run by each of the providers are looked up once and used for every run
+    if self.package is None:
+      self.package = await vm.repo(
+        image_hash=worker_image_hash(),
+        min_mem_gib=1.0,
+        min_storage_gib=1.0,
+      )
+
+    executor = Executor(
+      package=self.package,
+      max_workers=min(MAX_WORKERS, len(battles)),
+      budget=BUDGET,
+      network=NETWORK,
+      driver=DRIVER,
+      subnet_tag=SUBNET,
+      event_consumer=log_summary(log_event_repr),
+      timeout=TASK_TIMEOUT,
+    )
+
+    async with executor:
+      async for task in executor.submit(steps, data(battles)):
+        # Every task object we receive here represents a computed batch of battles
+        if task.result:
+          yield task.result
+
+
+
+async def run_battles(challenges, backend, result_writer, cache, metrics=None):
+
+  battles = [build_battle(challenge) for challenge in challenges.values()]
+
+  async for battle_results in backend.run_battles(battles):
+    # Results that are done together are saved together, as are the errors of battles that are out of attempts.
+    # Other errors are left for the challenge to be claimed and run again once its lease runs out.
+    challenge_results = []
+    challenge_errors = []
+    for battle_result in battle_results:
+      challenge = challenges.pop(battle_result['id'])
+      if metrics is not None and 'metrics' in battle_result:
+        metrics.add(challenge.id, battle_result['metrics'])
+      if 'result' in battle_result:
+        print(f"{backend.name.upper()} BATTLE RESULT FOR {challenge.id}")
+        challenge_results.append((challenge, battle_result['result']))
+      else:
+        print(f"{backend.name.upper()} BATTLE ERROR FOR {challenge.id}: {battle_result.get('error')}")
+        if (challenge.lease_attempts or 0) >= MAX_BATTLE_ATTEMPTS:
+          challenge_errors.append((challenge, battle_result.get('error') or 'battle failed'))
+
+    if challenge_results:
+      await save_results(challenge_results, result_writer)
+      await asyncio.get_event_loop().run_in_executor(None, cache_results, challenge_results, cache)
+    if challenge_errors:
+      await fail_challenges(challenge_errors, result_writer)
+
+  for challenge_id in challenges:
+    print(f"NO {backend.name.upper()} BATTLE RESULT FOR {challenge_id}.")
+
+  # Battles that the backend finished without on their last attempt are given up on now, rather than on their next claim
+  challenge_errors = [
+    (challenge, f'no battle result after {MAX_BATTLE_ATTEMPTS} attempts')
+    for challenge in challenges.values() if (challenge.lease_attempts or 0) >= MAX_BATTLE_ATTEMPTS
+  ]
+  if challenge_errors:
+    await fail_challenges(challenge_errors, result_writer)
+
+  if metrics is not None and metrics.battle_count:
+    metrics.print_summary()
+    metrics.save(METRICS_PATH)
       
       
 
-def set_result(result, challenge):
-  challenge.result = result
-  challenge.state = 'complete'
-  challenge.golem_timestamp = datetime.now(pytz.timezone('UTC'))
-  challenge.save(Challenge.state == 'prepared')
-  print("RESULT SAVED")
+async def fail_challenges(challenge_errors, result_writer):
+  ''' 
+  Moves challenges whose battles are out of attempts to the 'failed' state, with their errors
+  '''
+
+  failed = await asyncio.get_event_loop().run_in_executor(None, result_writer.fail_all, challenge_errors)
+  print(f"{failed} OF {len(challenge_errors)} FAILED CHALLENGES SAVED")
+
+
+
+async def save_results(challenge_results, result_writer):
+  ''' 
+  Saves a batch of results together, off the event loop so other runs carry on meanwhile
+  '''
+
+  saved = await asyncio.get_event_loop().run_in_executor(None, result_writer.write_all, challenge_results)
+  print(f"{saved} OF {len(challenge_results)} RESULTS SAVED")
   
   
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""
+Saving battle results back to challenges. Only the attributes that change are written, results too big for a DynamoDB
+item are compressed or moved to S3, and writes that are throttled are retried.
+"""
+
+import os
+import gzip
+import json
+import time
+import boto3
+import pytz
+import random
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import UpdateError
+
+from models.challenge import Challenge
+from replay import build_replay
+
+
+# Errors that mean a request should be tried again after a while
+RETRYABLE_ERROR_CODES = {
+  'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError',
+  'SlowDown', 'Throttling', 'RequestTimeout', 'InternalError', 'ServiceUnavailable'
+}
+
+
+class ResultTooLarge(Exception):
+  """ A result that is too big for a challenge, with no S3 bucket to move it to """
+
+
+class ResultWriter:
+  """
+  Saves results to the challenges they were claimed for, writing a group of results at once across several threads.
+
+  A result is saved in the challenge's `result` attribute if the challenge stays under the item size limit, otherwise
+  it's gzipped into `result_compressed`. A result that is still too big is uploaded gzipped to the S3 bucket, and
+  `result_location` is set to its 's3://bucket/key' url. A replay of it is uploaded alongside, with its url in
+  `replay_location`, so single waves of the battle can be read with ranged requests instead of downloading it all.
+  """
+
+  # DynamoDB items can't be larger than 400 KB, including the fleets and the rest of the challenge
+  MAX_ITEM_BYTES = 400 * 1024
+  ITEM_OVERHEAD_BYTES = 8 * 1024
+
+  MAX_ATTEMPTS = 8
+  BASE_BACKOFF_SEC = 0.1
+  MAX_BACKOFF_SEC = 5
+
+  def __init__(self, bucket=None, s3_host=None, region=None, concurrency=8):
+    self.bucket = bucket
+    self.s3 = boto3.client('s3', region_name=region, endpoint_url=s3_host) if bucket else None
+    self.concurrency = concurrency
+
+  def write_all(self, challenge_results):
+    """ Saves a list of (challenge, result) pairs, returning the number saved. Results that can't be saved are logged. """
+    with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+      return sum(pool.map(lambda challenge_result: self.try_write(*challenge_result), challenge_results))
+
+  def reject_all(self, challenge_problems):
+    """ Moves a list of (challenge, problems) pairs to the 'invalid' state, returning the number moved """
+    return sum(self.try_reject(challenge, problems) for challenge, problems in challenge_problems)
+
+  def fail_all(self, challenge_errors):
+    """ Moves a list of (challenge, error) pairs to the 'failed' state, returning the number moved """
+    return sum(self.try_fail(challenge, error) for challenge, error in challenge_errors)
+
+  def try_write(self, challenge, result):
+    return self.try_update(challenge, lambda: self.write(challenge, result), 'RESULT')
+
+  def try_reject(self, challenge, problems):
+    return self.try_update(challenge, lambda: self.reject(challenge, problems), 'REJECTION')
+
+  def try_fail(self, challenge, error):
+    return self.try_update(challenge, lambda: self.fail(challenge, error), 'FAILURE')
+
+  def try_update(self, challenge, update, name):
+    try:
+      saved = update()
+    except Exception as e:
+      print(f"{name} FOR {challenge.id} NOT SAVED: {e}")
+      return False
+
+    if not saved:
+      print(f"CLAIM ON {challenge.id} WAS LOST, {name} NOT SAVED")
+    return saved
+
+  def write(self, challenge, result):
+    """ Saves a result, returning False if the challenge's claim was lost to another requestor """
+    return self.update_claimed(challenge, [Challenge.state.set('complete'), *self.result_actions(challenge, result)])
+
+  def reject(self, challenge, problems):
+    """ Saves the problems with a challenge's fleets instead of a result, returning False if its claim was lost """
+    return self.update_claimed(challenge, [Challenge.state.set('invalid'), Challenge.validation_problems.set(problems)])
+
+  def fail(self, challenge, error):
+    """ Saves the error of a battle that keeps failing instead of a result, returning False if its claim was lost """
+    return self.update_claimed(challenge, [Challenge.state.set('failed'), Challenge.battle_error.set(error)])
+
+  def update_claimed(self, challenge, actions):
+    """ Finishes with a claimed challenge, releasing the claim, unless the claim was lost to another requestor """
+
+    actions = [
+      *actions,
+      Challenge.golem_timestamp.set(datetime.now(pytz.timezone('UTC'))),
+      Challenge.lease_owner.remove(),
+      Challenge.lease_expires.remove(),
+    ]
+
+    # The challenge is only updated while this requestor's claim on it stands
+    condition = (Challenge.state == 'processing') & (Challenge.lease_owner == challenge.lease_owner)
+    try:
+      self.with_retries(lambda: challenge.update(actions=actions, condition=condition))
+    except UpdateError as e:
+      if e.cause_response_code != 'ConditionalCheckFailedException':
+        raise
+      return False
+
+    return True
+
+  def result_actions(self, challenge, result):
+    """ The updates that store a result, in whichever form fits in the challenge """
+
+    result_json = json.dumps(result, separators=(',', ':')).encode()
+    fleets_json = json.dumps([challenge.challenger_fleet, challenge.challengee_fleet], separators=(',', ':')).encode()
+    max_result_bytes = self.MAX_ITEM_BYTES - self.ITEM_OVERHEAD_BYTES - len(fleets_json)
+
+    if len(result_json) <= max_result_bytes:
+      return [Challenge.result.set(result)]
+
+    compressed_result = gzip.compress(result_json)
+    if len(compressed_result) <= max_result_bytes:
+      return [Challenge.result_compressed.set(compressed_result)]
+
+    if not self.s3:
+      raise ResultTooLarge(f'{len(compressed_result)} bytes compressed, and no bucket is set to upload it to')
+
+    key = f'results/{challenge.id}.json.gz'
+    self.with_retries(lambda: self.s3.put_object(
+      Bucket=self.bucket, Key=key, Body=compressed_result, ContentType='application/json', ContentEncoding='gzip'))
+
+    replay_key = f'results/{challenge.id}.replay'
+    replay = build_replay(result)
+    self.with_retries(lambda: self.s3.put_object(Bucket=self.bucket, Key=replay_key, Body=replay, ContentType='application/octet-stream'))
+
+    return [Challenge.result_location.set(f's3://{self.bucket}/{key}'), Challenge.replay_location.set(f's3://{self.bucket}/{replay_key}')]
+
+  def with_retries(self, request):
+    """ Makes a request, trying again with exponential backoff and jitter while it's throttled """
+
+    for attempt in range(self.MAX_ATTEMPTS):
+      try:
+        return request()
+      except (UpdateError, ClientError) as e:
+        code = e.cause_response_code if isinstance(e, UpdateError) else e.response.get('Error', {}).get('Code')
+        if code not in RETRYABLE_ERROR_CODES or attempt == self.MAX_ATTEMPTS - 1:
+          raise
+        time.sleep(random.uniform(0, min(self.MAX_BACKOFF_SEC, self.BASE_BACKOFF_SEC * 2 ** attempt)))
+
+
+
+def result_writer_from_env():
+  """ A result writer that uploads results too big for DynamoDB to the bucket in RESULTS_BUCKET, if it's set """
+  return ResultWriter(
+    bucket=os.environ.get('RESULTS_BUCKET'),
+    s3_host=os.environ.get('S3_HOST'),
+    region=Challenge.Meta.region)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import json
 import asyncio
 
@@ -15,14 +17,40 @@ from yapapi import Executor, Task, WorkContext
 from yapapi.log import enable_default_logger, log_event_repr, log_summary
 from yapapi.package import vm
 
+# Fleets are checked, and battles cached and run on this machine, with the worker code itself
+sys.path.append(str(Path(__file__).resolve().parents[2] / "worker"))
+from battle_cache import BattleCache
+from backends import get_backend, worker_image_hash
+from waves import WAVE_FORMAT_SNAPSHOT
+from metrics import MetricsAggregator
+from result_encoding import supported_result_encodings, decode_battle_result
+from validation import InvalidBattleError, normalize_battle
+from worker import build_battle_error
+
 # Worker paths
-FLEETS_PATH = Path("/golem/input/fleets.json")
-RESULT_PATH = Path("/golem/output/result.json")
+BATTLES_PATH = Path("/golem/input/battles.jsonl")
+RESULTS_PATH = Path("/golem/output/results.jsonl")
 ENTRYPOINT_PATH = Path("/golem/entrypoint/worker.py")
 
+# Results are sent back in the most compact encoding both sides support, and decoded as they're downloaded
+RESULT_ENCODINGS = supported_result_encodings()
+
 # Data paths
 INPUT_PATH = Path("data/fleets.json")
 OUTPUT_PATH = Path("data/result.json")
+BATCH_INPUT_PATH = Path("data/battles.jsonl")
+BATCH_OUTPUT_PATH = Path("data/results.jsonl")
+
+# Results of battles that were already run are reused from the cache, which is kept under a size limit
+CACHE_DIR = Path("data/cache")
+CACHE_MAX_BYTES = 1024 ** 3
+
+# With COLLECT_METRICS set, every battle that is run collects its metrics, which are totalled by provider and saved
+COLLECT_METRICS = bool(os.environ.get('COLLECT_METRICS'))
+METRICS_PATH = Path("data/metrics.json")
+
+# The most battles packed into a single Golem task
+BATCH_SIZE = 50
 
 # Golem Executor args
 NETWORK = "rinkeby"
@@ -34,13 +62,18 @@ TASK_TIMEOUT = timedelta(minutes=10)
 
 def main():
   ''' 
-  Use Golem to get the battle result
+  Use Golem, or the local backend, to get the battle result
   '''
 
-  print('RUNNING FLEET BATTLE SIMUATION WITH LOCAL INPUT FILE')
+  # A batch of battles is run instead of a single battle, if there is one
+  batch = BATCH_INPUT_PATH.exists()
+  if batch:
+    print('RUNNING FLEET BATTLE SIMUATIONS WITH LOCAL BATCH INPUT FILE')
+  else:
+    print('RUNNING FLEET BATTLE SIMUATION WITH LOCAL INPUT FILE')
   
   loop = asyncio.get_event_loop()
-  task = loop.create_task(run_golem())
+  task = loop.create_task(run_battle_batch() if batch else run_battle())
 
   # yapapi debug logging to a file
   enable_default_logger(log_file="yapapi.log")
@@ -54,77 +87,189 @@ def main():
     
     
     
-def data(fleets_file: Path) -> Iterator[Task]:
+def batch_data(battles) -> Iterator[Task]:
   """
-  Return an iterator of `Task` objects.
+  Return an iterator of `Task` objects, each holding a batch of battles.
   """
-  with fleets_file.open() as f:
-    yield Task(data=json.load(f))
+  for batch_start in range(0, len(battles), BATCH_SIZE):
+    yield Task(data=battles[batch_start:batch_start + BATCH_SIZE])
 
 
 
-async def steps(context: WorkContext, tasks: AsyncIterable[Task]):
-  """Prepare a sequence of steps which need to happen for a task to be computed.
-  `WorkContext` is a utility which allows us to define a series of commands to
-  interact with a provider.
-  Tasks are provided from a common, asynchronous queue.
+async def batch_steps(context: WorkContext, tasks: AsyncIterable[Task]):
+  """Prepare the steps to compute each task, which is a batch of battles.
   The signature of this function cannot change, as it's used internally by `Executor`.
   """
-  
-  context.send_file(str(INPUT_PATH), str(FLEETS_PATH))
 
   async for task in tasks:
-    
-    context.run(str(ENTRYPOINT_PATH))
+
+    # Every task has its own batch of battles to send
+    battles_file = NamedTemporaryFile(mode='w', suffix='.jsonl')
+    for battle in task.data:
+      battles_file.write(json.dumps(dict(battle, resultEncodings=RESULT_ENCODINGS)) + '\n')
+    battles_file.flush()
+    context.send_file(battles_file.name, str(BATTLES_PATH))
+
+    context.run(str(ENTRYPOINT_PATH), '--batch')
 
     output_file = NamedTemporaryFile()
-    context.download_file(str(RESULT_PATH), output_file.name)
+    context.download_file(str(RESULTS_PATH), output_file.name)
     yield context.commit()
 
-    task.accept_result(result=json.load(output_file))
+    battle_results = [decode_battle_result(json.loads(line)) for line in output_file if line.strip()]
+
+    # Metrics are compared by the provider that ran the battles
+    for battle_result in battle_results:
+      if 'metrics' in battle_result:
+        battle_result['metrics']['provider'] = context.provider_name
+
+    task.accept_result(result=battle_results)
     output_file.close()
+    battles_file.close()
+
+
+
+class GolemBackend:
+  """ Runs battles on Golem, packed into tasks of up to BATCH_SIZE battles """
+
+  name = 'golem'
 
+  async def run_battles(self, battles):
 
+    # Set of parameters for the VM run by each of the providers
+    package = await vm.repo(
+      image_hash=worker_image_hash(),
+      min_mem_gib=1.0,
+      min_storage_gib=1.0,
+    )
 
-async def run_golem():
+    executor = Executor(
+      package=package,
+      max_workers=1,
+      budget=BUDGET,
+      network=NETWORK,
+      driver=DRIVER,
+      subnet_tag=SUBNET,
+      event_consumer=log_summary(log_event_repr),
+      timeout=TASK_TIMEOUT,
+    )
 
-  # Set of parameters for the VM run by each of the providers
-  package = await vm.repo(
-    image_hash="29a71cc7cdddfbfb911c04ac981296acae18651723516d58888fd01e",
-    min_mem_gib=1.0,
-    min_storage_gib=1.0,
-  )
+    async with executor:
+      async for task in executor.submit(batch_steps, batch_data(battles)):
+        # Every task object we receive here represents a computed batch of battles
+        if task.result:
+          yield task.result
 
-  executor = Executor(
-    package=package,
-    max_workers=1,
-    budget=BUDGET,
-    network=NETWORK,
-    driver=DRIVER,
-    subnet_tag=SUBNET,
-    event_consumer=log_summary(log_event_repr),
-    timeout=TASK_TIMEOUT,
-  )
+
+
+async def run_battle():
+
+  with INPUT_PATH.open() as f:
+    fleets = json.load(f)
+
+  # Fleets that can't battle are turned away before anything is spent on them
+  try:
+    fleets = normalize_battle(fleets)
+  except InvalidBattleError as e:
+    print(f"INVALID FLEETS: {e}")
+    return
+
+  # A battle that was already run doesn't need to be run again
+  cache = BattleCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+  result = cache.get(fleets.get('challenger'), fleets.get('challengee'), fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT))
+  if result:
+    print(f"CACHED FLEET BATTLE RESULT: {result}")
+    save_result(result)
+    return
+
+  backend = get_backend(GolemBackend)
+  battle = dict(fleets, id=INPUT_PATH.stem)
+  if COLLECT_METRICS:
+    battle['collectMetrics'] = True
+  metrics = MetricsAggregator()
 
   result = ""
-  async with executor:
-    async for task in executor.submit(steps, data(INPUT_PATH)):
-      # Every task object we receive here represents a computed task
-      if task.result:
-        result = task.result
-        break
-
-    if result:
-      print(f"GOLEM FLEET BATTLE RESULT: {result}")
-      save_result(result)
-    else:
-      print("NO GOLEM BATTLE RESULT!")
+  async for battle_results in backend.run_battles([battle]):
+    for battle_result in battle_results:
+      result = battle_result.get('result')
+      if not result:
+        print(f"FLEET BATTLE ERROR: {battle_result.get('error')}")
+      if 'metrics' in battle_result:
+        metrics.add(battle_result['id'], battle_result['metrics'])
+
+  if result:
+    print(f"{backend.name.upper()} FLEET BATTLE RESULT: {result}")
+    save_result(result)
+    cache.put(fleets.get('challenger'), fleets.get('challengee'), fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT), result)
+  else:
+    print("NO FLEET BATTLE RESULT!")
+
+  save_metrics(metrics)
       
       
 
+async def run_battle_batch():
+
+  with BATCH_INPUT_PATH.open() as f:
+    battles = [json.loads(line) for line in f if line.strip()]
+
+  # Results are saved as they're found or computed, one line for each battle
+  result_count = 0
+  with BATCH_OUTPUT_PATH.open('w') as outfile:
+
+    # Battles with fleets that can't battle get their errors straight away. Battles that were already run are saved
+    # from the cache, and only the rest are run.
+    cache = BattleCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+    uncached_battles = []
+    for battle in battles:
+      try:
+        battle = normalize_battle(battle)
+      except InvalidBattleError as e:
+        print(f"INVALID FLEETS FOR {battle.get('id')}: {e}")
+        outfile.write(json.dumps(build_battle_error(battle.get('id'), e)) + '\n')
+        result_count += 1
+        continue
+
+      result = cache.get(battle.get('challenger'), battle.get('challengee'), battle.get('waveFormat', WAVE_FORMAT_SNAPSHOT))
+      if result:
+        print(f"CACHED FLEET BATTLE RESULT FOR {battle.get('id')}")
+        outfile.write(json.dumps({'id': battle.get('id'), 'result': result}) + '\n')
+        result_count += 1
+      else:
+        uncached_battles.append(dict(battle, collectMetrics=True) if COLLECT_METRICS else battle)
+
+    metrics = MetricsAggregator()
+    if uncached_battles:
+      uncached_battles_by_id = {battle.get('id'): battle for battle in uncached_battles}
+      backend = get_backend(GolemBackend)
+      async for battle_results in backend.run_battles(uncached_battles):
+        for battle_result in battle_results:
+          print(f"{backend.name.upper()} FLEET BATTLE {'RESULT' if 'result' in battle_result else 'ERROR'} FOR {battle_result['id']}")
+          outfile.write(json.dumps(battle_result) + '\n')
+          result_count += 1
+          if 'metrics' in battle_result:
+            metrics.add(battle_result['id'], battle_result['metrics'])
+
+          battle = uncached_battles_by_id.get(battle_result['id'])
+          if battle and 'result' in battle_result:
+            cache.put(battle.get('challenger'), battle.get('challengee'), battle.get('waveFormat', WAVE_FORMAT_SNAPSHOT), battle_result['result'])
+
+  print(f"FLEET BATTLE RESULTS SAVED: {result_count}")
+  save_metrics(metrics)
+
+
+
 def save_result(result):
   with open(str(OUTPUT_PATH), 'w') as outfile:
     json.dump(result, outfile)
+
+
+
+def save_metrics(metrics):
+  if metrics.battle_count:
+    metrics.print_summary()
+    metrics.save(METRICS_PATH)
+    print(f"FLEET BATTLE METRICS SAVED TO {METRICS_PATH}")
   
   
 if __name__ == "__main__":
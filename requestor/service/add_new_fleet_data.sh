@@ -1,4 +1,8 @@
 #!/bin/sh
-# Copies the example_fleets.json file to a new file called fleets.json which the FleetBattleService will process
+# Copies the example_fleets.json file to a new, uniquely named file in the inbox directory which the FleetBattleService will process.
+# The copy is made outside the inbox and then moved in, so the service never sees a partly written file.
 
-cp data/example_fleets.json data/fleets.json
\ No newline at end of file
+mkdir -p data/inbox
+name="fleets-$(date +%s%N)-$$.json"
+cp data/example_fleets.json "data/$name" && mv "data/$name" "data/inbox/$name"
+echo "Added data/inbox/$name, the result will be saved to data/outbox/$name"
@@ -0,0 +1,198 @@
+"""
+Load aware dispatch and autoscaling for a cluster of fleet battle services
+"""
+
+import math
+import time
+import statistics
+
+
+class InstanceLoad:
+  """ The jobs a service instance is running, and how fast it has been running them """
+
+  # How much the latest batch counts towards the recent time per job of an instance
+  SMOOTHING = 0.3
+
+  def __init__(self):
+    self.jobs = []
+    self.batch_started = None
+    self.seconds_per_job = None
+    self.batch_count = 0
+    self.idle_since = time.monotonic()
+
+  def start_batch(self, jobs):
+    self.jobs = jobs
+    self.batch_started = time.monotonic()
+
+  def finish_batch(self):
+    """ Records how long the batch took per job, returning its jobs. A batch that was already given up on isn't recorded. """
+    if not self.jobs:
+      return []
+    batch_seconds_per_job = (time.monotonic() - self.batch_started) / len(self.jobs)
+    if self.seconds_per_job is None:
+      self.seconds_per_job = batch_seconds_per_job
+    else:
+      self.seconds_per_job += self.SMOOTHING * (batch_seconds_per_job - self.seconds_per_job)
+    self.batch_count += 1
+    return self.take_jobs()
+
+  def take_jobs(self):
+    """ Returns the jobs of the batch, which is over """
+    jobs, self.jobs = self.jobs, []
+    self.batch_started = None
+    self.idle_since = time.monotonic()
+    return jobs
+
+
+class ClusterManager:
+  """
+  Spreads the job queue across the instances of a cluster and keeps the number of instances in line with the backlog.
+  Instances take jobs when they have none running, so busy instances never get more, and each takes a share of the
+  waiting jobs that is weighted by how fast it has recently been running them.
+  Instances that fail are replaced, as are instances much slower than the rest and instances whose batch has been
+  running for so long that it may never finish, and instances are added or stopped as the backlog grows or shrinks,
+  between the minimum and maximum.
+  """
+
+  def __init__(self, job_queue, min_instances=1, max_instances=1, jobs_per_instance=20, max_jobs_per_commit=10,
+    slow_instance_factor=3.0, min_batches_to_judge=3, scale_down_delay_sec=60, max_batch_sec_per_job=1200):
+    self.job_queue = job_queue
+    self.min_instances = min_instances
+    self.max_instances = max_instances
+    self.jobs_per_instance = jobs_per_instance
+    self.max_jobs_per_commit = max_jobs_per_commit
+    self.slow_instance_factor = slow_instance_factor
+    self.min_batches_to_judge = min_batches_to_judge
+    self.scale_down_delay_sec = scale_down_delay_sec
+    self.max_batch_sec_per_job = max_batch_sec_per_job
+    self.cluster = None
+    self.loads = {}
+    self.requested_instances = 0
+    self.stopped_instances = set()
+    self.last_scaled_up = time.monotonic()
+
+  def manage(self, cluster, num_instances):
+    """ Starts managing a cluster that was asked to run a number of instances """
+    self.cluster = cluster
+    self.requested_instances = num_instances
+
+  def load(self, service):
+    if service not in self.loads:
+      self.loads[service] = InstanceLoad()
+    return self.loads[service]
+
+  ####################
+  # DISPATCH
+  ####################
+
+  def job_allowance(self, service):
+    """ The number of waiting jobs an instance takes at once, weighted by how fast it runs jobs compared to the others """
+
+    # Counting the job the instance has already taken
+    waiting_jobs = self.job_queue.qsize() + 1
+
+    running_instances = self.running_instances()
+    speeds = {
+      other_service: 1 / self.load(other_service).seconds_per_job
+      for other_service in running_instances
+      if self.load(other_service).seconds_per_job
+    }
+
+    # Instances that haven't run anything yet are counted as typical
+    typical_speed = statistics.median(speeds.values()) if speeds else 1
+    speed = speeds.get(service, typical_speed)
+    total_speed = sum(speeds.values()) + typical_speed * (max(1, len(running_instances)) - len(speeds))
+
+    share = math.ceil(waiting_jobs * speed / total_speed) if total_speed else waiting_jobs
+    return max(1, min(self.max_jobs_per_commit, share))
+
+  def running_instances(self):
+    """ Instances that are running and haven't been asked to stop """
+    return [
+      service for service in (self.cluster.instances if self.cluster else self.loads)
+      if service.state.value == 'running' and service not in self.stopped_instances
+    ]
+
+  def start_batch(self, service, jobs):
+    self.load(service).start_batch(jobs)
+
+  def finish_batch(self, service):
+    self.load(service).finish_batch()
+
+  def requeue_batch(self, service):
+    """ Puts the jobs of an instance that failed to finish its batch back in the queue """
+    jobs = self.load(service).take_jobs()
+    if jobs:
+      print(f"*** REQUEUEING {len(jobs)} JOBS FROM {service.provider_name}")
+      self.job_queue.requeue(jobs)
+
+  ####################
+  # SCALING
+  ####################
+
+  def active_instance_count(self):
+    """ Instances that are running or starting, including those still waiting for a provider """
+    commissioned = len(self.cluster.instances)
+    active = len([s for s in self.cluster.instances if s.state.value in ('starting', 'running') and s not in self.stopped_instances])
+    return active + max(0, self.requested_instances - commissioned)
+
+  def spawn(self, num_instances, reason):
+    print(f"*** SPAWNING {num_instances} INSTANCES: {reason}")
+    self.requested_instances += num_instances
+    self.cluster.spawn_instances(num_instances)
+
+  def stop(self, service, reason):
+    print(f"*** STOPPING INSTANCE ON {service.provider_name}: {reason}")
+    self.stopped_instances.add(service)
+    self.cluster.stop_instance(service)
+
+  def monitor(self):
+    """ Replaces failed, stuck and slow instances, and scales the cluster to the backlog. Called regularly while the cluster runs. """
+
+    # Replace instances that ended without being stopped, after putting any jobs they had back in the queue
+    for service in self.cluster.instances:
+      if service.state.value in ('terminated', 'unresponsive') and service not in self.stopped_instances:
+        self.stopped_instances.add(service)
+        self.requeue_batch(service)
+        self.spawn(1, f'replacing failed instance on {service.provider_name}')
+
+    # An instance that never finishes its batch is never judged slow, so one whose batch is long overdue is treated as
+    # failed, and its jobs are put back in the queue
+    now = time.monotonic()
+    for service in self.running_instances():
+      load = self.load(service)
+      if load.jobs and now - load.batch_started > self.max_batch_sec_per_job * len(load.jobs):
+        batch_seconds = now - load.batch_started
+        self.requeue_batch(service)
+        self.stop(service, f'batch still running after {batch_seconds:.0f}s')
+        self.spawn(1, f'replacing stuck instance on {service.provider_name}')
+
+    # Replace an instance that runs jobs much slower than the others
+    judged = {
+      service: self.load(service).seconds_per_job for service in self.running_instances()
+      if self.load(service).batch_count >= self.min_batches_to_judge
+    }
+    if len(judged) > 1:
+      slowest = max(judged, key=judged.get)
+      others = statistics.median(seconds for service, seconds in judged.items() if service is not slowest)
+      if judged[slowest] > self.slow_instance_factor * others:
+        self.stop(slowest, f'{judged[slowest]:.2f}s per job while the others take {others:.2f}s')
+        self.spawn(1, f'replacing slow instance on {slowest.provider_name}')
+
+    # Keep enough instances for the backlog
+    backlog = self.job_queue.qsize() + sum(len(load.jobs) for load in self.loads.values())
+    wanted = max(self.min_instances, min(self.max_instances, math.ceil(backlog / self.jobs_per_instance)))
+    active = self.active_instance_count()
+
+    if wanted > active:
+      self.last_scaled_up = time.monotonic()
+      self.spawn(wanted - active, f'backlog of {backlog} jobs')
+
+    # Only stop instances once the backlog has stayed low for a while, starting with those that have been idle longest
+    elif wanted < active and time.monotonic() - self.last_scaled_up > self.scale_down_delay_sec:
+      idle_instances = sorted(
+        (s for s in self.running_instances() if not self.load(s).jobs
+          and time.monotonic() - self.load(s).idle_since > self.scale_down_delay_sec),
+        key=lambda s: self.load(s).idle_since)
+      for service in idle_instances[:active - wanted]:
+        self.stop(service, f'backlog of {backlog} jobs')
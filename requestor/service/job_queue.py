@@ -0,0 +1,275 @@
+"""
+A queue of battle jobs for the fleet battle service, with a future for the result of each job
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+
+from pathlib import Path
+from typing import NamedTuple
+
+from waves import WAVE_FORMAT_SNAPSHOT
+from result_encoding import decode_result
+from validation import InvalidBattleError, normalize_battle
+
+
+class BattleJobError(Exception):
+  """ A battle job that the worker couldn't determine the result of, with the problems found in its fleets if they can't battle """
+
+  def __init__(self, message, problems=None):
+    super().__init__(message)
+    self.problems = problems
+
+
+class BattleJob(NamedTuple):
+  """ A battle waiting for a result from the service """
+  job_id: str
+  challenge_id: str
+  input_path: Path
+  result_path: Path
+  metrics_path: Path
+  future: asyncio.Future
+  queued_at: float
+
+
+class BattleJobQueue:
+  """
+  Battle jobs waiting to be run by the service. Jobs are kept as uniquely named files in a directory until they are done,
+  so submissions that arrive close together never overwrite each other.
+  With a battle cache, battles that were already run get their result straight away, and are never queued.
+  With a metrics aggregator, the metrics of every battle that is run are added to it (see metrics.py).
+  """
+
+  def __init__(self, jobs_dir=Path("data/jobs"), cache=None, metrics=None):
+    self.jobs_dir = jobs_dir
+    self.jobs_dir.mkdir(parents=True, exist_ok=True)
+    self.cache = cache
+    self.metrics = metrics
+    self._queue = asyncio.Queue()
+
+    # Every job that doesn't have a result yet, whether it's waiting or being run
+    self._unfinished_jobs = {}
+
+  def qsize(self):
+    """ The number of jobs waiting to be run """
+    return self._queue.qsize()
+
+  def submit(self, challenge_id, fleets):
+    """ Queues a battle between the fleets of a challenge, returning a future for its result """
+    job = self._new_job(challenge_id)
+    fleets = self._normalize_fleets(job, fleets)
+    if fleets is None or self._set_cached_result(job, fleets):
+      return job.future
+    with job.input_path.open('w') as f:
+      json.dump(fleets, f)
+    self._queue.put_nowait(job)
+    return job.future
+
+  def submit_file(self, challenge_id, fleets_path):
+    """ Queues the battle in a fleets file, which is moved to the jobs directory, returning a future for its result """
+    job = self._new_job(challenge_id)
+    fleets = self._read_fleets(fleets_path)
+    normalized_fleets = self._normalize_fleets(job, fleets)
+    if normalized_fleets is None or self._set_cached_result(job, normalized_fleets):
+      fleets_path.unlink()
+      return job.future
+
+    # The file is only rewritten if normalizing changed the fleets
+    if normalized_fleets is fleets:
+      os.replace(str(fleets_path), str(job.input_path))
+    else:
+      with job.input_path.open('w') as f:
+        json.dump(normalized_fleets, f)
+      fleets_path.unlink()
+    self._queue.put_nowait(job)
+    return job.future
+
+  def _new_job(self, challenge_id):
+    job_id = uuid.uuid4().hex
+    job = BattleJob(
+      job_id=job_id,
+      challenge_id=challenge_id,
+      input_path=self.jobs_dir / f'{job_id}.json',
+      result_path=self.jobs_dir / f'{job_id}.result.json',
+      metrics_path=self.jobs_dir / f'{job_id}.metrics.json',
+      future=asyncio.get_event_loop().create_future(),
+      queued_at=time.monotonic()
+    )
+    self._unfinished_jobs[job_id] = job
+    job.future.add_done_callback(lambda future: self._unfinished_jobs.pop(job_id, None))
+    return job
+
+  def _normalize_fleets(self, job, fleets):
+    """ Returns the fleets of a job normalized, or fails the job and returns None if they can't battle """
+    if fleets is None:
+      self.fail(job, BattleJobError(f'fleets for challenge {job.challenge_id} are not a JSON object'))
+      return None
+    try:
+      return normalize_battle(fleets)
+    except InvalidBattleError as e:
+      self.fail(job, BattleJobError(f"fleets for challenge {job.challenge_id} can't battle: {e}", e.problem_dicts()))
+      return None
+
+  def _set_cached_result(self, job, fleets):
+    """ Sets the result of a job from the cache, if its battle is cached, returning whether it was """
+    if not self.cache:
+      return False
+    result = self.cache.get(fleets.get('challenger'), fleets.get('challengee'), fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT))
+    if result:
+      print(f"*** CACHED RESULT FOR {job.challenge_id}")
+      job.future.set_result(result)
+    return bool(result)
+
+  def _cache_result(self, job, result):
+    fleets = self._read_fleets(job.input_path)
+    if fleets is not None:
+      self.cache.put(fleets.get('challenger'), fleets.get('challengee'), fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT), result)
+
+  def _read_fleets(self, fleets_path):
+    # Files that can't be read, or don't hold a JSON object, have no fleets
+    try:
+      with fleets_path.open() as f:
+        fleets = json.load(f)
+    except (OSError, ValueError):
+      return None
+    return fleets if isinstance(fleets, dict) else None
+
+  async def get_jobs(self, max_jobs):
+    """ Waits for at least one job, then returns every job waiting to be run, up to a maximum """
+
+    jobs = []
+    while not jobs:
+      job = await self._queue.get()
+      jobs = self.take_waiting_jobs(max_jobs - 1, [job])
+    return jobs
+
+  def take_waiting_jobs(self, max_jobs, jobs=None):
+    """ Returns jobs that are waiting to be run, up to a maximum, without waiting for more """
+
+    jobs = jobs or []
+    max_jobs += len(jobs)
+    while len(jobs) < max_jobs and not self._queue.empty():
+      jobs.append(self._queue.get_nowait())
+
+    # Jobs that their submitter gave up on, or that got a result some other way, aren't run
+    for job in [job for job in jobs if job.future.done()]:
+      self._remove_files(job)
+      jobs.remove(job)
+
+    return jobs
+
+  def overdue_jobs(self, max_age_sec):
+    """ Jobs that still don't have a result a while after they were submitted, whether they're waiting or being run """
+    now = time.monotonic()
+    return [job for job in self._unfinished_jobs.values() if now - job.queued_at > max_age_sec]
+
+  def read_battle(self, job):
+    """ Reads the battle of a job, as a line of a batch for the worker with the job id as its id, or None if it can't be read """
+    fleets = self._read_fleets(job.input_path)
+    return dict(fleets, id=job.job_id) if fleets is not None else None
+
+  def requeue(self, jobs):
+    """ Puts jobs that couldn't be run back in the queue, so they are run again """
+    for job in jobs:
+      if job.future.done():
+        self._remove_files(job)
+      else:
+        self._queue.put_nowait(job)
+
+  def complete(self, job, provider=None):
+    """
+    Sets the result of a job from its downloaded result file, in whichever encoding the worker wrote it, along with
+    the metrics of its battle on a provider if they were downloaded too
+    """
+
+    self._add_metrics_file(job, provider)
+
+    try:
+      with job.result_path.open(mode="rb") as f:
+        result = decode_result(f.read())
+    except (OSError, ValueError) as e:
+      self.fail(job, BattleJobError(f'no result for challenge {job.challenge_id}: {e}'))
+      return
+
+    self.settle(job, result if 'error' in result else {'result': result})
+
+  def _add_metrics_file(self, job, provider):
+    if self.metrics is None or not job.metrics_path.exists():
+      return
+    try:
+      with job.metrics_path.open() as f:
+        self.metrics.add(job.challenge_id, json.load(f), provider)
+    except (OSError, ValueError) as e:
+      print(f"*** NO METRICS FOR {job.challenge_id}: {e}")
+
+  def settle(self, job, battle_result, remove_files=True):
+    """
+    Sets the result of a job from a battle result holding either the 'result' or the 'error' of its battle, and
+    optionally its 'metrics'. A job that is also being run elsewhere keeps its files until that run is over.
+    """
+
+    # Every run of a battle has its metrics added, even if another run already set the job's result
+    if self.metrics is not None and 'metrics' in battle_result:
+      self.metrics.add(job.challenge_id, battle_result['metrics'])
+
+    if not job.future.done():
+      if 'error' in battle_result:
+        job.future.set_exception(BattleJobError(f"battle for challenge {job.challenge_id} failed: {battle_result['error']}"))
+      else:
+        job.future.set_result(battle_result['result'])
+        if self.cache:
+          self._cache_result(job, battle_result['result'])
+
+    if remove_files:
+      self._remove_files(job)
+
+  def fail(self, job, exception):
+    """ Sets the exception of a job that will never have a result """
+    if not job.future.done():
+      job.future.set_exception(exception)
+    self._remove_files(job)
+
+  def _remove_files(self, job):
+    for path in (job.input_path, job.result_path, job.metrics_path):
+      if path.exists():
+        path.unlink()
+
+
+
+async def watch_inbox(job_queue, inbox_dir, outbox_dir, poll_interval_sec):
+  """
+  Queues every fleets file added to an inbox directory, and saves each result to a file with the same name in an outbox directory.
+  Files should be moved into the inbox once they are complete, so a partly written file is never queued.
+  """
+
+  inbox_dir.mkdir(parents=True, exist_ok=True)
+  outbox_dir.mkdir(parents=True, exist_ok=True)
+
+  while True:
+    for fleets_path in sorted(inbox_dir.glob('*.json')):
+      print(f"*** QUEUEING {fleets_path.name}")
+      future = job_queue.submit_file(fleets_path.stem, fleets_path)
+      future.add_done_callback(lambda future, result_path=outbox_dir / fleets_path.name: save_result(future, result_path))
+    await asyncio.sleep(poll_interval_sec)
+
+
+
+def save_result(future, result_path):
+  """ Saves the result of a job to a file, or the error if it failed """
+
+  if future.cancelled():
+    return
+
+  exception = future.exception()
+  if exception:
+    result = {'error': str(exception)}
+    if getattr(exception, 'problems', None):
+      result['problems'] = exception.problems
+  else:
+    result = future.result()
+  with result_path.open('w') as f:
+    json.dump(result, f)
+  print(f"*** SAVED RESULT TO {result_path}")
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import os
-import os.path
+import sys
 import asyncio
 
 from pathlib import Path
@@ -11,6 +11,16 @@ from yapapi.services import Service
 from yapapi.log import enable_default_logger
 from yapapi.payload import vm
 
+# The job queue's cache, the local fallback and the result encodings the daemon is asked for all come from the worker code
+sys.path.append(str(Path(__file__).resolve().parents[2] / "worker"))
+from backends import BACKEND, LOCAL_FALLBACK_SEC, LocalBackend, worker_image_hash
+from battle_cache import BattleCache
+from metrics import MetricsAggregator
+from result_encoding import supported_result_encodings
+
+from cluster import ClusterManager
+from job_queue import BattleJobError, BattleJobQueue, watch_inbox
+
 # Golem args
 NETWORK = "rinkeby"
 SUBNET = "devnet-beta.2"
@@ -18,66 +28,125 @@ DRIVER = "zksync"
 BUDGET = 0.1
 MONITOR_INTERVAL_SEC = 5
 
+# Data paths. Fleets files moved into the inbox get a result with the same name in the outbox.
+INBOX_DIR = Path("data/inbox")
+OUTBOX_DIR = Path("data/outbox")
+INBOX_POLL_INTERVAL_SEC = 0.1
+
+# Results of battles that were already run are reused from the cache, which is kept under a size limit
+CACHE_DIR = Path("data/cache")
+CACHE_MAX_BYTES = 1024 ** 3
+
+# With COLLECT_METRICS set, every battle collects its metrics, which are totalled by provider and saved as they come in
+COLLECT_METRICS = bool(os.environ.get('COLLECT_METRICS'))
+METRICS_PATH = Path("data/metrics.json")
+
+# Cluster args. The number of instances grows and shrinks between the bounds, aiming for a backlog per instance.
+MIN_INSTANCES = 1
+MAX_INSTANCES = 5
+JOBS_PER_INSTANCE = 20
+SLOW_INSTANCE_FACTOR = 3.0
+SCALE_DOWN_DELAY_SEC = 120
+
+# The most jobs an instance sends, runs and downloads together in one batch of commands
+MAX_JOBS_PER_COMMIT = 10
+
+# How long the worker daemon gets for each job of a batch. If it hasn't finished them all by then, most likely because
+# it died, the batch fails and its jobs are run elsewhere.
+JOB_TIMEOUT_SEC = 600
+
+# Instances whose batch has taken this long per job are given up on, even if the daemon's timeout never fired, such as
+# when sending or downloading files hangs. It's longer than the job timeout, to leave time for the files.
+MAX_BATCH_SEC_PER_JOB = 2 * JOB_TIMEOUT_SEC
+
+# How often jobs are checked for having gone past LOCAL_FALLBACK_SEC on Golem, when they're run locally as well
+FALLBACK_CHECK_INTERVAL_SEC = 1
+
 
 class FleetBattleService(Service):
-  INPUT_PATH = Path("data/fleets.json")
-  OUTPUT_PATH = Path("data/result.json")
-  FLEETS_PATH = Path("/golem/input/fleets.json")
-  RESULT_PATH = Path("/golem/output/result.json")
-  ENTRYPOINT_PATH = Path("/golem/entrypoint/worker.py")
+  JOBS_INPUT_DIR = Path("/golem/input/jobs")
+  JOBS_OUTPUT_DIR = Path("/golem/output/jobs")
+  JOBS_FIFO_PATH = Path("/golem/work/jobs.fifo")
+  DONE_DIR = Path("/golem/work/done")
+  DAEMON_PATH = Path("/golem/entrypoint/daemon.py")
+
+  # The queue every instance of the service takes jobs from, and the manager that shares it out between instances.
+  # Both are set before the service is run.
+  job_queue: BattleJobQueue = None
+  cluster_manager: ClusterManager = None
 
   @staticmethod
   async def get_payload():
     return await vm.repo(
-      image_hash="29a71cc7cdddfbfb911c04ac981296acae18651723516d58888fd01e",
+      image_hash=worker_image_hash(),
       min_mem_gib=0.5,
       min_storage_gib=1.0,
     )
 
   async def start(self):
     print("*** STARTING SERVICE")
+
+    # The worker daemon is started once and stays up with the service, so battles don't pay for starting the worker.
+    # It writes results in the most compact encoding both sides support, which the job queue decodes.
+    daemon_args = ["--start", "--result-encodings", ",".join(supported_result_encodings())]
+    if COLLECT_METRICS:
+      daemon_args.append("--metrics")
+    self._ctx.run(str(self.DAEMON_PATH), *daemon_args)
     yield self._ctx.commit()
 
   async def run(self):
     while True:
 
-      # This causes the service to check for new data every second
-      await asyncio.sleep(1)
-
-      # Checks for a 'data/fleets.json' file.
-      # If it exists, the service will process it, send back a 'data/result.json' file, and clean up the 'data/fleets.json' file.
-      print("*** CHECKING FOR NEW DATA")
-      if os.path.exists(str(self.INPUT_PATH)):
+      # Wake up as soon as there are jobs, and take this instance's share of the jobs that are waiting so they can be run together
+      jobs = await self.job_queue.get_jobs(1)
+      jobs += self.job_queue.take_waiting_jobs(self.cluster_manager.job_allowance(self) - 1)
+      job_ids = [job.job_id for job in jobs]
+      self.cluster_manager.start_batch(self, jobs)
 
-        print("*** SENDING FLEET DATA TO SERVICE")
-        self._ctx.send_file(str(self.INPUT_PATH), str(self.FLEETS_PATH))
+      print(f"*** SENDING FLEET DATA FOR {len(jobs)} BATTLES TO SERVICE")
+      for job in jobs:
+        self._ctx.send_file(str(job.input_path), str(self.JOBS_INPUT_DIR / f"{job.job_id}.json"))
 
-        # Run a battle simulation using the fleet data
-        print("*** RUNNING SIM")
-        self._ctx.run(str(self.ENTRYPOINT_PATH))
+      # Queue the battle simulations with the worker daemon, and wait for them all to be done
+      print("*** RUNNING SIMS")
+      self._ctx.run("/bin/sh", "-c", self.submit_jobs_command(job_ids))
 
-        # The battle simulation worker outputs its results to a file, 
-        # so we need to download that file from the service provider to our local filesystem
-        print("*** SAVING RESULT")
-        self._ctx.download_file(str(self.RESULT_PATH), str(self.OUTPUT_PATH))
+      # The battle simulation worker outputs its results to files, 
+      # so we need to download those files from the service provider to our local filesystem
+      output_names = [f"{job_id}.json" for job_id in job_ids]
+      for job in jobs:
+        self._ctx.download_file(str(self.JOBS_OUTPUT_DIR / f"{job.job_id}.json"), str(job.result_path))
+        if COLLECT_METRICS:
+          self._ctx.download_file(str(self.JOBS_OUTPUT_DIR / f"{job.job_id}.metrics.json"), str(job.metrics_path))
+          output_names.append(f"{job.job_id}.metrics.json")
+      self._ctx.run("/bin/rm", "-f", *(str(self.JOBS_OUTPUT_DIR / output_name) for output_name in output_names))
 
-        # Wait for results
+      # Wait for results. If the service fails before they arrive, the jobs are put back in the queue.
+      done = False
+      try:
         future_results = yield self._ctx.commit()
-        results = await future_results
-        print(results)
-        print("*** SIMULATION COMPLETE!")
-
-        # Clean up the old processed fleet data
-        try:
-          os.remove(str(self.INPUT_PATH))
-        except:
-          print("*** FAILED TO REMOVE PROCESSED FLEET DATA")
+        await future_results
+        done = True
+      finally:
+        if not done:
+          self.cluster_manager.requeue_batch(self)
+      self.cluster_manager.finish_batch(self)
 
-      else:
-        print("*** NO FLEET DATA FOUND... WAITING...")
+      print("*** SIMULATIONS COMPLETE!")
+      for job in jobs:
+        self.job_queue.complete(job, self.provider_name)
 
-      steps = self._ctx.commit()
-      yield steps
+  def submit_jobs_command(self, job_ids):
+    """
+    A shell command that queues jobs with the worker daemon and waits until they're all done. A daemon that died would
+    leave it waiting forever, on the jobs FIFO or on the done FIFOs, so it gives up after a while and fails instead.
+    """
+    done_paths = " ".join(str(self.DONE_DIR / job_id) for job_id in job_ids)
+    return (
+      f"mkfifo {done_paths} && timeout {JOB_TIMEOUT_SEC * len(job_ids)} "
+      f"sh -c 'printf \"%s\\n\" {' '.join(job_ids)} > {self.JOBS_FIFO_PATH} && cat {done_paths}'; "
+      f"status=$?; rm -f {done_paths}; exit $status"
+    )
 
   async def shutdown(self):
     print("*** SHUTTING DOWN SERVICE")
@@ -86,13 +155,13 @@ class FleetBattleService(Service):
 
 def main():
   ''' 
-  Use Golem to get the battle result
+  Use Golem, or the local backend, to get the battle result
   '''
 
-  print('RUNNING FLEET BATTLE SIMULATION SERVICE WITH LOCAL INPUT FILE')
+  print('RUNNING FLEET BATTLE SIMULATION SERVICE WITH LOCAL INBOX DIRECTORY')
   
   loop = asyncio.get_event_loop()
-  task = loop.create_task(run_golem())
+  task = loop.create_task(run_service())
 
   # yapapi debug logging to a file
   enable_default_logger(log_file="yapapi.log")
@@ -105,23 +174,150 @@ def main():
     
     
 
-async def run_golem():
+async def run_service():
+
+  # Battles can be submitted with FleetBattleService.job_queue.submit(), or as files moved into the inbox
+  FleetBattleService.job_queue = BattleJobQueue(
+    cache=BattleCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES),
+    metrics=MetricsAggregator() if COLLECT_METRICS else None)
+  inbox_task = asyncio.get_event_loop().create_task(
+    watch_inbox(FleetBattleService.job_queue, INBOX_DIR, OUTBOX_DIR, INBOX_POLL_INTERVAL_SEC))
+
+  if BACKEND == 'local':
+    await run_local(FleetBattleService.job_queue, LocalBackend(), inbox_task)
+  elif BACKEND == 'golem':
+    # The service can't start on Golem without the worker image, so that's checked before anything is spent
+    worker_image_hash()
+    await run_golem(inbox_task)
+  else:
+    raise ValueError(f'unknown backend {BACKEND}')
+
+
+
+async def run_golem(inbox_task):
+
+  FleetBattleService.cluster_manager = ClusterManager(
+    FleetBattleService.job_queue,
+    min_instances=MIN_INSTANCES,
+    max_instances=MAX_INSTANCES,
+    jobs_per_instance=JOBS_PER_INSTANCE,
+    max_jobs_per_commit=MAX_JOBS_PER_COMMIT,
+    slow_instance_factor=SLOW_INSTANCE_FACTOR,
+    scale_down_delay_sec=SCALE_DOWN_DELAY_SEC,
+    max_batch_sec_per_job=MAX_BATCH_SEC_PER_JOB)
+
+  # Jobs that take Golem too long are run locally as well, and whichever result comes first is used
+  fallback_task = None
+  if LOCAL_FALLBACK_SEC is not None:
+    fallback_task = asyncio.get_event_loop().create_task(
+      fall_back_to_local(FleetBattleService.job_queue, LocalBackend(), LOCAL_FALLBACK_SEC))
 
   async with Golem(budget=BUDGET, subnet_tag=SUBNET) as golem:
-    cluster = await golem.run_service(FleetBattleService, num_instances=1)
+    cluster = await golem.run_service(FleetBattleService, num_instances=MIN_INSTANCES)
+    FleetBattleService.cluster_manager.manage(cluster, MIN_INSTANCES)
 
     print("*** CLUSTER IS UP!!!")
     print(cluster)
 
     # Monitor the service while it runs
+    metrics_reported = 0
     while True:
+      for task in (inbox_task, fallback_task):
+        if task and task.done():
+          task.result()
       for num, instance in enumerate(cluster.instances):
         print(f"Instance {num} is {instance.state.value} on {instance.provider_name}")
+      print(f"{FleetBattleService.job_queue.qsize()} jobs waiting")
+
+      # Replace failed or slow instances and scale the cluster to the backlog
+      FleetBattleService.cluster_manager.monitor()
+      metrics_reported = report_metrics(FleetBattleService.job_queue.metrics, metrics_reported)
       await asyncio.sleep(MONITOR_INTERVAL_SEC)
       print("...")
 
 
 
+async def run_local(job_queue, backend, inbox_task):
+
+  print(f"*** RUNNING BATTLES ON THE {backend.name.upper()} BACKEND WITH {backend.processes} PROCESSES")
+  metrics_reported = 0
+  try:
+    while True:
+      if inbox_task.done():
+        inbox_task.result()
+
+      # Wake up as soon as there are jobs, and run as many of the waiting jobs together as there are processes
+      jobs = await job_queue.get_jobs(1)
+      jobs += job_queue.take_waiting_jobs(backend.processes - 1)
+      await run_jobs(job_queue, backend, jobs)
+      metrics_reported = report_metrics(job_queue.metrics, metrics_reported)
+  finally:
+    backend.close()
+
+
+
+async def fall_back_to_local(job_queue, backend, latency_budget_sec):
+
+  # The jobs that are being run locally, so they aren't run locally twice
+  falling_back = set()
+
+  def fell_back(run, jobs):
+    falling_back.difference_update(job.job_id for job in jobs)
+    if not run.cancelled() and run.exception():
+      print(f"*** {backend.name.upper()} BACKEND FAILED: {run.exception()}")
+
+  try:
+    while True:
+      jobs = [job for job in job_queue.overdue_jobs(latency_budget_sec) if job.job_id not in falling_back]
+      if jobs:
+        print(f"*** RUNNING {len(jobs)} BATTLES ON THE {backend.name.upper()} BACKEND")
+        falling_back.update(job.job_id for job in jobs)
+
+        # The jobs may still be waiting in the queue or running on an instance, so their files are left for Golem's run
+        run = asyncio.get_event_loop().create_task(run_jobs(job_queue, backend, jobs, remove_files=False))
+        run.add_done_callback(lambda run, jobs=jobs: fell_back(run, jobs))
+
+      await asyncio.sleep(FALLBACK_CHECK_INTERVAL_SEC)
+  finally:
+    backend.close()
+
+
+
+async def run_jobs(job_queue, backend, jobs, remove_files=True):
+  ''' 
+  Run jobs on a backend, settling each job with its battle result as soon as it's done
+  '''
+
+  jobs_by_id = {}
+  battles = []
+  for job in jobs:
+    battle = job_queue.read_battle(job)
+    if battle is not None:
+      jobs_by_id[job.job_id] = job
+      battles.append(dict(battle, collectMetrics=True) if COLLECT_METRICS else battle)
+    elif remove_files:
+      job_queue.fail(job, BattleJobError(f'no fleets for challenge {job.challenge_id}'))
+
+  async for battle_results in backend.run_battles(battles):
+    for battle_result in battle_results:
+      print(f"*** {backend.name.upper()} BATTLE {'ERROR' if 'error' in battle_result else 'RESULT'} FOR {battle_result['id']}")
+      job_queue.settle(jobs_by_id[battle_result['id']], battle_result, remove_files=remove_files)
+
+
+
+def report_metrics(metrics, reported_battle_count):
+  ''' 
+  Prints and saves the metrics totals if battles were added since they were last reported, returning how many are reported
+  '''
+
+  if metrics is None or metrics.battle_count == reported_battle_count:
+    return reported_battle_count
+  metrics.print_summary()
+  metrics.save(METRICS_PATH)
+  return metrics.battle_count
+
+
+
 if __name__ == "__main__":
   main()
     
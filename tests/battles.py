@@ -0,0 +1,32 @@
+"""
+Seeded random battles for the tests
+"""
+
+import copy
+import json
+import random
+
+from fleets import TYPE_MIXES, generate_fleet
+from worker import determine_battle_result
+
+
+def random_battle(seed, grid_width=None):
+  """ Fleets of different sizes, type mixes and gaps, in grids of the same width as the baseline engine needs """
+
+  rng = random.Random(seed)
+  grid_width = grid_width or rng.randint(1, 8)
+  type_mix = rng.choice(list(TYPE_MIXES))
+  sparsity = rng.choice((0.0, 0.0, 0.2, 0.5))
+  return (
+    generate_fleet(rng.randint(1, grid_width * 6), seed * 2, type_mix, sparsity, grid_width),
+    generate_fleet(rng.randint(1, grid_width * 6), seed * 2 + 1, type_mix, sparsity, grid_width))
+
+
+def as_json(result):
+  # Waves of the baseline engine share the manifests they were built with, so results are only comparable as JSON
+  return json.loads(json.dumps(result))
+
+
+def battle_result(challenger_fleet, challengee_fleet, **kwargs):
+  """ The result of a battle as JSON, leaving the fleets as they were """
+  return as_json(determine_battle_result(copy.deepcopy(challenger_fleet), copy.deepcopy(challengee_fleet), **kwargs))
@@ -0,0 +1,8 @@
+import sys
+
+from pathlib import Path
+
+# The worker modules import each other by name, as they do in the worker image, and the synthetic fleets come from the benchmarks
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR / "benchmark"))
+sys.path.insert(0, str(ROOT_DIR / "worker"))
@@ -0,0 +1,85 @@
+"""
+Battles between seeded random fleets, checked against the battle engine as it was before it was rewritten (see
+baseline_engine.py), in every mode of the current engine, and the row kernel checked against battling one ship at a time.
+"""
+
+import copy
+
+import pytest
+
+import baseline_engine
+
+from battles import as_json, battle_result, random_battle
+from kernel import KERNEL_MIN_ROW_WIDTH, is_kernel_available
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, iter_decoded_waves
+
+SEEDS = range(40)
+KERNEL_SEEDS = range(6)
+
+
+def baseline_result(challenger_fleet, challengee_fleet):
+  return as_json(baseline_engine.determine_battle_result(copy.deepcopy(challenger_fleet), copy.deepcopy(challengee_fleet)))
+
+
+def without_unit_state(fleets):
+  return {
+    view: dict(fleet, manifest={
+      unit_id: {key: value for key, value in unit.items() if key not in ('health', 'skip')}
+      for unit_id, unit in fleet['manifest'].items()
+    })
+    for view, fleet in fleets.items()
+  }
+
+
+def assert_same_battle(result, expected):
+  """ Checks a result of either wave format has the same battle as a snapshot result """
+
+  assert {key: value for key, value in result.items() if key not in ('waveFormat', 'initial', 'waves')} == \
+    {key: value for key, value in expected.items() if key not in ('initial', 'waves')}
+
+  # The initial fleets of delta results also have the health and skip every unit starts with
+  if result['waveFormat'] == WAVE_FORMAT_DELTA:
+    assert without_unit_state(result['initial']) == expected['initial']
+  else:
+    assert result['initial'] == expected['initial']
+
+  for view in ('challenger', 'challengee'):
+    if result['waveFormat'] != WAVE_FORMAT_DELTA:
+      assert result['waves'][view] == expected['waves'][view]
+      continue
+
+    # Every wave of a snapshot result has the manifests as they are at the end of its view, where decoded delta waves
+    # have them as they are after the wave, so they only have to match for the last wave
+    waves = list(iter_decoded_waves(result, view))
+    assert [without_manifests(wave) for wave in waves] == [without_manifests(wave) for wave in expected['waves'][view]]
+    if waves:
+      assert waves[-1] == expected['waves'][view][-1]
+
+
+def without_manifests(wave):
+  return dict(wave, attackerFleet=wave['attackerFleet']['formation'], defenderFleet=wave['defenderFleet']['formation'])
+
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('wave_format', (WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA))
+@pytest.mark.parametrize('shared_pass', (True, False))
+@pytest.mark.parametrize('vectorized', (True, False))
+def test_battles_match_baseline_engine(seed, wave_format, shared_pass, vectorized):
+  challenger_fleet, challengee_fleet = random_battle(seed)
+  result = battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format, shared_pass=shared_pass, vectorized=vectorized)
+  assert result['waveFormat'] == wave_format
+  assert_same_battle(result, baseline_result(challenger_fleet, challengee_fleet))
+
+
+@pytest.mark.skipif(not is_kernel_available(), reason='the row kernel needs NumPy')
+@pytest.mark.parametrize('seed', KERNEL_SEEDS)
+@pytest.mark.parametrize('wave_format', (WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA))
+@pytest.mark.parametrize('shared_pass', (True, False))
+def test_row_kernel_matches_single_ships(seed, wave_format, shared_pass):
+  challenger_fleet, challengee_fleet = random_battle(seed, grid_width=KERNEL_MIN_ROW_WIDTH + seed)
+  vectorized_result = battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format, shared_pass=shared_pass, vectorized=True)
+  single_ship_result = battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format, shared_pass=shared_pass, vectorized=False)
+  assert vectorized_result == single_ship_result
+  if wave_format == WAVE_FORMAT_SNAPSHOT and seed < 2:
+    assert_same_battle(vectorized_result, baseline_result(challenger_fleet, challengee_fleet))
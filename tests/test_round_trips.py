@@ -0,0 +1,70 @@
+"""
+Battle results read back from each of the forms they're written in: delta waves decoded as snapshots, results in every
+result encoding, whole or streamed, and waves rebuilt from replays.
+"""
+
+import io
+
+import pytest
+
+from battles import battle_result, random_battle
+from replay import Replay, build_replay
+from result_encoding import decode_result, encode_result, supported_result_encodings
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, decode_wave, iter_decoded_waves
+from worker import write_encoded_battle_result
+
+SEEDS = range(12)
+WAVE_FORMATS = (WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA)
+VIEWS = ('challenger', 'challengee')
+
+
+def formations(wave):
+  return wave['attackerRow'], wave['attackerFleet']['formation'], wave['defenderFleet']['formation'], wave['interactions']
+
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_decoded_delta_waves_match_snapshot_waves(seed):
+  challenger_fleet, challengee_fleet = random_battle(seed)
+  snapshot_result = battle_result(challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT)
+  delta_result = battle_result(challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_DELTA)
+
+  for view in VIEWS:
+    decoded_waves = list(iter_decoded_waves(delta_result, view))
+    assert [decode_wave(delta_result, view, wave_idx) for wave_idx in range(len(decoded_waves))] == decoded_waves
+    assert [formations(wave) for wave in decoded_waves] == [formations(wave) for wave in snapshot_result['waves'][view]]
+    if decoded_waves:
+      assert decoded_waves[-1] == snapshot_result['waves'][view][-1]
+
+    with pytest.raises(IndexError):
+      decode_wave(delta_result, view, len(decoded_waves))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('wave_format', WAVE_FORMATS)
+@pytest.mark.parametrize('result_encoding', supported_result_encodings())
+def test_encoded_results_decode_to_the_result(seed, wave_format, result_encoding):
+  challenger_fleet, challengee_fleet = random_battle(seed)
+  result = battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format)
+  assert decode_result(encode_result(result, result_encoding)) == result
+
+  result_file = io.BytesIO()
+  write_encoded_battle_result(result_file, challenger_fleet, challengee_fleet, result_encoding, wave_format=wave_format)
+  assert decode_result(result_file.getvalue()) == result
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('wave_format', WAVE_FORMATS)
+@pytest.mark.parametrize('keyframe_interval', (1, 3))
+def test_replay_waves_match_the_result(seed, wave_format, keyframe_interval):
+  challenger_fleet, challengee_fleet = random_battle(seed)
+  result = battle_result(challenger_fleet, challengee_fleet, wave_format=wave_format)
+  replay = Replay(io.BytesIO(build_replay(result, keyframe_interval)))
+
+  assert replay.wave_format == wave_format
+  assert (replay.initial, replay.final, replay.score, replay.winner) == (result['initial'], result['final'], result['score'], result['winner'])
+  for view in VIEWS:
+    waves = list(iter_decoded_waves(result, view)) if wave_format == WAVE_FORMAT_DELTA else result['waves'][view]
+    assert replay.wave_count(view) == len(waves)
+    assert [replay.get_wave(view, wave_idx) for wave_idx in reversed(range(len(waves)))] == waves[::-1]
+    assert list(replay.iter_waves(view, 1)) == waves[1:]
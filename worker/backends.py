@@ -0,0 +1,181 @@
+"""
+Execution backends that requestors run battles on. A backend takes a list of battles, each with an 'id', the 'challenger'
+and 'challengee' fleets and optionally a 'waveFormat' and the 'terms' of its challenge, like the lines of a batch for the
+worker. It yields lists of battle results as they're done, each holding the 'id' of a battle with either its 'result' or
+its 'error', like the lines of the worker's batch results. Battles that ask for them with 'collectMetrics' also get their
+'metrics' (see metrics.py), with the 'provider' that ran them.
+
+Each requestor has its own backend for Golem. The backends here run battles on the requestor's own machine, or fall back
+to doing so when another backend is too slow, and get_backend() picks between them as configured.
+"""
+
+import os
+import asyncio
+
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import PHASE_VALIDATE, BattleMetrics, timed
+from waves import WAVE_FORMAT_SNAPSHOT
+from validation import normalize_battle
+from worker import available_cpu_count, build_battle_error, determine_battle_result
+
+# Where requestors run battles: 'golem', or 'local' to run them in a process pool on this machine.
+# Battles that Golem hasn't returned within the latency budget are run locally too, unless the budget is None.
+BACKEND = os.environ.get('BACKEND', 'golem')
+LOCAL_FALLBACK_SEC = 300
+
+# The hash of the worker image providers run battles in. The image has to be built from this version of the worker code
+# and deployed to the Yagna repository (see the README), so there's no default.
+WORKER_IMAGE_HASH = os.environ.get('WORKER_IMAGE_HASH')
+
+
+def run_battle(battle):
+  """
+  Determines the result of a battle, returning a battle result with either the result or the error, and the metrics of
+  the battle if it asks for them with 'collectMetrics'
+  """
+
+  metrics = BattleMetrics() if battle.get('collectMetrics') else None
+  try:
+    with timed(metrics, PHASE_VALIDATE):
+      battle = normalize_battle(battle)
+    result = determine_battle_result(
+      battle.get('challenger'),
+      battle.get('challengee'),
+      wave_format=battle.get('waveFormat', WAVE_FORMAT_SNAPSHOT),
+      metrics=metrics)
+    battle_result = {'id': battle.get('id'), 'result': result}
+  except Exception as e:
+    battle_result = build_battle_error(battle.get('id'), e)
+
+  # Battles run here were run by this machine, rather than by a provider
+  if metrics is not None:
+    battle_result['metrics'] = dict(metrics.to_dict(), provider=LocalBackend.name)
+  return battle_result
+
+
+
+class LocalBackend:
+  """ Runs battles in a pool of processes on this machine, without Golem """
+
+  name = 'local'
+
+  def __init__(self, processes=None):
+    self.processes = processes or available_cpu_count()
+    self._pool = None
+
+  async def run_battles(self, battles):
+    # The pool is started on first use and kept for later battles, so they don't pay for starting processes
+    if self._pool is None:
+      self._pool = ProcessPoolExecutor(max_workers=self.processes)
+
+    loop = asyncio.get_event_loop()
+    futures = [loop.run_in_executor(self._pool, run_battle, battle) for battle in battles]
+    try:
+      pending = set(futures)
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        yield [future.result() for future in done]
+    finally:
+      for future in futures:
+        future.cancel()
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.shutdown()
+      self._pool = None
+
+
+
+class FallbackBackend:
+  """
+  Runs battles on a primary backend, and runs any that don't have a result within a latency budget on a fallback backend
+  too, along with any the primary backend finishes without. Each battle's first result is used.
+  """
+
+  def __init__(self, primary, fallback, latency_budget_sec):
+    self.primary = primary
+    self.fallback = fallback
+    self.latency_budget_sec = latency_budget_sec
+    self.name = f'{primary.name} with {fallback.name} fallback'
+
+  async def run_battles(self, battles):
+
+    pending = {battle.get('id'): battle for battle in battles}
+    battle_results = asyncio.Queue()
+
+    async def run_on(backend, backend_battles):
+      backend_results = backend.run_battles(backend_battles)
+      try:
+        async for backend_battle_results in backend_results:
+          battle_results.put_nowait(backend_battle_results)
+      except Exception as e:
+        print(f'*** {backend.name.upper()} BACKEND FAILED: {e}')
+      finally:
+        await backend_results.aclose()
+        # The backend itself is queued to say it's done
+        battle_results.put_nowait(backend)
+
+    loop = asyncio.get_event_loop()
+    runs = [loop.create_task(run_on(self.primary, battles))]
+    running = {self.primary}
+    deadline = loop.time() + self.latency_budget_sec
+
+    try:
+      while pending and running:
+
+        # Wait for the next results, or for the budget to run out
+        timeout = max(0, deadline - loop.time()) if self.fallback not in running else None
+        try:
+          backend_battle_results = await asyncio.wait_for(battle_results.get(), timeout)
+        except asyncio.TimeoutError:
+          backend_battle_results = None
+
+        if backend_battle_results in (self.primary, self.fallback):
+          running.discard(backend_battle_results)
+
+        elif backend_battle_results is not None:
+          new_battle_results = [battle_result for battle_result in backend_battle_results if battle_result.get('id') in pending]
+          for battle_result in new_battle_results:
+            del pending[battle_result.get('id')]
+          if new_battle_results:
+            yield new_battle_results
+
+        # Battles without a result once the budget runs out, or once the primary backend is done, are run on the fallback
+        out_of_time = backend_battle_results is None or self.primary not in running
+        if out_of_time and pending and self.fallback not in running and len(runs) == 1:
+          print(f'*** RUNNING {len(pending)} BATTLES ON THE {self.fallback.name.upper()} BACKEND')
+          running.add(self.fallback)
+          runs.append(loop.create_task(run_on(self.fallback, list(pending.values()))))
+
+    # Once every battle has a result, the backends still running are stopped
+    finally:
+      for run in runs:
+        run.cancel()
+      await asyncio.gather(*runs, return_exceptions=True)
+
+
+
+def worker_image_hash():
+  """ The hash of the worker image, which has to be set for providers to run battles """
+
+  if not WORKER_IMAGE_HASH:
+    raise ValueError('WORKER_IMAGE_HASH is not set: build and deploy the worker image and set it to its hash, or set BACKEND to local')
+  return WORKER_IMAGE_HASH
+
+
+
+def get_backend(golem_backend_factory):
+  """
+  The backend to run battles on, as configured. Requestors run battles on Golem in their own ways, so the Golem backend
+  is made by calling golem_backend_factory, once the worker image it needs is known to be set.
+  """
+
+  if BACKEND == 'local':
+    return LocalBackend()
+  if BACKEND != 'golem':
+    raise ValueError(f'unknown backend {BACKEND}')
+  worker_image_hash()
+  if LOCAL_FALLBACK_SEC is None:
+    return golem_backend_factory()
+  return FallbackBackend(golem_backend_factory(), LocalBackend(), LOCAL_FALLBACK_SEC)
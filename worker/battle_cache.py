@@ -0,0 +1,216 @@
+"""
+A cache of battle results, keyed by the content of the battle. Battles are deterministic, so a battle between the same
+fleets, with the same unit type specs, always has the same result, even when the units of the fleets have other ids.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from pathlib import Path
+from collections import OrderedDict
+
+from constants import UNIT_TYPE_SPECS
+from fleet_arrays import ARRAY_PROPERTIES, EMPTY_SLOT, NO_TYPE, fleet_to_arrays
+from rules import COMPILED_UNIT_SPECS
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, OPPOSING_VIEW
+
+# Changes to the unit type specs change the results of battles, so results from other specs are never used
+SPEC_VERSION = hashlib.sha256(json.dumps(UNIT_TYPE_SPECS, sort_keys=True).encode()).hexdigest()[:16]
+
+# Bump when the engine changes the results of battles without the specs changing
+ENGINE_VERSION = 1
+
+
+def battle_key(challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT):
+  """
+  Returns the cache key of a battle, and the unit ids of each fleet in the order the key numbers them.
+  The key is a hash of both fleets with their units numbered by where they are in the formation, so fleets that only
+  differ in the ids of their units have the same key.
+  """
+
+  challenger_form, challenger_ids = canonical_fleet(challenger_fleet)
+  challengee_form, challengee_ids = canonical_fleet(challengee_fleet)
+  content = json.dumps([SPEC_VERSION, ENGINE_VERSION, wave_format, challenger_form, challengee_form], sort_keys=True, separators=(',', ':'))
+
+  return hashlib.sha256(content.encode()).hexdigest(), {'challenger': challenger_ids, 'challengee': challengee_ids}
+
+
+
+def canonical_fleet(fleet):
+  """
+  Returns a fleet with its units numbered in the order they are found in its formation, and the unit ids in that order.
+  Units that are only in the manifest come last, ordered by their properties. Consumable properties are left out,
+  as battles start with their initial values.
+  """
+
+  fleet_arrays = fleet_to_arrays(fleet.get('formation'), fleet.get('manifest'), reset_consumables=True)
+
+  def unit_properties(unit):
+    properties = fleet_arrays.extra_properties.get(unit, {})
+    type_name = COMPILED_UNIT_SPECS.type_names[fleet_arrays.types[unit]] if fleet_arrays.types[unit] != NO_TYPE else None
+    return [type_name, {name: value for name, value in properties.items() if name not in ARRAY_PROPERTIES}]
+
+  order = list(OrderedDict.fromkeys(unit for row in fleet_arrays.grid for unit in row if unit != EMPTY_SLOT))
+  in_formation = set(order)
+  order += sorted(
+    (unit for unit in range(len(fleet_arrays.unit_ids)) if unit not in in_formation),
+    key=lambda unit: json.dumps(unit_properties(unit), sort_keys=True))
+  numbers = {unit: number for number, unit in enumerate(order)}
+
+  return (
+    {
+      'grid': [[None if unit == EMPTY_SLOT else numbers[unit] for unit in row] for row in fleet_arrays.grid],
+      'units': [unit_properties(unit) for unit in order]
+    },
+    [fleet_arrays.unit_ids[unit] for unit in order]
+  )
+
+
+
+def relabel_result(result, unit_id_maps):
+  """ Returns a battle result with the ids of the units of each fleet replaced, using a map of old to new ids for each fleet """
+
+  def relabel(unit_id, side):
+    return unit_id_maps[side].get(unit_id, unit_id)
+
+  def relabel_fleet(fleet, side):
+    return {
+      'formation': [[None if unit_id is None else relabel(unit_id, side) for unit_id in row] for row in fleet['formation']],
+      'manifest': {relabel(unit_id, side): unit for unit_id, unit in fleet['manifest'].items()}
+    }
+
+  def relabel_wave_fleet(wave_fleet, side):
+    if result['waveFormat'] == WAVE_FORMAT_DELTA:
+      return {
+        'health': {relabel(unit_id, side): health for unit_id, health in wave_fleet['health'].items()},
+        'skip': {relabel(unit_id, side): skip for unit_id, skip in wave_fleet['skip'].items()},
+        'removed': wave_fleet['removed']
+      }
+    return relabel_fleet(wave_fleet, side)
+
+  def relabel_wave(wave, attacking_side):
+    defending_side = OPPOSING_VIEW[attacking_side]
+    return {
+      'attackerRow': wave['attackerRow'],
+      'attackerFleet': relabel_wave_fleet(wave['attackerFleet'], attacking_side),
+      'defenderFleet': relabel_wave_fleet(wave['defenderFleet'], defending_side),
+      'interactions': [
+        {
+          'attackerUnit': relabel(interaction['attackerUnit'], attacking_side),
+          'defenderUnit': relabel(interaction['defenderUnit'], defending_side),
+          'killed': interaction['killed']
+        }
+        for interaction in wave['interactions']
+      ]
+    }
+
+  relabeled = dict(result)
+  relabeled['initial'] = {side: relabel_fleet(fleet, side) for side, fleet in result['initial'].items()}
+  relabeled['final'] = {side: relabel_fleet(fleet, side) for side, fleet in result['final'].items()}
+  relabeled['waves'] = {side: [relabel_wave(wave, side) for wave in waves] for side, waves in result['waves'].items()}
+  return relabeled
+
+
+
+class BattleCache:
+  """
+  Battle results saved to files in a directory, keyed by battle_key(). The least recently used results are removed
+  once the cache holds more than its maximum number of results or bytes. It can be used from several threads.
+  """
+
+  def __init__(self, cache_dir, max_bytes=1024 ** 3, max_entries=100000):
+    self.cache_dir = Path(cache_dir)
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+
+    # The size of every cached result, least recently used first
+    self.entries = OrderedDict()
+    paths = sorted(self.cache_dir.glob('*.json'), key=lambda path: path.stat().st_mtime)
+    for path in paths:
+      self.entries[path.stem] = path.stat().st_size
+    self.total_bytes = sum(self.entries.values())
+
+  def get(self, challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT):
+    """ Returns the cached result of a battle, or None if it isn't cached """
+
+    try:
+      key, unit_ids = battle_key(challenger_fleet, challengee_fleet, wave_format)
+    # Fleets that can't battle are left for the worker to report
+    except (KeyError, TypeError, ValueError, AttributeError):
+      return None
+
+    # Results cached by other processes sharing the directory are found too
+    path = self.path(key)
+    try:
+      with path.open() as f:
+        entry = json.load(f)
+      os.utime(str(path))
+    except (OSError, ValueError) as e:
+      with self.lock:
+        self.forget(key, remove_file=not isinstance(e, FileNotFoundError))
+      return None
+
+    with self.lock:
+      if key not in self.entries:
+        self.entries[key] = path.stat().st_size
+        self.total_bytes += self.entries[key]
+      self.entries.move_to_end(key)
+
+    # The cached result has the unit ids of the battle it came from
+    unit_id_maps = {
+      side: {cached_id: unit_id for cached_id, unit_id in zip(entry['unitIds'][side], unit_ids[side]) if cached_id != unit_id}
+      for side in unit_ids
+    }
+    result = entry['result']
+    if any(unit_id_maps.values()):
+      result = relabel_result(result, unit_id_maps)
+
+    # Snapshot results start with the fleets exactly as they were sent
+    if wave_format == WAVE_FORMAT_SNAPSHOT:
+      result['initial'] = {
+        'challenger': json.loads(json.dumps(challenger_fleet)),
+        'challengee': json.loads(json.dumps(challengee_fleet))
+      }
+
+    return result
+
+  def put(self, challenger_fleet, challengee_fleet, wave_format, result):
+    """ Caches the result of a battle """
+
+    try:
+      key, unit_ids = battle_key(challenger_fleet, challengee_fleet, wave_format)
+    except (KeyError, TypeError, ValueError, AttributeError):
+      return
+
+    # Results are written to a temporary file first, so a partly written result is never read
+    path = self.path(key)
+    temp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    with temp_path.open('w') as f:
+      json.dump({'unitIds': unit_ids, 'result': result}, f, separators=(',', ':'))
+    os.replace(str(temp_path), str(path))
+
+    with self.lock:
+      self.forget(key, remove_file=False)
+      self.entries[key] = path.stat().st_size
+      self.total_bytes += self.entries[key]
+
+      # Remove the least recently used results until the cache is within its limits
+      while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+        self.forget(next(iter(self.entries)))
+
+  def forget(self, key, remove_file=True):
+    """ Removes a result from the index, and its file. Called with the lock held. """
+    if key in self.entries:
+      self.total_bytes -= self.entries.pop(key)
+    if remove_file:
+      try:
+        self.path(key).unlink()
+      except OSError:
+        pass
+
+  def path(self, key):
+    return self.cache_dir / f'{key}.json'
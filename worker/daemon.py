@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+A long lived worker for the Service model. It's started once, keeps everything the battle engine needs in memory,
+and then takes battle jobs through a FIFO so battles don't pay for starting Python and importing the engine.
+
+A job is a fleets file sent to JOBS_INPUT_DIR as '<job id>.json'. Writing the job id as a line to JOBS_FIFO_PATH
+queues it, and the daemon saves the result to JOBS_OUTPUT_DIR as '<job id>.json'. Once the result is saved, the daemon
+writes 'ok' or 'error' to the FIFO at DONE_DIR/<job id>, if the submitter made one, so it can wait without polling:
+
+  mkfifo /golem/work/done/<job id> && echo <job id> > /golem/work/jobs.fifo && cat /golem/work/done/<job id>
+
+Results are JSON, unless the daemon is started with the result encodings the submitter accepts (see result_encoding.py),
+in which case they're in the first of those it can write. Errors are always JSON. Started with --metrics, the daemon
+also saves the metrics of every job (see metrics.py) to JOBS_OUTPUT_DIR as '<job id>.metrics.json', whether it failed
+or not.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import argparse
+import subprocess
+
+from pathlib import Path
+
+from metrics import PHASE_LOAD, PHASE_VALIDATE, BattleMetrics, timed
+from result_encoding import RESULT_ENCODING_JSON, choose_result_encoding
+from waves import WAVE_FORMAT_SNAPSHOT
+from validation import normalize_battle
+from worker import ENCODING, available_cpu_count, build_battle_error, write_encoded_battle_result
+
+JOBS_INPUT_DIR = Path("/golem/input/jobs")
+JOBS_OUTPUT_DIR = Path("/golem/output/jobs")
+
+# FIFOs can't be made on the input and output volumes, so they are kept in the VM's own filesystem
+WORK_DIR = Path("/golem/work")
+JOBS_FIFO_PATH = WORK_DIR / "jobs.fifo"
+DONE_DIR = WORK_DIR / "done"
+PID_PATH = WORK_DIR / "daemon.pid"
+LOG_PATH = WORK_DIR / "daemon.log"
+
+# How long to wait for the daemon to be ready when starting it, and for a submitter to wait for its job
+START_TIMEOUT_SEC = 30
+DONE_TIMEOUT_SEC = 10
+
+
+def start_daemon():
+  """ Starts the daemon in the background, if it isn't running already, and returns once it's ready for jobs """
+
+  if is_daemon_running():
+    print('DAEMON ALREADY RUNNING')
+    return
+
+  WORK_DIR.mkdir(parents=True, exist_ok=True)
+  if PID_PATH.exists():
+    PID_PATH.unlink()
+
+  with LOG_PATH.open(mode="a", encoding=ENCODING) as log_file:
+    daemon = subprocess.Popen(
+      [sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+      stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+  # The daemon saves its pid once it's listening for jobs
+  deadline = time.monotonic() + START_TIMEOUT_SEC
+  while not PID_PATH.exists():
+    if daemon.poll() is not None:
+      raise RuntimeError(f'daemon exited with {daemon.returncode}, see {LOG_PATH}')
+    if time.monotonic() > deadline:
+      raise TimeoutError(f'daemon was not ready after {START_TIMEOUT_SEC} seconds')
+    time.sleep(0.01)
+
+  print(f'DAEMON STARTED WITH PID {daemon.pid}')
+
+
+
+def is_daemon_running():
+  """ Checks if a daemon has saved its pid and is still running """
+  try:
+    os.kill(int(PID_PATH.read_text()), 0)
+  except (OSError, ValueError):
+    return False
+  return True
+
+
+
+def serve(processes=1, result_encoding=RESULT_ENCODING_JSON, collect_metrics=False):
+  """ Processes jobs as their ids are written to the jobs FIFO, forever """
+
+  for job_dir in (JOBS_INPUT_DIR, JOBS_OUTPUT_DIR, DONE_DIR):
+    job_dir.mkdir(parents=True, exist_ok=True)
+  if not JOBS_FIFO_PATH.exists():
+    os.mkfifo(str(JOBS_FIFO_PATH))
+
+  # Opening the FIFO for writing too means reads never reach the end of the file between submitters
+  jobs_fifo = os.fdopen(os.open(str(JOBS_FIFO_PATH), os.O_RDWR), encoding=ENCODING)
+  PID_PATH.write_text(str(os.getpid()))
+  print(f'DAEMON READY FOR JOBS AT {JOBS_FIFO_PATH}, WRITING {result_encoding.upper()} RESULTS', flush=True)
+
+  for line in jobs_fifo:
+    job_id = line.strip()
+    if job_id:
+      status = process_job(job_id, processes, result_encoding, collect_metrics)
+      signal_job_done(job_id, status)
+
+
+
+def process_job(job_id, processes=1, result_encoding=RESULT_ENCODING_JSON, collect_metrics=False):
+  """ Determines the result of the battle in a job and saves it, along with its metrics if they're collected, returning the status of the job """
+
+  input_path = JOBS_INPUT_DIR / f'{job_id}.json'
+  output_path = JOBS_OUTPUT_DIR / f'{job_id}.json'
+  metrics = BattleMetrics() if collect_metrics else None
+
+  try:
+    with timed(metrics, PHASE_LOAD), input_path.open(encoding=ENCODING) as f:
+      fleets = json.load(f)
+    with timed(metrics, PHASE_VALIDATE):
+      fleets = normalize_battle(fleets)
+
+    with output_path.open(mode="wb") as f:
+      write_encoded_battle_result(
+        f,
+        challenger_fleet=fleets.get('challenger'),
+        challengee_fleet=fleets.get('challengee'),
+        result_encoding=result_encoding,
+        wave_format=fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT),
+        processes=processes,
+        metrics=metrics)
+
+    status = 'ok'
+
+  # A failed job still gets a result, so the submitter always has something to download
+  except Exception as e:
+    print(f'JOB {job_id} FAILED: {type(e).__name__}: {e}', flush=True)
+    save_job_output(job_id, output_path, build_battle_error(job_id, e))
+    status = 'error'
+
+  if metrics is not None:
+    save_job_output(job_id, JOBS_OUTPUT_DIR / f'{job_id}.metrics.json', metrics.to_dict())
+
+  if input_path.exists():
+    input_path.unlink()
+
+  return status
+
+
+
+def save_job_output(job_id, path, output):
+  """ Saves the error or metrics of a job. A job whose output can't be saved is left without it, rather than stopping the daemon. """
+  try:
+    with path.open(mode="w", encoding=ENCODING) as f:
+      json.dump(output, f)
+  except OSError as e:
+    print(f'JOB {job_id} OUTPUT NOT SAVED TO {path}: {e}', flush=True)
+
+
+
+def signal_job_done(job_id, status):
+  """ Writes the status of a job to its done FIFO, if the submitter is waiting on one """
+
+  done_path = DONE_DIR / job_id
+  if not done_path.exists():
+    return
+
+  # The submitter opens the FIFO right after queueing the job. If it never does, the daemon gives up on it.
+  deadline = time.monotonic() + DONE_TIMEOUT_SEC
+  while True:
+    try:
+      done_fd = os.open(str(done_path), os.O_WRONLY | os.O_NONBLOCK)
+      break
+    except OSError as e:
+      if e.errno != errno.ENXIO or time.monotonic() > deadline:
+        print(f'JOB {job_id} HAS NO SUBMITTER WAITING', flush=True)
+        return
+      time.sleep(0.001)
+
+  # The submitter may have given up waiting and gone in the meantime
+  try:
+    os.write(done_fd, f'{status}\n'.encode(ENCODING))
+  except OSError as e:
+    print(f'JOB {job_id} SUBMITTER WENT AWAY: {e}', flush=True)
+  finally:
+    os.close(done_fd)
+
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='A long lived worker that takes battle jobs through a FIFO')
+  parser.add_argument('--start', action='store_true', help='start the daemon in the background and return once it is ready')
+  parser.add_argument('--processes', type=int, default=available_cpu_count(), help='the number of processes a large battle is spread across (default: the number of cores)')
+  parser.add_argument('--result-encodings', default=RESULT_ENCODING_JSON, help='the result encodings the submitter accepts, most preferred first, separated by commas (default: json)')
+  parser.add_argument('--metrics', action='store_true', help='save the metrics of every job alongside its result')
+  args = parser.parse_args()
+
+  if args.start:
+    sys.argv.remove('--start')
+    start_daemon()
+  else:
+    serve(processes=args.processes, result_encoding=choose_result_encoding(args.result_encodings.split(',')), collect_metrics=args.metrics)
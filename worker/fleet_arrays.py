@@ -0,0 +1,133 @@
+"""
+Array backed fleets used by the battle engine, and converters to and from the JSON fleet format
+"""
+
+from array import array
+from typing import NamedTuple
+
+from rules import COMPILED_UNIT_SPECS
+
+# Grid value of an empty slot in a formation
+EMPTY_SLOT = -1
+
+# Type code of units in a formation that are missing from the manifest. They stay in the formation but never battle.
+NO_TYPE = -1
+
+# The manifest properties stored in arrays. Any other properties of a unit are kept as they are.
+ARRAY_PROPERTIES = ('type', 'health', 'skip')
+
+
+class FleetArrays(NamedTuple):
+  """ A fleet with its units stored in arrays and referred to by index """
+  unit_ids: list
+  types: array
+  health: array
+  skip: array
+  grid: list  # A row of unit indices (or EMPTY_SLOT) for each row in the formation
+  extra_properties: dict  # Original unit dicts of units with properties that aren't stored in arrays
+
+  def copy(self):
+    """ Returns a copy of the fleet which can battle without changing this one """
+    return FleetArrays(
+      unit_ids=self.unit_ids,
+      types=self.types,
+      health=array(self.health.typecode, self.health),
+      skip=array(self.skip.typecode, self.skip),
+      grid=[array(row.typecode, row) for row in self.grid],
+      extra_properties=self.extra_properties
+    )
+
+  def is_unit(self, unit):
+    """ Checks if a grid value refers to a unit that can battle """
+    return unit != EMPTY_SLOT and self.types[unit] != NO_TYPE
+
+  def has_unique_units(self):
+    """ Checks that no unit is in more than one slot of the formation """
+    units = [unit for row in self.grid for unit in row if unit != EMPTY_SLOT]
+    return len(units) == len(set(units))
+
+  def count_row_units(self):
+    """ Counts the units that can battle in each row of the formation """
+    return [sum(1 for unit in row if self.is_unit(unit)) for row in self.grid]
+
+  def to_formation(self):
+    """ Converts the grid to a JSON formation of unit ids """
+    unit_ids = self.unit_ids
+    return [[None if unit == EMPTY_SLOT else unit_ids[unit] for unit in row] for row in self.grid]
+
+  def to_manifest(self):
+    """ Converts the unit arrays to a JSON manifest, keyed by unit id """
+    return {
+      self.unit_ids[unit]: self.to_unit(unit)
+      for unit in range(len(self.unit_ids))
+      if self.types[unit] != NO_TYPE
+    }
+
+  def to_unit(self, unit):
+    """ Converts a single unit to a JSON manifest entry """
+    if unit in self.extra_properties:
+      unit_data = dict(self.extra_properties[unit])
+    else:
+      unit_data = {'type': COMPILED_UNIT_SPECS.type_names[self.types[unit]]}
+    unit_data['health'] = self.health[unit]
+    unit_data['skip'] = self.skip[unit]
+    return unit_data
+
+  def to_fleet(self):
+    """ Converts the fleet to the JSON fleet format """
+    return {
+      'formation': self.to_formation(),
+      'manifest': self.to_manifest()
+    }
+
+
+def fleet_to_arrays(formation, manifest, reset_consumables=False):
+  """ Converts a fleet in the JSON fleet format to arrays. Units without consumable properties get their initial values. """
+
+  unit_ids = []
+  unit_indices = {}
+  types = array('b')
+  health = array('q')
+  skip = array('i')
+  extra_properties = {}
+
+  # Add every unit in the manifest
+  for unit_id, unit_data in manifest.items():
+    unit_code = COMPILED_UNIT_SPECS.type_codes[unit_data['type']]
+    unit_indices[unit_id] = len(unit_ids)
+    if any(unit_property not in ARRAY_PROPERTIES for unit_property in unit_data):
+      extra_properties[len(unit_ids)] = unit_data
+    unit_ids.append(unit_id)
+    types.append(unit_code)
+    if reset_consumables:
+      health.append(COMPILED_UNIT_SPECS.health[unit_code])
+      skip.append(COMPILED_UNIT_SPECS.skip[unit_code])
+    else:
+      health.append(unit_data.get('health') or COMPILED_UNIT_SPECS.health[unit_code])
+      skip.append(unit_data.get('skip', COMPILED_UNIT_SPECS.skip[unit_code]))
+
+  # Build the grid, adding units that are in the formation but missing from the manifest
+  grid = []
+  for row in formation:
+    grid_row = array('i')
+    for unit_id in row:
+      if unit_id is None:
+        grid_row.append(EMPTY_SLOT)
+        continue
+      if unit_id not in unit_indices:
+        unit_indices[unit_id] = len(unit_ids)
+        unit_ids.append(unit_id)
+        types.append(NO_TYPE)
+        health.append(0)
+        skip.append(0)
+      grid_row.append(unit_indices[unit_id])
+    grid.append(grid_row)
+
+  return FleetArrays(
+    unit_ids=unit_ids,
+    types=types,
+    health=health,
+    skip=skip,
+    grid=grid,
+    extra_properties=extra_properties
+  )
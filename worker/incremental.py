@@ -0,0 +1,482 @@
+"""
+Incremental re-simulation of battles whose fleets change, such as when a player adjusts their formation and previews
+the battle again. Attacking row i only depends on the state left behind by the waves of rows 0..i-1, so the state of a
+battle is checkpointed after every wave, and a change only re-simulates the waves from the first one it can affect.
+"""
+
+import copy
+import math
+
+from array import array
+
+from fleet_arrays import EMPTY_SLOT
+from kernel import RowCollisions
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, OPPOSING_VIEW
+from validation import normalize_fleets
+from worker import (
+  battle_fleets_to_arrays, build_battle_summary, can_share_battle_pass, process_fleet_arrays_action, replay_fleet_arrays_action)
+
+# The first changed row of a fleet that didn't change
+UNCHANGED = math.inf
+
+# Unit properties that battles start from their initial values, so changing them doesn't change the battle
+CONSUMABLE_PROPERTIES = ('health', 'skip')
+
+# Who was killed in a logged collision, as seen from the opposing view
+SWAPPED_KILLED = {None: None, 'attacker': 'defender', 'defender': 'attacker', 'both': 'both'}
+
+
+class IncrementalBattle:
+  """
+  A battle between two fleets that can be run again after either fleet changes, re-simulating as little as possible.
+  Waves before the first changed row of the attacking fleet are reused, as are waves whose attacking row ran out of units
+  before reaching the first changed row of the defending fleet.
+
+  When the fleets allow a shared pass, the view that can be resumed from the later wave is processed, logging its
+  collisions, and the opposing view is replayed from them. The replayed view is checkpointed too, and resumed from its
+  own first affected wave, since the log still holds the collisions of the waves that weren't processed again. Changing
+  a back row of a fleet re-simulates the last few waves of its view, but the opposing view from its first wave that
+  reached that row, which in most battles is one of the first. Otherwise each view is resumed on its own. Results are
+  the same as from determine_battle_result.
+  """
+
+  def __init__(self, challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT, shared_pass=True, vectorized=True):
+    self.wave_format = wave_format
+    self.shared_pass = shared_pass
+    self.vectorized = vectorized
+    self.fleets = None
+    self.checkpoints = {}
+    self.waves = {}
+    # The view that was processed in the last shared pass, which is the one whose collisions were logged
+    self.primary_view = None
+    self.result = self.update(challenger_fleet, challengee_fleet)
+
+  def update(self, challenger_fleet, challengee_fleet):
+    """ Returns the result of the battle between the fleets as they are now, re-simulating only the waves that changed """
+
+    challenger_fleet, challengee_fleet = normalize_fleets(challenger_fleet, challengee_fleet)
+    fleet_arrays = dict(zip(('challenger', 'challengee'), battle_fleets_to_arrays(challenger_fleet, challengee_fleet, self.wave_format)))
+    fleets = {'challenger': copy_fleet(challenger_fleet), 'challengee': copy_fleet(challengee_fleet)}
+
+    # The first row of each fleet that isn't the same as before
+    if self.fleets is None:
+      changed_rows = {side: 0 for side in fleets}
+    else:
+      changed_rows = {side: first_changed_row(self.fleets[side], fleets[side]) for side in fleets}
+
+    if self.wave_format == WAVE_FORMAT_DELTA:
+      initial = {side: fleet.to_fleet() for side, fleet in fleet_arrays.items()}
+    else:
+      initial = copy.deepcopy({'challenger': challenger_fleet, 'challengee': challengee_fleet})
+
+    # Reused snapshot waves get the changed rows as they are at the start of the battle
+    initial_formations = None
+    if self.fleets is not None and self.wave_format == WAVE_FORMAT_SNAPSHOT:
+      initial_formations = {side: fleet.to_formation() for side, fleet in fleet_arrays.items()}
+
+    shared_pass = self.shared_pass and can_share_battle_pass(fleet_arrays['challenger'], fleet_arrays['challengee'])
+    first_waves = {view: self.first_affected_wave(view, changed_rows, shared_pass) for view in ('challenger', 'challengee')}
+
+    # A battle that fails part way through leaves its checkpoints half written, so the next update starts over
+    try:
+      if shared_pass:
+        # The view that can be resumed from the latest wave is processed, and the other is replayed from its collisions
+        view = max(('challenger', 'challengee'), key=lambda view: first_waves[view])
+        opposing_view = OPPOSING_VIEW[view]
+        view_results = {view: self.resume_view(view, first_waves[view], fleet_arrays, changed_rows, initial_formations, log_collisions=True)}
+        view_results[opposing_view] = self.replay_view(
+          opposing_view, first_waves[opposing_view], fleet_arrays, changed_rows, initial_formations, self.checkpoints[view].collision_log)
+        self.primary_view = view
+      else:
+        view_results = {
+          view: self.resume_view(view, first_waves[view], fleet_arrays, changed_rows, initial_formations, log_collisions=False)
+          for view in ('challenger', 'challengee')
+        }
+        self.primary_view = None
+    except Exception:
+      self.fleets = None
+      self.checkpoints = {}
+      self.waves = {}
+      self.primary_view = None
+      raise
+    self.fleets = fleets
+
+    battle_summary = build_battle_summary(view_results['challenger'], view_results['challengee'])
+    self.result = {
+      'waveFormat': self.wave_format,
+      'initial': initial,
+      'final': battle_summary['final'],
+      'waves': {view: self.waves[view] for view in ('challenger', 'challengee')},
+      'score': battle_summary['score'],
+      'winner': battle_summary['winner']
+    }
+    return self.result
+
+  def first_affected_wave(self, view, changed_rows, shared_pass):
+    """ The first wave of a view that has to be processed again """
+
+    # Views can only be replayed from the collisions of a battle that had a shared pass
+    checkpoints = self.checkpoints.get(view)
+    if checkpoints is None or (shared_pass and self.primary_view is None):
+      return 0
+
+    return checkpoints.first_affected_wave(changed_rows[view], changed_rows[OPPOSING_VIEW[view]])
+
+  def resume_view(self, view, first_wave, fleet_arrays, changed_rows, initial_formations, log_collisions):
+    """ Processes a view of the battle, carrying on from the first wave the changes affect """
+
+    attacking_fleet = fleet_arrays[view].copy()
+    defending_fleet = fleet_arrays[OPPOSING_VIEW[view]].copy()
+
+    # Whether rows battle all at once depends on the fleets the battle started with, which the resumed fleets may
+    # no longer look like once units that were in more than one slot are destroyed
+    vectorized = self.vectorized and attacking_fleet.has_unique_units() and defending_fleet.has_unique_units()
+
+    checkpoints, waves, unit_maps = self.restore_view(
+      view, first_wave, attacking_fleet, defending_fleet, changed_rows, initial_formations, log_collisions)
+
+    return process_fleet_arrays_action(
+      attacking_fleet=attacking_fleet,
+      defending_fleet=defending_fleet,
+      wave_format=self.wave_format,
+      vectorized=vectorized,
+      waves=waves,
+      collision_log=checkpoints.collision_log,
+      unit_maps=unit_maps,
+      checkpoints=checkpoints)
+
+  def replay_view(self, view, first_wave, fleet_arrays, changed_rows, initial_formations, collision_log):
+    """ Replays a view of the battle from the collisions logged by the opposing view, carrying on from the first wave the changes affect """
+
+    # This is the last use of the fleet arrays, so they don't need to be copied
+    attacking_fleet = fleet_arrays[view]
+    defending_fleet = fleet_arrays[OPPOSING_VIEW[view]]
+
+    # Undoing a wave takes about a third as long as replaying it, so a view that would keep less than a quarter of its
+    # waves is quicker to replay from the start
+    checkpoints = self.checkpoints.get(view)
+    if checkpoints is not None and 4 * first_wave < checkpoints.wave_count:
+      first_wave = 0
+
+    checkpoints, waves, unit_maps = self.restore_view(
+      view, first_wave, attacking_fleet, defending_fleet, changed_rows, initial_formations, log_collisions=False)
+
+    view_result = replay_fleet_arrays_action(
+      attacking_fleet=attacking_fleet,
+      defending_fleet=defending_fleet,
+      collision_log=collision_log,
+      wave_format=self.wave_format,
+      waves=waves,
+      unit_maps=unit_maps,
+      checkpoints=checkpoints)
+
+    # Each row of the opposing fleet battled the rows of this one in its own wave, and battled this fleet's row in this
+    # view's wave for it, with the sides swapped. Units only battle once in a pair of rows, so undoing pairs is enough.
+    for wave_collisions in self.checkpoints[OPPOSING_VIEW[view]].collisions:
+      for dfr_fl_row_idx, atr_fl_row_idx, row_collisions in wave_collisions:
+        if atr_fl_row_idx >= first_wave:
+          checkpoints.collisions[atr_fl_row_idx].append((atr_fl_row_idx, dfr_fl_row_idx, swap_row_collisions(row_collisions)))
+
+    return view_result
+
+  def restore_view(self, view, first_wave, attacking_fleet, defending_fleet, changed_rows, initial_formations, log_collisions):
+    """
+    Rolls the checkpoints of a view back to its first wave the changes affect, and moves them to the changed fleets.
+    Returns the checkpoints, the waves before the first one and the manifests the waves share.
+    """
+
+    opposing_view = OPPOSING_VIEW[view]
+    unit_maps = ({}, {})
+
+    if not first_wave:
+      checkpoints = ViewCheckpoints(attacking_fleet, defending_fleet, log_collisions)
+      waves = []
+
+    else:
+      checkpoints = self.checkpoints[view]
+      # Only the view processed last time logged its collisions, which are the same collisions from the other side
+      if not log_collisions:
+        checkpoints.collision_log = None
+      elif view != self.primary_view:
+        opposing_checkpoints = self.checkpoints[opposing_view]
+        checkpoints.collision_log = swap_collision_log(opposing_checkpoints.collision_log, len(opposing_checkpoints.attacking_fleet.grid[0]))
+        opposing_checkpoints.collision_log = None
+      checkpoints.roll_back(first_wave)
+      checkpoints.move_to(attacking_fleet, defending_fleet, changed_rows[view], changed_rows[opposing_view])
+
+      waves = self.waves[view][:first_wave]
+      if initial_formations is not None:
+        waves = patch_snapshot_waves(
+          waves,
+          initial_formations[view], changed_rows[view],
+          initial_formations[opposing_view], changed_rows[opposing_view],
+          unit_maps)
+
+    self.checkpoints[view] = checkpoints
+    self.waves[view] = waves
+    return checkpoints, waves, unit_maps
+
+
+
+class ViewCheckpoints:
+  """
+  The state of a view of a battle after each of its waves, so it can be rolled back to any wave and resumed.
+  Instead of a copy of the fleets for every wave, only their latest state is kept, along with the state every unit
+  was in before each of its collisions, which is enough to undo the waves one at a time.
+  With a collision log, processing the view logs its collisions the way a shared pass does, for replaying the opposing view.
+  """
+
+  def __init__(self, attacking_fleet, defending_fleet, log_collisions=False):
+    self.attacking_fleet = attacking_fleet
+    self.defending_fleet = defending_fleet
+    self.collision_log = {} if log_collisions else None
+
+    # For each wave, the collisions of its rows, the defending rows it could have reached, and the kills after it
+    self.collisions = []
+    self.dfr_rows_reached = []
+    self.kills = []
+    self.wave_collisions = []
+
+  @property
+  def wave_count(self):
+    return len(self.kills)
+
+  def record_collisions(self, atr_fl_row_idx, dfr_fl_row_idx, row_collisions):
+    self.wave_collisions.append((atr_fl_row_idx, dfr_fl_row_idx, row_collisions))
+
+  def end_wave(self, dfr_rows_reached, kills):
+    self.collisions.append(self.wave_collisions)
+    self.dfr_rows_reached.append(dfr_rows_reached)
+    self.kills.append(kills)
+    self.wave_collisions = []
+
+  def first_affected_wave(self, atr_changed_row, dfr_changed_row):
+    """ Returns the first wave that changes to the attacking and defending fleets from the given rows on can affect """
+
+    for wave_idx, dfr_rows_reached in enumerate(self.dfr_rows_reached):
+      if wave_idx >= atr_changed_row:
+        return wave_idx
+      if dfr_changed_row != UNCHANGED and (dfr_rows_reached is None or dfr_rows_reached > dfr_changed_row):
+        return wave_idx
+
+    return self.wave_count
+
+  def roll_back(self, wave_count):
+    """ Undoes every wave after the first ones, leaving the fleets in their state after the last wave kept """
+
+    # Units can battle more than once in a wave, so collisions are undone in the reverse of the order they happened
+    for wave_collisions in reversed(self.collisions[wave_count:]):
+      for atr_fl_row_idx, dfr_fl_row_idx, row_collisions in reversed(wave_collisions):
+        undo_collisions(self.attacking_fleet, atr_fl_row_idx, row_collisions.atr_slots, row_collisions.atr_units,
+          row_collisions.atr_previous_health, row_collisions.atr_previous_skip, row_collisions.atr_killed)
+        undo_collisions(self.defending_fleet, dfr_fl_row_idx, row_collisions.dfr_slots, row_collisions.dfr_units,
+          row_collisions.dfr_previous_health, row_collisions.dfr_previous_skip, row_collisions.dfr_killed)
+        if self.collision_log is not None:
+          del self.collision_log[(atr_fl_row_idx, dfr_fl_row_idx)]
+
+    del self.collisions[wave_count:]
+    del self.dfr_rows_reached[wave_count:]
+    del self.kills[wave_count:]
+
+  def move_to(self, attacking_fleet, defending_fleet, atr_changed_row, dfr_changed_row):
+    """
+    Moves the checkpoints to the arrays of the changed fleets, carrying over the state of the units in the rows before
+    the changes. Those are the only units the waves that are kept can have battled.
+    """
+
+    atr_unit_map = carry_over_fleet_state(self.attacking_fleet, attacking_fleet, atr_changed_row)
+    dfr_unit_map = carry_over_fleet_state(self.defending_fleet, defending_fleet, dfr_changed_row)
+
+    # Units with other indices in the new arrays get them in the collisions too
+    if atr_unit_map is not None or dfr_unit_map is not None:
+      atr_unit_map = atr_unit_map or IdentityMap()
+      dfr_unit_map = dfr_unit_map or IdentityMap()
+      self.collisions = [
+        [
+          (atr_fl_row_idx, dfr_fl_row_idx, row_collisions._replace(
+            atr_units=[atr_unit_map[unit] for unit in row_collisions.atr_units],
+            dfr_units=[dfr_unit_map[unit] for unit in row_collisions.dfr_units]))
+          for atr_fl_row_idx, dfr_fl_row_idx, row_collisions in wave_collisions
+        ]
+        for wave_collisions in self.collisions
+      ]
+      if self.collision_log is not None:
+        self.collision_log = {
+          rows: [
+            (atr_slot, atr_unit_map[atr_unit], atr_health, atr_skip, dfr_unit_map[dfr_unit], dfr_health, dfr_skip, killed)
+            for atr_slot, atr_unit, atr_health, atr_skip, dfr_unit, dfr_health, dfr_skip, killed in logged_collisions
+          ]
+          for rows, logged_collisions in self.collision_log.items()
+        }
+
+    self.attacking_fleet = attacking_fleet
+    self.defending_fleet = defending_fleet
+
+
+
+class IdentityMap:
+  """ A map of unit indices for units that kept theirs """
+  def __getitem__(self, unit):
+    return unit
+
+
+
+def undo_collisions(fleet, row_idx, slots, units, previous_health, previous_skip, killed):
+  """ Puts the units of one side of the collisions between two rows back in their state from before the collisions """
+
+  # A unit in more than one slot of a row battles more than once, so the collisions are undone last first
+  row = fleet.grid[row_idx]
+  for slot, unit, unit_health, unit_skip, unit_killed in reversed(list(zip(slots, units, previous_health, previous_skip, killed))):
+    fleet.health[unit] = unit_health
+    fleet.skip[unit] = unit_skip
+    if unit_killed:
+      row[slot] = unit
+
+
+
+def carry_over_fleet_state(rolled_back_fleet, fleet, changed_row):
+  """
+  Copies the state of the units in the rows of a rolled back fleet before its first changed row to a new fleet with the
+  same units in those rows. Returns a map of the old indices of the units to their new ones, or None if they're the same.
+  """
+
+  kept_rows = min(changed_row, len(fleet.grid))
+
+  # Units keep their indices as long as the manifest keeps its order, which is the case for most formation changes
+  unit_count = len(rolled_back_fleet.unit_ids)
+  if fleet.unit_ids[:unit_count] == rolled_back_fleet.unit_ids and fleet.types[:unit_count] == rolled_back_fleet.types:
+    fleet.health[:unit_count] = rolled_back_fleet.health
+    fleet.skip[:unit_count] = rolled_back_fleet.skip
+    fleet.grid[:kept_rows] = [array(row.typecode, row) for row in rolled_back_fleet.grid[:kept_rows]]
+    return None
+
+  old_indices = {unit_id: unit for unit, unit_id in enumerate(rolled_back_fleet.unit_ids)}
+  unit_map = {}
+  for row_idx in range(kept_rows):
+    rolled_back_row = rolled_back_fleet.grid[row_idx]
+    row = fleet.grid[row_idx]
+    for slot, unit in enumerate(row):
+      if unit == EMPTY_SLOT:
+        continue
+      old_unit = old_indices[fleet.unit_ids[unit]]
+      unit_map[old_unit] = unit
+      fleet.health[unit] = rolled_back_fleet.health[old_unit]
+      fleet.skip[unit] = rolled_back_fleet.skip[old_unit]
+      if rolled_back_row[slot] == EMPTY_SLOT:
+        row[slot] = EMPTY_SLOT
+
+  return unit_map
+
+
+
+def swap_row_collisions(row_collisions):
+  """ The collisions between two rows as seen from the opposing view """
+  return RowCollisions(
+    atr_slots=row_collisions.dfr_slots,
+    dfr_slots=row_collisions.atr_slots,
+    atr_units=row_collisions.dfr_units,
+    dfr_units=row_collisions.atr_units,
+    atr_previous_health=row_collisions.dfr_previous_health,
+    atr_previous_skip=row_collisions.dfr_previous_skip,
+    dfr_previous_health=row_collisions.atr_previous_health,
+    dfr_previous_skip=row_collisions.atr_previous_skip,
+    atr_health=row_collisions.dfr_health,
+    atr_skip=row_collisions.dfr_skip,
+    dfr_health=row_collisions.atr_health,
+    dfr_skip=row_collisions.atr_skip,
+    atr_killed=row_collisions.dfr_killed,
+    dfr_killed=row_collisions.atr_killed)
+
+
+
+def swap_collision_log(collision_log, row_width):
+  """ The collisions logged by a shared pass as if they had been logged by the opposing view, slots in their own order """
+  return {
+    (dfr_fl_row_idx, atr_fl_row_idx): [
+      (row_width - 1 - atr_slot, dfr_unit, dfr_health, dfr_skip, atr_unit, atr_health, atr_skip, SWAPPED_KILLED[killed])
+      for atr_slot, atr_unit, atr_health, atr_skip, dfr_unit, dfr_health, dfr_skip, killed in reversed(logged_collisions)
+    ]
+    for (atr_fl_row_idx, dfr_fl_row_idx), logged_collisions in collision_log.items()
+  }
+
+
+
+def copy_fleet(fleet):
+  """ A copy of a fleet to tell later changes to it apart, which only copies as deep as the battle looks """
+  return {
+    'formation': [list(row) for row in fleet.get('formation') or []],
+    'manifest': {unit_id: dict(unit) for unit_id, unit in (fleet.get('manifest') or {}).items()}
+  }
+
+
+
+def first_changed_row(old_fleet, new_fleet):
+  """
+  Returns the first row of a fleet's formation that changed, either because its slots changed or because a unit in it
+  changed in the manifest, or UNCHANGED if none did.
+  """
+
+  old_manifest = old_fleet.get('manifest') or {}
+  new_manifest = new_fleet.get('manifest') or {}
+  changed_units = {
+    unit_id for unit_id in old_manifest.keys() | new_manifest.keys()
+    if old_manifest.get(unit_id) != new_manifest.get(unit_id)
+    and battle_properties(old_manifest.get(unit_id)) != battle_properties(new_manifest.get(unit_id))
+  }
+
+  old_formation = old_fleet.get('formation') or []
+  new_formation = new_fleet.get('formation') or []
+  for row_idx, (old_row, new_row) in enumerate(zip(old_formation, new_formation)):
+    if old_row != new_row or not changed_units.isdisjoint(new_row):
+      return row_idx
+
+  # Rows added to or removed from the back of the formation
+  if len(old_formation) != len(new_formation):
+    return min(len(old_formation), len(new_formation))
+  return UNCHANGED
+
+
+
+def battle_properties(unit):
+  """ The properties of a manifest entry that can change a battle """
+  if unit is None:
+    return None
+  return {name: value for name, value in unit.items() if name not in CONSUMABLE_PROPERTIES}
+
+
+
+def patch_snapshot_waves(waves, attacking_formation, atr_changed_row, defending_formation, dfr_changed_row, unit_maps):
+  """
+  Rebuilds reused snapshot waves for the changed fleets. Their formations keep the rows before each fleet's first changed
+  row, which are as the wave left them, and get the changed rows as they are at the start of the battle, since the wave
+  didn't reach them. They share the new manifests, which are filled in once the battle is over.
+  """
+
+  attacking_fleet_unit_map, defending_fleet_unit_map = unit_maps
+
+  # Waves that share a formation still share it once it's patched
+  patched_formations = {}
+
+  def patch_formation(formation, initial_formation, changed_row):
+    kept_rows = min(changed_row, len(initial_formation))
+    if kept_rows == len(formation) == len(initial_formation):
+      return formation
+    if id(formation) not in patched_formations:
+      patched_formations[id(formation)] = formation[:kept_rows] + initial_formation[kept_rows:]
+    return patched_formations[id(formation)]
+
+  return [
+    {
+      'attackerRow': wave['attackerRow'],
+      'attackerFleet': {
+        'manifest': attacking_fleet_unit_map,
+        'formation': patch_formation(wave['attackerFleet']['formation'], attacking_formation, atr_changed_row)
+      },
+      'defenderFleet': {
+        'manifest': defending_fleet_unit_map,
+        'formation': patch_formation(wave['defenderFleet']['formation'], defending_formation, dfr_changed_row)
+      },
+      'interactions': wave['interactions']
+    }
+    for wave in waves
+  ]
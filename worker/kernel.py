@@ -0,0 +1,165 @@
+"""
+Vectorized battles between whole rows of units, used by the battle engine when NumPy is installed
+"""
+
+from typing import NamedTuple
+
+from fleet_arrays import EMPTY_SLOT, NO_TYPE
+from rules import COMPILED_UNIT_SPECS
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Narrower rows battle faster one unit at a time, since the kernel has a fixed cost for every pair of rows
+KERNEL_MIN_ROW_WIDTH = 128
+
+
+class FleetViews(NamedTuple):
+  """ NumPy views of the arrays of a fleet, which share their memory with the fleet """
+  types: object
+  health: object
+  skip: object
+  grid: list
+  has_missing_units: bool  # If any units in the formation are missing from the manifest
+
+
+class RowCollisions(NamedTuple):
+  """ The battles between the units in two rows, with one entry in each list for each battle, in slot order """
+  atr_slots: list
+  dfr_slots: list
+  atr_units: list
+  dfr_units: list
+  atr_previous_health: list
+  atr_previous_skip: list
+  dfr_previous_health: list
+  dfr_previous_skip: list
+  atr_health: list
+  atr_skip: list
+  dfr_health: list
+  dfr_skip: list
+  atr_killed: list
+  dfr_killed: list
+
+
+# Row collisions for rows where no units battled
+NO_ROW_COLLISIONS = RowCollisions(*([],) * len(RowCollisions._fields))
+
+
+def is_kernel_available():
+  """ Checks if rows can be battled with the vectorized kernel """
+  return numpy is not None and COMPILED_DAMAGE is not None
+
+
+def compile_damage_arrays():
+  """ Converts the compiled unit spec tables to NumPy arrays, if NumPy is installed and all values are integers """
+
+  if numpy is None:
+    return None, None
+
+  # The fleet arrays store health as integers, so the kernel can only use integer damage
+  values = COMPILED_UNIT_SPECS.health + [damage for row in COMPILED_UNIT_SPECS.damage for damage in row if damage is not None]
+  if not all(isinstance(value, int) for value in values):
+    return None, None
+
+  damage = numpy.array([[damage or 0 for damage in row] for row in COMPILED_UNIT_SPECS.damage], dtype=numpy.int64)
+  dynamic_damage = numpy.array([[damage is None for damage in row] for row in COMPILED_UNIT_SPECS.damage], dtype=bool)
+  return damage, dynamic_damage
+
+
+def fleet_views(fleet):
+  """ Returns NumPy views of the arrays of a fleet """
+  return FleetViews(
+    types=numpy.frombuffer(fleet.types, dtype=fleet.types.typecode),
+    health=numpy.frombuffer(fleet.health, dtype=fleet.health.typecode),
+    skip=numpy.frombuffer(fleet.skip, dtype=fleet.skip.typecode),
+    grid=[numpy.frombuffer(row, dtype=row.typecode) for row in fleet.grid],
+    has_missing_units=NO_TYPE in fleet.types
+  )
+
+
+def collide_rows(attacking_fleet, atr_fl_row, defending_fleet, dfr_fl_row):
+  """
+  Has every unit in a row of the attacking fleet battle the unit coming at it in a row of the defending fleet, all at once.
+  Both rows must be the same width and no unit can be in a row more than once.
+  Returns the row collisions, or None if any of the battles can't be vectorized.
+  """
+
+  # The defending row is reversed since they are coming AT the attacker fleet
+  reversed_dfr_row = dfr_fl_row[::-1]
+
+  # Find the slots where both units exist
+  atr_slots = numpy.flatnonzero((atr_fl_row != EMPTY_SLOT) & (reversed_dfr_row != EMPTY_SLOT))
+  if not atr_slots.size:
+    return NO_ROW_COLLISIONS
+  atr_units = atr_fl_row[atr_slots]
+  dfr_units = reversed_dfr_row[atr_slots]
+  atr_types = attacking_fleet.types[atr_units]
+  dfr_types = defending_fleet.types[dfr_units]
+  if attacking_fleet.has_missing_units or defending_fleet.has_missing_units:
+    exists = (atr_types != NO_TYPE) & (dfr_types != NO_TYPE)
+    atr_slots, atr_units, dfr_units, atr_types, dfr_types = atr_slots[exists], atr_units[exists], dfr_units[exists], atr_types[exists], dfr_types[exists]
+    if not atr_slots.size:
+      return NO_ROW_COLLISIONS
+
+  atr_previous_health = attacking_fleet.health[atr_units]
+  dfr_previous_health = defending_fleet.health[dfr_units]
+  atr_previous_skip = attacking_fleet.skip[atr_units]
+  dfr_previous_skip = defending_fleet.skip[dfr_units]
+
+  # If either unit can skip battle, the skip property on both units is decremented instead of fighting
+  skipping = (atr_previous_skip > 0) | (dfr_previous_skip > 0)
+  fighting = ~skipping
+
+  # Damage that depends on more than the unit types has to be interpreted one battle at a time
+  if HAS_DYNAMIC_DAMAGE:
+    if COMPILED_DYNAMIC_DAMAGE[dfr_types[fighting], atr_types[fighting]].any() or COMPILED_DYNAMIC_DAMAGE[atr_types[fighting], dfr_types[fighting]].any():
+      return None
+
+  # Calculate the new health values of the fighting units.
+  # Units in a formation always have health left, so there is no need for the fallback to their initial health.
+  atr_health = atr_previous_health - COMPILED_DAMAGE[dfr_types, atr_types] * fighting
+  dfr_health = dfr_previous_health - COMPILED_DAMAGE[atr_types, dfr_types] * fighting
+
+  # Calculate the new skip values of the skipping units
+  atr_skip = numpy.where(skipping, numpy.maximum(atr_previous_skip - 1, 0), atr_previous_skip)
+  dfr_skip = numpy.where(skipping, numpy.maximum(dfr_previous_skip - 1, 0), dfr_previous_skip)
+
+  # Check for destroyed ships
+  atr_killed = atr_health <= 0
+  dfr_killed = dfr_health <= 0
+  atr_health[atr_killed] = 0
+  dfr_health[dfr_killed] = 0
+
+  # Save the new states and remove destroyed ships from the formations
+  dfr_slots = len(dfr_fl_row) - 1 - atr_slots
+  attacking_fleet.health[atr_units] = atr_health
+  defending_fleet.health[dfr_units] = dfr_health
+  attacking_fleet.skip[atr_units] = atr_skip
+  defending_fleet.skip[dfr_units] = dfr_skip
+  atr_fl_row[atr_slots[atr_killed]] = EMPTY_SLOT
+  dfr_fl_row[dfr_slots[dfr_killed]] = EMPTY_SLOT
+
+  return RowCollisions(
+    atr_slots=atr_slots.tolist(),
+    dfr_slots=dfr_slots.tolist(),
+    atr_units=atr_units.tolist(),
+    dfr_units=dfr_units.tolist(),
+    atr_previous_health=atr_previous_health.tolist(),
+    atr_previous_skip=atr_previous_skip.tolist(),
+    dfr_previous_health=dfr_previous_health.tolist(),
+    dfr_previous_skip=dfr_previous_skip.tolist(),
+    atr_health=atr_health.tolist(),
+    atr_skip=atr_skip.tolist(),
+    dfr_health=dfr_health.tolist(),
+    dfr_skip=dfr_skip.tolist(),
+    atr_killed=atr_killed.tolist(),
+    dfr_killed=dfr_killed.tolist()
+  )
+
+
+# Convert the compiled unit specs once, when the worker starts
+COMPILED_DAMAGE, COMPILED_DYNAMIC_DAMAGE = compile_damage_arrays()
+HAS_DYNAMIC_DAMAGE = COMPILED_DYNAMIC_DAMAGE is not None and bool(COMPILED_DYNAMIC_DAMAGE.any())
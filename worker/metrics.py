@@ -0,0 +1,209 @@
+"""
+Metrics of battles, to find out where the time of a slow battle went. A battle only collects them when it's asked to, and
+otherwise the battle engine is given None instead, which costs no more than checking for it.
+
+The metrics of a battle are counts of what happened in it, and the seconds spent in each phase of running it:
+
+* load - Parsing the battle's JSON
+* validate - Validating and normalizing the fleets (see validation.py)
+* init - Converting the fleets to arrays, and copying their initial state
+* finalStates - Processing the battle without its waves, to find the final manifests snapshot waves hold, when the
+  result is streamed
+* challengerView, challengeeView - Processing the battle from the view of each fleet
+* serialize - Encoding the result, including each wave as it's built
+* write - Writing the encoded result to its output
+
+Phases only count their own time, not the time of phases inside them, so the seconds of a battle add up to its total.
+The views of a battle processed in parallel are timed in their own processes, so they overlap.
+"""
+
+import sys
+import json
+import time
+import heapq
+
+from contextlib import contextmanager, nullcontext
+
+COUNTS = ('units', 'collisions', 'skippedInteractions', 'kills', 'deepcopyBytes')
+
+PHASE_LOAD = 'load'
+PHASE_VALIDATE = 'validate'
+PHASE_INIT = 'init'
+PHASE_FINAL_STATES = 'finalStates'
+PHASE_SERIALIZE = 'serialize'
+PHASE_WRITE = 'write'
+VIEW_PHASES = {'challenger': 'challengerView', 'challengee': 'challengeeView'}
+
+# Phases of battles without metrics are timed with this instead, which does nothing
+NO_PHASE = nullcontext()
+
+# The slowest battles are kept, with their metrics, to find fleets that are slow to battle
+MAX_SLOWEST_BATTLES = 10
+
+
+class BattleMetrics:
+  """ The counts and phase timings of a single battle """
+
+  def __init__(self):
+    self.counts = dict.fromkeys(COUNTS, 0)
+    self.seconds = {}
+    self._phases = []
+    self._phase_start = None
+
+  @contextmanager
+  def phase(self, name):
+    """ Times a phase of the battle. A phase inside another pauses it, so its time isn't counted twice. """
+
+    now = time.perf_counter()
+    if self._phases:
+      self._add_seconds(self._phases[-1], now)
+    self._phases.append(name)
+    self._phase_start = now
+    try:
+      yield
+    finally:
+      now = time.perf_counter()
+      self._add_seconds(self._phases.pop(), now)
+      self._phase_start = now
+
+  def add_phase_seconds(self, name, seconds):
+    """ Adds the time of a phase that was timed some other way """
+    self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+  def _add_seconds(self, name, now):
+    self.add_phase_seconds(name, now - self._phase_start)
+
+  def count_collisions(self, row_collisions, kill_count):
+    """ Counts the battles between two rows, which are skipped when either unit has a skip left """
+    self.counts['collisions'] += len(row_collisions.atr_units)
+    self.counts['skippedInteractions'] += sum(
+      1 for atr_skip, dfr_skip in zip(row_collisions.atr_previous_skip, row_collisions.dfr_previous_skip) if atr_skip > 0 or dfr_skip > 0)
+    self.counts['kills'] += kill_count
+
+  def merge(self, other):
+    """ Adds the counts and timings of part of the battle collected elsewhere, such as in another process """
+    for name, count in other.counts.items():
+      self.counts[name] = self.counts.get(name, 0) + count
+    for name, seconds in other.seconds.items():
+      self.add_phase_seconds(name, seconds)
+
+  def to_dict(self):
+    return {'counts': dict(self.counts), 'seconds': {name: round(seconds, 6) for name, seconds in self.seconds.items()}}
+
+
+
+def timed(metrics, name):
+  """ Times a phase of a battle in its metrics, or does nothing if the battle has none """
+  return NO_PHASE if metrics is None else metrics.phase(name)
+
+
+
+def copied_size(value):
+  """
+  The bytes a deep copy of a JSON value allocates. Strings and numbers can't be changed, so copies share them, and only
+  the lists and dicts holding them are copied.
+  """
+
+  size = 0
+  values = [value]
+  while values:
+    value = values.pop()
+    if isinstance(value, dict):
+      size += sys.getsizeof(value)
+      values.extend(value.values())
+    elif isinstance(value, list):
+      size += sys.getsizeof(value)
+      values.extend(value)
+  return size
+
+
+
+class TimedWaves:
+  """ Appends the waves of a view to a wave writer, timing it as serializing the result """
+
+  def __init__(self, waves, metrics):
+    self.waves = waves
+    self.metrics = metrics
+
+  def append(self, wave):
+    with self.metrics.phase(PHASE_SERIALIZE):
+      self.waves.append(wave)
+
+  def close(self):
+    with self.metrics.phase(PHASE_SERIALIZE):
+      self.waves.close()
+
+
+
+def timed_waves(waves, metrics):
+  """ The waves of a view, timed as serializing the result if the battle has metrics """
+  return waves if metrics is None else TimedWaves(waves, metrics)
+
+
+
+class MetricsAggregator:
+  """
+  Totals of the metrics of battles, by the provider that ran them, and the slowest battles. Providers that are slow for
+  the battles they're given stand out by their time per collision, and fleets that are slow to battle by being among
+  the slowest battles.
+  """
+
+  def __init__(self, max_slowest_battles=MAX_SLOWEST_BATTLES):
+    self.max_slowest_battles = max_slowest_battles
+    self.providers = {}
+    self.battle_count = 0
+    self._slowest_battles = []
+
+  def add(self, battle_id, metrics, provider=None):
+    """ Adds the metrics of a battle, as the dict it's sent as, with the provider that ran it if it's not in them """
+
+    provider = metrics.get('provider') or provider or 'unknown'
+    totals = self.providers.setdefault(provider, {'battles': 0, 'counts': {}, 'seconds': {}})
+    totals['battles'] += 1
+    for name, count in metrics.get('counts', {}).items():
+      totals['counts'][name] = totals['counts'].get(name, 0) + count
+    for name, seconds in metrics.get('seconds', {}).items():
+      totals['seconds'][name] = totals['seconds'].get(name, 0.0) + seconds
+
+    self.battle_count += 1
+    slow_battle = (sum(metrics.get('seconds', {}).values()), self.battle_count, str(battle_id), provider, metrics)
+    if len(self._slowest_battles) < self.max_slowest_battles:
+      heapq.heappush(self._slowest_battles, slow_battle)
+    else:
+      heapq.heappushpop(self._slowest_battles, slow_battle)
+
+  def summary(self):
+    """ The totals and rates of each provider, slowest first, and the slowest battles """
+
+    providers = {}
+    for provider, totals in self.providers.items():
+      total_seconds = sum(totals['seconds'].values())
+      collisions = totals['counts'].get('collisions', 0)
+      providers[provider] = dict(
+        totals,
+        seconds={name: round(seconds, 6) for name, seconds in totals['seconds'].items()},
+        totalSeconds=round(total_seconds, 6),
+        secondsPerBattle=round(total_seconds / totals['battles'], 6),
+        microsecondsPerCollision=round(total_seconds * 1e6 / collisions, 3) if collisions else None)
+
+    return {
+      'providers': dict(sorted(providers.items(), key=lambda item: item[1]['microsecondsPerCollision'] or 0, reverse=True)),
+      'slowestBattles': [
+        {'id': battle_id, 'provider': provider, 'totalSeconds': round(total_seconds, 6), 'metrics': metrics}
+        for total_seconds, _, battle_id, provider, metrics in sorted(self._slowest_battles, reverse=True)
+      ]
+    }
+
+  def print_summary(self):
+    summary = self.summary()
+    print(f'*** METRICS OF {self.battle_count} BATTLES')
+    for provider, totals in summary['providers'].items():
+      per_collision = '-' if totals['microsecondsPerCollision'] is None else f"{totals['microsecondsPerCollision']:.2f}us"
+      print(f"***   {provider}: {totals['battles']} battles, {totals['secondsPerBattle']:.3f}s per battle, {per_collision} per collision")
+    for battle in summary['slowestBattles'][:3]:
+      print(f"***   SLOW BATTLE {battle['id']} ON {battle['provider']}: {battle['totalSeconds']:.3f}s, "
+        f"{battle['metrics'].get('counts', {}).get('units', '?')} units")
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.summary(), f, indent=2)
@@ -0,0 +1,264 @@
+"""
+Seekable replays of battle results. A replay file holds the waves of a battle result as keyframes, the full state of
+both fleets every few waves, and the changes made by each wave in between, each compressed on its own and found
+through an index at the end of the file. Any wave can be rebuilt by reading its keyframe and the waves after it, so a
+single wave of a large battle is read without loading the rest of the result.
+
+Waves are rebuilt as full snapshots: the same as the waves of a snapshot format result, or the waves a delta format
+result decodes to with waves.decode_wave.
+"""
+
+import io
+import sys
+import copy
+import json
+import zlib
+import struct
+import argparse
+
+from waves import WAVE_FORMAT_DELTA, OPPOSING_VIEW, new_fleet_delta, apply_fleet_delta
+
+REPLAY_MAGIC = b'FBREPLAY'
+REPLAY_VERSION = 1
+
+# A replay starts with the magic and version, and ends with the offset and length of its index followed by the magic
+REPLAY_HEADER = struct.Struct('<8sH')
+REPLAY_TRAILER = struct.Struct('<QQ8s')
+
+# Rebuilding a wave reads at most this many waves after its keyframe
+DEFAULT_KEYFRAME_INTERVAL = 8
+
+VIEWS = ('challenger', 'challengee')
+
+
+class ReplayError(Exception):
+  """ A file that isn't a replay, or a replay in a version that can't be read """
+
+
+
+def build_replay(result, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+  """ Returns the replay file of a battle result, in either wave format, as bytes """
+
+  if keyframe_interval < 1:
+    raise ValueError(f'keyframe interval must be at least 1, not {keyframe_interval}')
+
+  replay_file = io.BytesIO()
+  replay_file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION))
+
+  def write_block(value):
+    """ Writes a compressed JSON block, returning its offset and length """
+    block = zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+    offset = replay_file.tell()
+    replay_file.write(block)
+    return [offset, len(block)]
+
+  index = {
+    'version': REPLAY_VERSION,
+    'waveFormat': result.get('waveFormat'),
+    'keyframeInterval': keyframe_interval,
+    'score': result.get('score'),
+    'winner': result.get('winner'),
+    'initial': write_block(result.get('initial')),
+    'final': write_block(result.get('final')),
+    'views': {}
+  }
+
+  for view in VIEWS:
+    wave_blocks = []
+    keyframe_blocks = []
+
+    for wave_idx, (wave, fleets) in enumerate(iter_wave_fleets(result, view)):
+      # Waves with a keyframe don't need their changes, only what happened in them
+      if wave_idx % keyframe_interval == 0:
+        keyframe_blocks.append(write_block({'attackerFleet': fleets[0], 'defenderFleet': fleets[1]}))
+        wave_blocks.append(write_block({'attackerRow': wave['attackerRow'], 'interactions': wave['interactions']}))
+      else:
+        wave_blocks.append(write_block(wave))
+
+    index['views'][view] = {'waves': wave_blocks, 'keyframes': keyframe_blocks}
+
+  index_offset, index_length = write_block(index)
+  replay_file.write(REPLAY_TRAILER.pack(index_offset, index_length, REPLAY_MAGIC))
+  return replay_file.getvalue()
+
+
+
+def iter_wave_fleets(result, view):
+  """
+  Yields every wave of a view of a battle result in the delta format, along with the attacking and defending fleets as
+  they are after it. The fleets are only valid until the next wave.
+  """
+
+  waves = result['waves'][view]
+
+  if result.get('waveFormat') == WAVE_FORMAT_DELTA:
+    attacking_fleet = copy.deepcopy(result['initial'][view])
+    defending_fleet = copy.deepcopy(result['initial'][OPPOSING_VIEW[view]])
+    for wave in waves:
+      apply_fleet_delta(attacking_fleet, wave['attackerFleet'])
+      apply_fleet_delta(defending_fleet, wave['defenderFleet'])
+      yield wave, (attacking_fleet, defending_fleet)
+    return
+
+  # Snapshot waves are turned into the changes from the wave before them. The first wave has nothing before it, but it
+  # always has a keyframe, so its changes are never used.
+  previous_wave = None
+  for wave in waves:
+    yield {
+      'attackerRow': wave['attackerRow'],
+      'attackerFleet': fleet_changes(previous_wave and previous_wave['attackerFleet'], wave['attackerFleet']),
+      'defenderFleet': fleet_changes(previous_wave and previous_wave['defenderFleet'], wave['defenderFleet']),
+      'interactions': wave['interactions']
+    }, (wave['attackerFleet'], wave['defenderFleet'])
+    previous_wave = wave
+
+
+
+def fleet_changes(previous_fleet, fleet):
+  """ Returns the changes that turn one snapshot of a fleet into the next, in the form of a wave of the delta format """
+
+  fleet_delta = new_fleet_delta()
+  if previous_fleet is None:
+    return fleet_delta
+
+  # Snapshots share the manifest and formation of the wave before when they didn't change
+  previous_manifest = previous_fleet['manifest']
+  if fleet['manifest'] is not previous_manifest:
+    for unit_id, unit in fleet['manifest'].items():
+      previous_unit = previous_manifest.get(unit_id) or {}
+      for name in ('health', 'skip'):
+        if name in unit and unit[name] != previous_unit.get(name):
+          fleet_delta[name][unit_id] = unit[name]
+
+  previous_formation = previous_fleet['formation']
+  if fleet['formation'] is not previous_formation:
+    for row_idx, (previous_row, row) in enumerate(zip(previous_formation, fleet['formation'])):
+      for unit_idx, (previous_unit_id, unit_id) in enumerate(zip(previous_row, row)):
+        if previous_unit_id is not None and unit_id is None:
+          fleet_delta['removed'].append([row_idx, unit_idx])
+
+  return fleet_delta
+
+
+
+class Replay:
+  """
+  A replay file opened for reading. Only the index is read when it's opened, and each wave is rebuilt from the blocks
+  it needs. The file can be anything with seek and read, such as a wrapper around ranged reads from object storage.
+  """
+
+  def __init__(self, replay_file):
+    self.file = replay_file
+
+    self.file.seek(0)
+    magic, version = REPLAY_HEADER.unpack(self.file.read(REPLAY_HEADER.size))
+    if magic != REPLAY_MAGIC:
+      raise ReplayError('not a replay file')
+    if version != REPLAY_VERSION:
+      raise ReplayError(f'replay version {version} is not supported')
+
+    self.file.seek(-REPLAY_TRAILER.size, io.SEEK_END)
+    index_offset, index_length, magic = REPLAY_TRAILER.unpack(self.file.read(REPLAY_TRAILER.size))
+    if magic != REPLAY_MAGIC:
+      raise ReplayError('replay file is truncated')
+    self.index = self.read_block([index_offset, index_length])
+
+    self.wave_format = self.index['waveFormat']
+    self.keyframe_interval = self.index['keyframeInterval']
+    self.score = self.index['score']
+    self.winner = self.index['winner']
+
+  @classmethod
+  def open(cls, path):
+    return cls(open(path, 'rb'))
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def read_block(self, block):
+    offset, length = block
+    self.file.seek(offset)
+    return json.loads(zlib.decompress(self.file.read(length)))
+
+  @property
+  def initial(self):
+    return self.read_block(self.index['initial'])
+
+  @property
+  def final(self):
+    return self.read_block(self.index['final'])
+
+  def wave_count(self, view):
+    return len(self.index['views'][view]['waves'])
+
+  def get_wave(self, view, wave_idx):
+    """ Rebuilds a single wave of a view as a full snapshot """
+
+    wave_count = self.wave_count(view)
+    if wave_idx < 0 or wave_idx >= wave_count:
+      raise IndexError(f'wave {wave_idx} is out of range for a battle with {wave_count} waves')
+
+    return next(self.iter_waves(view, wave_idx, wave_idx + 1))
+
+  def iter_waves(self, view, start=0, stop=None):
+    """ Yields the waves of a view from start up to, but not including, stop as full snapshots, in order """
+
+    view_index = self.index['views'][view]
+    start, stop, _ = slice(start, stop).indices(len(view_index['waves']))
+    if start >= stop:
+      return
+
+    # Start from the last keyframe at or before the first wave, and apply the changes of every wave after it
+    first_wave_idx = start - start % self.keyframe_interval
+    for wave_idx in range(first_wave_idx, stop):
+      wave = self.read_block(view_index['waves'][wave_idx])
+      if wave_idx % self.keyframe_interval == 0:
+        keyframe = self.read_block(view_index['keyframes'][wave_idx // self.keyframe_interval])
+        attacking_fleet = keyframe['attackerFleet']
+        defending_fleet = keyframe['defenderFleet']
+      else:
+        apply_fleet_delta(attacking_fleet, wave['attackerFleet'])
+        apply_fleet_delta(defending_fleet, wave['defenderFleet'])
+
+      if wave_idx >= start:
+        yield {
+          'attackerRow': wave['attackerRow'],
+          'attackerFleet': copy.deepcopy(attacking_fleet),
+          'defenderFleet': copy.deepcopy(defending_fleet),
+          'interactions': wave['interactions']
+        }
+
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Builds a replay file from a battle result, or prints a wave of a replay')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  build_parser = subparsers.add_parser('build', help='build a replay file from a battle result JSON file')
+  build_parser.add_argument('result_path')
+  build_parser.add_argument('replay_path')
+  build_parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL, help=f'waves between keyframes (default: {DEFAULT_KEYFRAME_INTERVAL})')
+
+  wave_parser = subparsers.add_parser('wave', help='print a wave of a replay file as JSON')
+  wave_parser.add_argument('replay_path')
+  wave_parser.add_argument('view', choices=VIEWS)
+  wave_parser.add_argument('wave_idx', type=int)
+
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    with open(args.result_path) as f:
+      result = json.load(f)
+    with open(args.replay_path, 'wb') as f:
+      f.write(build_replay(result, args.keyframe_interval))
+
+  else:
+    with Replay.open(args.replay_path) as replay:
+      json.dump(replay.get_wave(args.view, args.wave_idx), sys.stdout)
+      print()
@@ -0,0 +1,568 @@
+"""
+Encodings that battle results can be written in. Results are JSON unless a requestor asks for another encoding.
+
+The columnar encoding is a binary layout for the waves of large battles, which repeat the same unit ids and manifests
+over and over. Every unit id is numbered once for its fleet, the interactions, formations and changes of a wave are
+arrays of those numbers, and the manifests and formations that snapshot waves share with the wave before them are
+written once. Either encoding can be compressed with gzip, or with zstd when the zstandard package is installed.
+
+A requestor lists the encodings it accepts, most preferred first, such as 'columnar+zstd', and the worker writes the
+first one it can. Encoded results start with a marker of their encoding, so they're read without being told which.
+"""
+
+import io
+import sys
+import gzip
+import json
+import base64
+import shutil
+import struct
+
+from array import array
+from contextlib import contextmanager
+from itertools import chain
+from operator import itemgetter
+
+from waves import KILLED_LABELS, OPPOSING_VIEW
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+RESULT_ENCODING_JSON = 'json'
+RESULT_ENCODING_COLUMNAR = 'columnar'
+RESULT_ENCODINGS = (RESULT_ENCODING_JSON, RESULT_ENCODING_COLUMNAR)
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_ZSTD)
+
+# Lower than the defaults of each library, which take much longer for results that are only a little smaller
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+JSON_TEXT_ENCODING = 'utf-8'
+
+# A columnar result is its magic and version, followed by blocks that each start with their kind and length
+COLUMNAR_MAGIC = b'FBCOLUMN'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<8sH')
+BLOCK_HEADER = struct.Struct('<BI')
+
+# A top level property of the result, as a JSON [key, value] pair
+BLOCK_PROPERTY = 1
+# Unit ids of each fleet, numbered after the ones before them, as a JSON object of lists keyed by fleet
+BLOCK_UNITS = 2
+# A wave of a view of the battle
+BLOCK_WAVE = 3
+
+VIEWS = ('challenger', 'challengee')
+
+# How the parts of a wave are stored
+FLEET_SNAPSHOT = 0
+FLEET_DELTA = 1
+SAME_AS_PREVIOUS_WAVE = 0
+WRITTEN = 1
+INT_VALUES = 0
+JSON_VALUES = 1
+
+# Slots without a unit are stored as the number one less than the first unit
+NO_UNIT = -1
+
+KILLED_CODES = {label: code for code, label in enumerate(KILLED_LABELS)}
+
+# Arrays are stored little endian whatever machine writes them
+SWAP_BYTES = sys.byteorder == 'big'
+
+COUNT = struct.Struct('<I')
+BYTE = struct.Struct('<B')
+ROW = struct.Struct('<i')
+
+
+class ResultEncodingError(ValueError):
+  """ A result that can't be decoded, or an encoding that isn't known """
+
+
+
+def parse_result_encoding(result_encoding):
+  """ Splits the name of a result encoding into the encoding and its compression, which is None if it isn't compressed """
+
+  encoding, _, compression = result_encoding.partition('+')
+  if encoding not in RESULT_ENCODINGS or (compression and compression not in COMPRESSIONS):
+    raise ResultEncodingError(f'unknown result encoding {result_encoding}')
+  return encoding, compression or None
+
+
+
+def supported_result_encodings():
+  """ The result encodings that can be written and read here, most preferred first """
+
+  compressions = ([COMPRESSION_ZSTD] if zstandard is not None else []) + [COMPRESSION_GZIP]
+  return [
+    f'{encoding}+{compression}' if compression else encoding
+    for encoding in (RESULT_ENCODING_COLUMNAR, RESULT_ENCODING_JSON)
+    for compression in compressions + [None]
+  ]
+
+
+
+def choose_result_encoding(accepted_encodings):
+  """ Returns the first of the accepted result encodings that can be written here, or JSON if there are none """
+
+  supported_encodings = supported_result_encodings()
+  for result_encoding in accepted_encodings or ():
+    if result_encoding in supported_encodings:
+      return result_encoding
+  return RESULT_ENCODING_JSON
+
+
+
+@contextmanager
+def open_result_stream(result_file, result_encoding):
+  """ Opens a stream that writes a battle result to a binary file in an encoding. The result is complete once it's closed. """
+
+  encoding, compression = parse_result_encoding(result_encoding)
+
+  if compression == COMPRESSION_GZIP:
+    encoded_file = gzip.GzipFile(filename='', fileobj=result_file, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+  elif compression == COMPRESSION_ZSTD:
+    if zstandard is None:
+      raise ResultEncodingError('zstd compression needs the zstandard package')
+    encoded_file = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(result_file, closefd=False)
+  else:
+    encoded_file = result_file
+
+  if encoding == RESULT_ENCODING_JSON:
+    # The text wrapper would close the file with it, so it's detached once the result is written
+    text_file = io.TextIOWrapper(encoded_file, encoding=JSON_TEXT_ENCODING)
+    try:
+      yield JsonResultStream(text_file)
+    finally:
+      text_file.flush()
+      text_file.detach()
+  else:
+    yield ColumnarResultStream(encoded_file)
+
+  if encoded_file is not result_file:
+    encoded_file.close()
+
+
+
+def encode_result(result, result_encoding):
+  """ Encodes a whole battle result, returning the bytes """
+
+  result_file = io.BytesIO()
+  with open_result_stream(result_file, result_encoding) as result_stream:
+    result_stream.write_start(result['waveFormat'], result['initial'])
+    for view, wave_writer in zip(VIEWS, result_stream.view_wave_writers()):
+      for wave in result['waves'][view]:
+        wave_writer.append(wave)
+      wave_writer.close()
+    result_stream.write_summary({key: value for key, value in result.items() if key not in ('waveFormat', 'initial', 'waves')})
+  return result_file.getvalue()
+
+
+
+def decode_result(data):
+  """ Decodes a battle result in any encoding """
+
+  if data.startswith(GZIP_MAGIC):
+    data = gzip.decompress(data)
+  elif data.startswith(ZSTD_MAGIC):
+    if zstandard is None:
+      raise ResultEncodingError('result is zstd compressed, and the zstandard package is not installed')
+    data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+
+  if data.startswith(COLUMNAR_MAGIC):
+    return decode_columnar_result(data)
+  return json.loads(data)
+
+
+
+def encode_battle_result(battle_id, encoded_result, result_encoding):
+  """
+  Builds a line of batch results for a result in an encoding other than JSON. It can't be part of a JSON line as it
+  is, so it's stored as base64 along with its encoding.
+  """
+  return {'id': battle_id, 'resultEncoding': result_encoding, 'encodedResult': base64.b64encode(encoded_result).decode('ascii')}
+
+
+
+def decode_battle_result(battle_result):
+  """ Decodes the result in a line of batch results if it's encoded, returning the line as it would be with a JSON result """
+
+  if 'encodedResult' not in battle_result:
+    return battle_result
+
+  battle_result = dict(battle_result)
+  del battle_result['resultEncoding']
+  battle_result['result'] = decode_result(base64.b64decode(battle_result.pop('encodedResult')))
+  return battle_result
+
+
+
+class WaveWriter:
+  """ Writes the waves of a view of a battle to a JSON list in a file as they are built, instead of keeping them """
+
+  def __init__(self, result_file, end):
+    self.result_file = result_file
+    self.end = end
+    self.wave_count = 0
+
+  def append(self, wave):
+    if self.wave_count:
+      self.result_file.write(', ')
+    self.result_file.write(json.dumps(wave))
+    self.wave_count += 1
+
+  def close(self):
+    """ Writes whatever comes after the list of waves """
+    self.result_file.write(self.end)
+
+
+
+class JsonResultStream:
+  """ Writes a battle result to a text file as JSON, a part at a time """
+
+  binary = False
+
+  def __init__(self, result_file):
+    self.result_file = result_file
+
+  def write_start(self, wave_format, initial, unit_ids=None):
+    self.result_file.write('{"waveFormat": ' + json.dumps(wave_format) + ', "initial": ')
+    self.result_file.write(json.dumps(initial))
+
+  def view_wave_writers(self):
+    """ Returns a writer for the waves of each view, which have to be written challenger first """
+    self.result_file.write(', "waves": {"challenger": [')
+    return WaveWriter(self.result_file, end='], "challengee": ['), WaveWriter(self.result_file, end=']}')
+
+  @staticmethod
+  def view_waves_file_writer(waves_file, view, unit_ids):
+    """ Returns a writer for the waves of a view on their own, to be copied into a result with write_view_waves """
+    return WaveWriter(waves_file, end='')
+
+  def write_view_waves(self, challenger_view_waves_file, challengee_view_waves_file):
+    self.result_file.write(', "waves": {"challenger": [')
+    shutil.copyfileobj(challenger_view_waves_file, self.result_file)
+    self.result_file.write('], "challengee": [')
+    shutil.copyfileobj(challengee_view_waves_file, self.result_file)
+    self.result_file.write(']}')
+
+  def write_summary(self, summary):
+    """ Writes the rest of the result, which is only known once the battle is over """
+    for key, value in summary.items():
+      self.result_file.write(', ' + json.dumps(key) + ': ')
+      self.result_file.write(json.dumps(value))
+    self.result_file.write('}')
+
+
+
+class ColumnarResultStream:
+  """ Writes a battle result to a binary file in the columnar encoding, a part at a time """
+
+  binary = True
+
+  def __init__(self, result_file):
+    self.result_file = result_file
+    self.unit_numbers = None
+
+  def write_start(self, wave_format, initial, unit_ids=None):
+    """ Starts the result. Units are numbered in the order of unit_ids, or of the initial manifests without them. """
+
+    if unit_ids is None:
+      unit_ids = {side: list((initial[side].get('manifest') or {}).keys()) for side in VIEWS}
+
+    self.result_file.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION))
+    write_block(self.result_file, BLOCK_PROPERTY, encode_json(['waveFormat', wave_format]))
+    write_block(self.result_file, BLOCK_PROPERTY, encode_json(['initial', initial]))
+    write_block(self.result_file, BLOCK_UNITS, encode_json({side: list(unit_ids[side]) for side in VIEWS}))
+    self.unit_numbers = {side: UnitNumbers(unit_ids[side]) for side in VIEWS}
+
+  def view_wave_writers(self):
+    """ Returns a writer for the waves of each view, which have to be written challenger first """
+    return tuple(ColumnarWaveWriter(self.result_file, view, self.unit_numbers) for view in VIEWS)
+
+  @staticmethod
+  def view_waves_file_writer(waves_file, view, unit_ids):
+    """ Returns a writer for the waves of a view on their own, to be copied into a result with write_view_waves """
+    return ColumnarWaveWriter(waves_file, view, {side: UnitNumbers(unit_ids[side]) for side in VIEWS})
+
+  def write_view_waves(self, challenger_view_waves_file, challengee_view_waves_file):
+    shutil.copyfileobj(challenger_view_waves_file, self.result_file)
+    shutil.copyfileobj(challengee_view_waves_file, self.result_file)
+
+  def write_summary(self, summary):
+    """ Writes the rest of the result, which is only known once the battle is over """
+    for key, value in summary.items():
+      write_block(self.result_file, BLOCK_PROPERTY, encode_json([key, value]))
+
+
+
+class UnitNumbers(dict):
+  """ The numbers of the units of a fleet, keyed by unit id. Ids that aren't numbered yet get the next number. """
+
+  def __init__(self, unit_ids):
+    super().__init__((unit_id, number) for number, unit_id in enumerate(unit_ids))
+    self.unit_count = len(self)
+    self.new_unit_ids = []
+    self[None] = NO_UNIT
+
+  def __missing__(self, unit_id):
+    self[unit_id] = self.unit_count
+    self.unit_count += 1
+    self.new_unit_ids.append(unit_id)
+    return self[unit_id]
+
+
+
+class ColumnarWaveWriter:
+  """ Writes the waves of a view of a battle to a binary file as blocks of the columnar encoding """
+
+  def __init__(self, result_file, view, unit_numbers):
+    self.result_file = result_file
+    self.view = view
+    self.unit_numbers = unit_numbers
+    self.previous_wave = None
+
+  def append(self, wave):
+    attacking_side = self.view
+    defending_side = OPPOSING_VIEW[self.view]
+
+    block = bytearray(BYTE.pack(VIEWS.index(self.view)))
+    block += ROW.pack(wave['attackerRow'])
+
+    interactions = wave['interactions']
+    attacking_unit_numbers = self.unit_numbers[attacking_side]
+    defending_unit_numbers = self.unit_numbers[defending_side]
+    pack_ints(block, 'i', map(attacking_unit_numbers.__getitem__, map(itemgetter('attackerUnit'), interactions)))
+    pack_ints(block, 'i', map(defending_unit_numbers.__getitem__, map(itemgetter('defenderUnit'), interactions)))
+    pack_ints(block, 'b', map(KILLED_CODES.__getitem__, map(itemgetter('killed'), interactions)))
+
+    for fleet_key, side in (('attackerFleet', attacking_side), ('defenderFleet', defending_side)):
+      previous_fleet = self.previous_wave[fleet_key] if self.previous_wave else None
+      pack_fleet(block, wave[fleet_key], previous_fleet, self.unit_numbers[side])
+
+    # Units that weren't numbered yet are written first, so the wave can refer to them
+    new_unit_ids = {side: unit_numbers.new_unit_ids for side, unit_numbers in self.unit_numbers.items() if unit_numbers.new_unit_ids}
+    if new_unit_ids:
+      write_block(self.result_file, BLOCK_UNITS, encode_json({side: new_unit_ids.get(side, []) for side in VIEWS}))
+      for unit_numbers in self.unit_numbers.values():
+        unit_numbers.new_unit_ids = []
+
+    write_block(self.result_file, BLOCK_WAVE, block)
+    self.previous_wave = wave
+
+  def close(self):
+    """ Nothing comes after the waves of a view in the columnar encoding """
+
+
+
+def pack_fleet(block, fleet, previous_fleet, unit_numbers):
+  """ Adds a fleet of a wave to a block, as a snapshot of the fleet or the changes to it """
+
+  if 'formation' not in fleet:
+    block += BYTE.pack(FLEET_DELTA)
+    for name in ('health', 'skip'):
+      pack_ints(block, 'i', map(unit_numbers.__getitem__, fleet[name].keys()))
+      pack_values(block, list(fleet[name].values()))
+    pack_ints(block, 'i', chain.from_iterable(fleet['removed']))
+    return
+
+  block += BYTE.pack(FLEET_SNAPSHOT)
+
+  # Snapshot waves share the formation and manifest of the wave before them when they didn't change
+  formation = fleet['formation']
+  if previous_fleet is not None and (formation is previous_fleet['formation'] or formation == previous_fleet['formation']):
+    block += BYTE.pack(SAME_AS_PREVIOUS_WAVE)
+  else:
+    block += BYTE.pack(WRITTEN)
+    pack_ints(block, 'I', map(len, formation))
+    pack_ints(block, 'i', map(unit_numbers.__getitem__, chain.from_iterable(formation)))
+
+  manifest = fleet['manifest']
+  if previous_fleet is not None and (manifest is previous_fleet['manifest'] or manifest == previous_fleet['manifest']):
+    block += BYTE.pack(SAME_AS_PREVIOUS_WAVE)
+  else:
+    block += BYTE.pack(WRITTEN)
+    pack_bytes(block, encode_json(manifest))
+
+
+
+def decode_columnar_result(data):
+  """ Decodes a battle result in the columnar encoding """
+
+  magic, version = COLUMNAR_HEADER.unpack_from(data)
+  if version != COLUMNAR_VERSION:
+    raise ResultEncodingError(f'columnar result version {version} is not supported')
+
+  result = {}
+  waves = {view: [] for view in VIEWS}
+
+  # Unit ids by number, with None last so slots without a unit come out as None
+  unit_ids = {side: [None] for side in VIEWS}
+
+  offset = COLUMNAR_HEADER.size
+  while offset < len(data):
+    kind, length = BLOCK_HEADER.unpack_from(data, offset)
+    offset += BLOCK_HEADER.size
+    block = memoryview(data)[offset:offset + length]
+    offset += length
+
+    if kind == BLOCK_PROPERTY:
+      key, value = json.loads(bytes(block))
+      result[key] = value
+
+    elif kind == BLOCK_UNITS:
+      result.setdefault('waves', waves)
+      for side, new_unit_ids in json.loads(bytes(block)).items():
+        unit_ids[side][-1:] = new_unit_ids + [None]
+
+    elif kind == BLOCK_WAVE:
+      reader = BlockReader(block)
+      view = VIEWS[reader.read_byte()]
+      view_waves = waves[view]
+      view_waves.append(read_wave(reader, unit_ids[view], unit_ids[OPPOSING_VIEW[view]], view_waves[-1] if view_waves else None))
+
+    else:
+      raise ResultEncodingError(f'unknown block kind {kind} in columnar result')
+
+  return result
+
+
+
+def read_wave(reader, attacking_unit_ids, defending_unit_ids, previous_wave):
+  """ Reads a wave from a block, sharing whatever a snapshot wave shares with the one before it """
+
+  attacker_row = reader.read_row()
+  attacking_units = map(attacking_unit_ids.__getitem__, reader.read_ints('i'))
+  defending_units = map(defending_unit_ids.__getitem__, reader.read_ints('i'))
+  killed = map(KILLED_LABELS.__getitem__, reader.read_ints('b'))
+
+  return {
+    'attackerRow': attacker_row,
+    'attackerFleet': read_fleet(reader, attacking_unit_ids, previous_wave and previous_wave['attackerFleet']),
+    'defenderFleet': read_fleet(reader, defending_unit_ids, previous_wave and previous_wave['defenderFleet']),
+    'interactions': [
+      {'attackerUnit': attacking_unit, 'defenderUnit': defending_unit, 'killed': unit_killed}
+      for attacking_unit, defending_unit, unit_killed in zip(attacking_units, defending_units, killed)
+    ]
+  }
+
+
+
+def read_fleet(reader, unit_ids, previous_fleet):
+  """ Reads a fleet of a wave from a block """
+
+  if reader.read_byte() == FLEET_DELTA:
+    fleet_delta = {}
+    for name in ('health', 'skip'):
+      units = map(unit_ids.__getitem__, reader.read_ints('i'))
+      fleet_delta[name] = dict(zip(units, reader.read_values()))
+    removed = reader.read_ints('i')
+    fleet_delta['removed'] = [[row_idx, unit_idx] for row_idx, unit_idx in zip(removed[0::2], removed[1::2])]
+    return fleet_delta
+
+  if reader.read_byte() == SAME_AS_PREVIOUS_WAVE:
+    formation = previous_fleet['formation']
+  else:
+    row_lengths = reader.read_ints('I')
+    slots = list(map(unit_ids.__getitem__, reader.read_ints('i')))
+    formation = []
+    row_start = 0
+    for row_length in row_lengths:
+      formation.append(slots[row_start:row_start + row_length])
+      row_start += row_length
+
+  if reader.read_byte() == SAME_AS_PREVIOUS_WAVE:
+    manifest = previous_fleet['manifest']
+  else:
+    manifest = json.loads(reader.read_bytes())
+
+  return {'manifest': manifest, 'formation': formation}
+
+
+
+def write_block(result_file, kind, block):
+  result_file.write(BLOCK_HEADER.pack(kind, len(block)))
+  result_file.write(block)
+
+
+
+def encode_json(value):
+  return json.dumps(value, separators=(',', ':')).encode(JSON_TEXT_ENCODING)
+
+
+
+def pack_bytes(block, data):
+  block += COUNT.pack(len(data))
+  block += data
+
+
+
+def pack_ints(block, typecode, values):
+  values = array(typecode, values)
+  if SWAP_BYTES:
+    values.byteswap()
+  block += COUNT.pack(len(values))
+  block += values.tobytes()
+
+
+
+def pack_values(block, values):
+  """ Adds the new values of a unit property, as an array if they're all integers """
+  if all(type(value) is int for value in values):
+    block += BYTE.pack(INT_VALUES)
+    pack_ints(block, 'q', values)
+  else:
+    block += BYTE.pack(JSON_VALUES)
+    pack_bytes(block, encode_json(values))
+
+
+
+class BlockReader:
+  """ Reads the parts of a block in the order they were packed """
+
+  def __init__(self, block):
+    self.block = block
+    self.offset = 0
+
+  def read_byte(self):
+    value, = BYTE.unpack_from(self.block, self.offset)
+    self.offset += BYTE.size
+    return value
+
+  def read_row(self):
+    value, = ROW.unpack_from(self.block, self.offset)
+    self.offset += ROW.size
+    return value
+
+  def read_count(self):
+    value, = COUNT.unpack_from(self.block, self.offset)
+    self.offset += COUNT.size
+    return value
+
+  def read_bytes(self):
+    length = self.read_count()
+    data = bytes(self.block[self.offset:self.offset + length])
+    self.offset += length
+    return data
+
+  def read_ints(self, typecode):
+    values = array(typecode)
+    length = self.read_count() * values.itemsize
+    values.frombytes(self.block[self.offset:self.offset + length])
+    self.offset += length
+    if SWAP_BYTES:
+      values.byteswap()
+    return values
+
+  def read_values(self):
+    if self.read_byte() == INT_VALUES:
+      return self.read_ints('q')
+    return json.loads(self.read_bytes())
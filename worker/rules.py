@@ -0,0 +1,116 @@
+"""
+Unit type specs compiled into lookup tables, so battles between units don't need to interpret the modifiers
+"""
+
+from typing import NamedTuple
+
+from constants import MOD_OPERATOR_FUNCTIONS, UNIT_TYPE_SPECS
+
+
+class CompiledUnitSpecs(NamedTuple):
+  """ Lookup tables for all unit types, indexed by type code """
+  type_names: tuple
+  type_codes: dict
+  health: list
+  skip: list
+  base_dmg: list
+  damage: list  # damage[attacker_code][defender_code], or None if it depends on more than the unit types
+
+
+def compile_unit_specs(unit_type_specs=UNIT_TYPE_SPECS):
+  """ Compiles the unit type specs into lookup tables """
+
+  type_names = tuple(unit_type_specs.keys())
+  type_codes = {type_name: type_code for type_code, type_name in enumerate(type_names)}
+  stats = [unit_type_specs[type_name]['stats'] for type_name in type_names]
+
+  damage = []
+  for attacker_type_name, attacker_stats in zip(type_names, stats):
+    damage.append([
+      compile_damage(attacker_stats, attacker_type_name, defender_stats, defender_type_name)
+      for defender_type_name, defender_stats in zip(type_names, stats)
+    ])
+
+  return CompiledUnitSpecs(
+    type_names=type_names,
+    type_codes=type_codes,
+    health=[unit_stats['health'] for unit_stats in stats],
+    skip=[unit_stats.get('skip', 0) for unit_stats in stats],
+    base_dmg=[unit_stats['base_dmg'] for unit_stats in stats],
+    damage=damage
+  )
+
+
+def compile_damage(attacker_stats, attacker_type_name, defender_stats, defender_type_name):
+  """ Determines the damage a unit of one type does to a unit of another type, if it only depends on their types """
+
+  modifiers = (
+    [(attack_modifier, defender_type_name) for attack_modifier in attacker_stats['modifiers']['attack']] +
+    [(defense_modifier, attacker_type_name) for defense_modifier in defender_stats['modifiers']['defense']]
+  )
+
+  # Modifiers that match on any other property have to be interpreted for every battle
+  if any(modifier['property'] != 'type' for modifier, _ in modifiers):
+    return None
+
+  # Apply the attack modifiers of the attacker, then the defense modifiers of the defender
+  damage = attacker_stats['base_dmg']
+  for modifier, other_type_name in modifiers:
+    if MOD_OPERATOR_FUNCTIONS[modifier['operator']](other_type_name, modifier['match']):
+      damage = MOD_OPERATOR_FUNCTIONS[modifier['action']['operator']](damage, modifier['action']['value'])
+
+  return damage
+
+
+def interpret_damage(attacker, defender, unit_type_specs=UNIT_TYPE_SPECS):
+  """ Determines the damage one unit does to another by interpreting the modifiers in the unit type specs """
+
+  attacker_stats = unit_type_specs[attacker.get('type')]['stats']
+  defender_stats = unit_type_specs[defender.get('type')]['stats']
+
+  damage = attacker_stats['base_dmg']
+
+  # Calculate the attack modifier effects
+  for attack_modifier in attacker_stats['modifiers']['attack']:
+    if MOD_OPERATOR_FUNCTIONS[attack_modifier['operator']](defender[attack_modifier['property']], attack_modifier['match']):
+      damage = MOD_OPERATOR_FUNCTIONS[attack_modifier['action']['operator']](damage, attack_modifier['action']['value'])
+
+  # Calculate the defense modifier effects
+  for defense_modifier in defender_stats['modifiers']['defense']:
+    if MOD_OPERATOR_FUNCTIONS[defense_modifier['operator']](attacker[defense_modifier['property']], defense_modifier['match']):
+      damage = MOD_OPERATOR_FUNCTIONS[defense_modifier['action']['operator']](damage, defense_modifier['action']['value'])
+
+  return damage
+
+
+def verify_compiled_unit_specs(compiled_unit_specs, unit_type_specs=UNIT_TYPE_SPECS):
+  """ Checks that the compiled damage table agrees with the interpreted modifiers for every pair of unit types """
+
+  for attacker_code, attacker_type_name in enumerate(compiled_unit_specs.type_names):
+    for defender_code, defender_type_name in enumerate(compiled_unit_specs.type_names):
+
+      compiled_damage = compiled_unit_specs.damage[attacker_code][defender_code]
+      if compiled_damage is None:
+        continue
+
+      # Units in their initial state, since a compiled damage can only depend on the unit types
+      attacker = new_unit(attacker_type_name, unit_type_specs)
+      defender = new_unit(defender_type_name, unit_type_specs)
+
+      interpreted_damage = interpret_damage(attacker, defender, unit_type_specs)
+      if compiled_damage != interpreted_damage:
+        raise ValueError(f'compiled damage of {attacker_type_name} to {defender_type_name} is {compiled_damage}, but interpreted damage is {interpreted_damage}')
+
+
+def new_unit(type_name, unit_type_specs=UNIT_TYPE_SPECS):
+  """ Returns a unit of a type with its consumable properties in their initial state """
+  return {
+    'type': type_name,
+    'health': unit_type_specs[type_name]['stats']['health'],
+    'skip': unit_type_specs[type_name]['stats'].get('skip', 0)
+  }
+
+
+# Compile the unit type specs once, when the worker starts
+COMPILED_UNIT_SPECS = compile_unit_specs()
+verify_compiled_unit_specs(COMPILED_UNIT_SPECS)
@@ -0,0 +1,225 @@
+"""
+Validation of the fleets of battles. The requestors check battles before they're sent to be run, and the worker checks
+them again before running them, so fleets the battle engine can't run are turned away with everything that's wrong with
+them, instead of failing part way through the battle.
+
+Validating also normalizes the fleets: rows narrower than the grid are filled out with empty slots at the end, which is
+what a row with its trailing empty slots left out means. Fleets that don't need it are returned as they are.
+"""
+
+from itertools import chain
+from typing import NamedTuple
+
+from constants import UNIT_TYPE_SPECS
+
+SIDES = ('challenger', 'challengee')
+
+UNIT_TYPE_NAMES = frozenset(UNIT_TYPE_SPECS)
+
+# Unit ids the battle engine can place in a slot. Ids that aren't in the manifest stay in the formation but never battle.
+SLOT_TYPES = frozenset((type(None), str, int))
+
+# Only this many problems are kept, so a huge broken fleet doesn't make a huge error
+MAX_PROBLEMS = 100
+
+# Problems shown in the message of an error, with the rest only counted
+MAX_MESSAGE_PROBLEMS = 3
+
+
+class FleetProblem(NamedTuple):
+  """ Something wrong with a fleet, and where in the fleet it is, such as ['manifest', '7', 'type'] or ['formation', 2, 1] """
+  fleet: str
+  path: list
+  code: str
+  message: str
+
+  def to_dict(self):
+    return dict(self._asdict())
+
+  def __str__(self):
+    return self.fleet + ''.join(f'[{step!r}]' for step in self.path) + f': {self.message}'
+
+
+class InvalidBattleError(ValueError):
+  """ Fleets that can't battle, with the problems found in them """
+
+  def __init__(self, problems):
+    self.problems = problems
+    message = '; '.join(str(problem) for problem in problems[:MAX_MESSAGE_PROBLEMS])
+    if len(problems) > MAX_MESSAGE_PROBLEMS:
+      message += f' (and {len(problems) - MAX_MESSAGE_PROBLEMS} more)'
+    super().__init__(message)
+
+  def problem_dicts(self):
+    return [problem.to_dict() for problem in self.problems]
+
+
+class BattleTerms(NamedTuple):
+  """
+  The terms of a challenge, which both of its fleets have to keep to. Terms that are None aren't checked.
+  In a battle or fleets file, they're the 'terms' object with 'units', 'gridWidth' and 'gridHeight'.
+  """
+  units: int = None
+  grid_width: int = None
+  grid_height: int = None
+
+  @classmethod
+  def from_dict(cls, terms):
+    if terms is None:
+      return None
+    return cls(units=terms.get('units'), grid_width=terms.get('gridWidth'), grid_height=terms.get('gridHeight'))
+
+  def to_dict(self):
+    return {'units': self.units, 'gridWidth': self.grid_width, 'gridHeight': self.grid_height}
+
+
+
+def normalize_battle(battle):
+  """
+  Validates and normalizes the fleets of a battle, or of a fleets file, holding the 'challenger' and 'challengee' fleets
+  and optionally the 'terms' of its challenge. Returns the battle with its fleets normalized, or raises an
+  InvalidBattleError with every problem found.
+  """
+
+  (challenger_fleet, challengee_fleet), problems = validate_fleets(
+    battle.get('challenger'), battle.get('challengee'), BattleTerms.from_dict(battle.get('terms')))
+  if problems:
+    raise InvalidBattleError(problems)
+
+  if challenger_fleet is battle.get('challenger') and challengee_fleet is battle.get('challengee'):
+    return battle
+  return dict(battle, challenger=challenger_fleet, challengee=challengee_fleet)
+
+
+
+def normalize_fleets(challenger_fleet, challengee_fleet, terms=None):
+  """ Validates and normalizes the fleets of a battle, returning them normalized or raising an InvalidBattleError """
+
+  fleets, problems = validate_fleets(challenger_fleet, challengee_fleet, terms)
+  if problems:
+    raise InvalidBattleError(problems)
+  return fleets
+
+
+
+def validate_fleets(challenger_fleet, challengee_fleet, terms=None):
+  """
+  Checks that both fleets of a battle can battle, returning the fleets normalized and a list of FleetProblems, which is
+  empty if they can.
+
+  Every fleet needs a formation that is a list of rows of unit ids, and a manifest of units with known types. With
+  terms, both fleets also have to fit in the grid and have no more units than the terms allow, and every unit in the
+  manifest has to be in exactly one slot of the formation.
+  """
+
+  problems = []
+  fleets = [challenger_fleet, challengee_fleet]
+  checked = [check_fleet(side, fleet, terms, problems) for side, fleet in zip(SIDES, fleets)]
+
+  if problems:
+    return tuple(fleets), problems[:MAX_PROBLEMS]
+
+  # Units only battle the unit in the mirrored slot of a row as wide as theirs, so every row is made as wide as the grid
+  width = terms.grid_width if terms is not None and terms.grid_width is not None else None
+  if width is None:
+    width = max((len(row) for row in chain(challenger_fleet['formation'], challengee_fleet['formation'])), default=0)
+
+  for idx, row_widths in enumerate(checked):
+    if any(row_width != width for row_width in row_widths):
+      fleet = fleets[idx]
+      fleets[idx] = dict(fleet, formation=[row if len(row) == width else row + [None] * (width - len(row)) for row in fleet['formation']])
+
+  return tuple(fleets), problems
+
+
+
+def check_fleet(side, fleet, terms, problems):
+  """ Adds the problems with a fleet to a list, returning the set of widths of its rows """
+
+  if not isinstance(fleet, dict):
+    problems.append(FleetProblem(side, [], 'not_a_fleet', 'fleet is missing' if fleet is None else 'fleet is not an object'))
+    return set()
+  problem_count = len(problems)
+
+  formation = fleet.get('formation')
+  manifest = fleet.get('manifest')
+  if not isinstance(formation, list):
+    problems.append(FleetProblem(side, ['formation'], 'bad_formation', 'formation is not a list of rows'))
+  if not isinstance(manifest, dict):
+    problems.append(FleetProblem(side, ['manifest'], 'bad_manifest', 'manifest is not an object of units by id'))
+  if len(problems) > problem_count:
+    return set()
+
+  # Everything is checked all at once first, and only looked at one by one to find the problems if something is wrong
+  rows_ok = all(type(row) is list for row in formation)
+  if not rows_ok:
+    for row_idx, row in enumerate(formation):
+      if type(row) is not list:
+        problems.append(FleetProblem(side, ['formation', row_idx], 'bad_row', 'row is not a list of unit ids'))
+
+  slots_ok = rows_ok and {type(unit_id) for unit_id in chain.from_iterable(formation)} <= SLOT_TYPES
+  if rows_ok and not slots_ok:
+    for row_idx, row in enumerate(formation):
+      for slot_idx, unit_id in enumerate(row):
+        if type(unit_id) not in SLOT_TYPES:
+          problems.append(FleetProblem(side, ['formation', row_idx, slot_idx], 'bad_slot', f'slot holds {unit_id!r} instead of a unit id or null'))
+
+  try:
+    types_ok = {unit['type'] for unit in manifest.values()} <= UNIT_TYPE_NAMES
+  except (TypeError, KeyError):
+    types_ok = False
+  if not types_ok:
+    for unit_id, unit in manifest.items():
+      if not isinstance(unit, dict):
+        problems.append(FleetProblem(side, ['manifest', unit_id], 'bad_unit', 'unit is not an object'))
+      elif 'type' not in unit:
+        problems.append(FleetProblem(side, ['manifest', unit_id, 'type'], 'unknown_type', 'unit has no type'))
+      elif not isinstance(unit['type'], str) or unit['type'] not in UNIT_TYPE_NAMES:
+        problems.append(FleetProblem(side, ['manifest', unit_id, 'type'], 'unknown_type', f"unknown unit type {unit['type']!r}"))
+
+  # Slots are only checked against the terms if they hold unit ids
+  if terms is not None and slots_ok:
+    check_fleet_terms(side, formation, manifest, terms, problems)
+
+  return {len(row) for row in formation} if rows_ok else set()
+
+
+
+def check_fleet_terms(side, formation, manifest, terms, problems):
+  """ Adds the ways a fleet breaks the terms of its challenge to a list of problems """
+
+  if terms.grid_height is not None and len(formation) > terms.grid_height:
+    problems.append(FleetProblem(side, ['formation'], 'too_many_rows', f'formation has {len(formation)} rows, more than the {terms.grid_height} in the grid'))
+
+  if terms.grid_width is not None:
+    for row_idx, row in enumerate(formation):
+      if len(row) > terms.grid_width:
+        problems.append(FleetProblem(side, ['formation', row_idx], 'row_too_wide', f'row has {len(row)} slots, more than the {terms.grid_width} in the grid'))
+
+  if terms.units is not None and len(manifest) > terms.units:
+    problems.append(FleetProblem(side, ['manifest'], 'too_many_units', f'fleet has {len(manifest)} units, more than the {terms.units} allowed'))
+
+  # Every unit is in exactly one slot, which is the case when there are as many units placed as there are different ones,
+  # and they're the units in the manifest
+  placed_unit_count = sum(len(row) - row.count(None) for row in formation)
+  placed_unit_ids = set(chain.from_iterable(formation))
+  placed_unit_ids.discard(None)
+  if placed_unit_count == len(placed_unit_ids) and placed_unit_ids == manifest.keys():
+    return
+
+  if placed_unit_count != len(placed_unit_ids) or not placed_unit_ids <= manifest.keys():
+    seen = set()
+    for row_idx, row in enumerate(formation):
+      for slot_idx, unit_id in enumerate(row):
+        if unit_id is None:
+          continue
+        if unit_id in seen:
+          problems.append(FleetProblem(side, ['formation', row_idx, slot_idx], 'unit_placed_twice', f'unit {unit_id!r} is already in another slot'))
+        elif unit_id not in manifest:
+          problems.append(FleetProblem(side, ['formation', row_idx, slot_idx], 'unit_not_in_manifest', f'unit {unit_id!r} is not in the manifest'))
+        seen.add(unit_id)
+
+  if not manifest.keys() <= placed_unit_ids:
+    for unit_id in manifest:
+      if unit_id not in placed_unit_ids:
+        problems.append(FleetProblem(side, ['manifest', unit_id], 'unit_not_placed', f'unit {unit_id!r} is not in the formation'))
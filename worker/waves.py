@@ -0,0 +1,98 @@
+"""
+Wave formats that battle results can be returned in, and a decoder for the compact delta format
+"""
+
+import copy
+
+# Every wave holds a full snapshot of both fleets (the original format)
+WAVE_FORMAT_SNAPSHOT = 1
+
+# The initial state of both fleets is stored once and every wave only holds what changed
+WAVE_FORMAT_DELTA = 2
+
+WAVE_FORMATS = (WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA)
+
+# The fleet on the other side of each view
+OPPOSING_VIEW = {
+  'challenger': 'challengee',
+  'challengee': 'challenger'
+}
+
+# The unit killed in an interaction, indexed by if the attacker was killed plus 2 if the defender was killed
+KILLED_LABELS = (None, 'attacker', 'defender', 'both')
+
+
+def new_fleet_delta():
+  """ Returns an empty set of changes to a fleet for a single wave """
+  return {
+    'health': {},
+    'skip': {},
+    'removed': []
+  }
+
+
+def decode_wave(result, view, wave_idx):
+  """ Rebuilds a single wave of a delta encoded battle result as a full snapshot """
+
+  waves = result['waves'][view]
+  if wave_idx < 0 or wave_idx >= len(waves):
+    raise IndexError(f'wave {wave_idx} is out of range for a battle with {len(waves)} waves')
+
+  attacking_fleet, defending_fleet = get_initial_fleets(result, view)
+
+  # Apply the changes from every wave up to and including the requested one
+  for wave in waves[:wave_idx + 1]:
+    apply_fleet_delta(attacking_fleet, wave['attackerFleet'])
+    apply_fleet_delta(defending_fleet, wave['defenderFleet'])
+
+  return {
+    'attackerRow': waves[wave_idx]['attackerRow'],
+    'attackerFleet': attacking_fleet,
+    'defenderFleet': defending_fleet,
+    'interactions': waves[wave_idx]['interactions']
+  }
+
+
+def iter_decoded_waves(result, view):
+  """ Yields every wave of a delta encoded battle result as a full snapshot, in order """
+
+  attacking_fleet, defending_fleet = get_initial_fleets(result, view)
+
+  for wave in result['waves'][view]:
+
+    # Apply the changes from this wave on top of the previous one
+    apply_fleet_delta(attacking_fleet, wave['attackerFleet'])
+    apply_fleet_delta(defending_fleet, wave['defenderFleet'])
+
+    yield {
+      'attackerRow': wave['attackerRow'],
+      'attackerFleet': copy.deepcopy(attacking_fleet),
+      'defenderFleet': copy.deepcopy(defending_fleet),
+      'interactions': wave['interactions']
+    }
+
+
+def get_initial_fleets(result, view):
+  """ Returns copies of the initial attacking and defending fleets for a view of a delta encoded result """
+
+  if result.get('waveFormat') != WAVE_FORMAT_DELTA:
+    raise ValueError(f"result is not delta encoded (waveFormat {result.get('waveFormat')})")
+
+  return (
+    copy.deepcopy(result['initial'][view]),
+    copy.deepcopy(result['initial'][OPPOSING_VIEW[view]])
+  )
+
+
+def apply_fleet_delta(fleet, fleet_delta):
+  """ Applies the changes to a fleet from a single wave """
+
+  manifest = fleet['manifest']
+  for unit_id, health in fleet_delta['health'].items():
+    manifest[unit_id]['health'] = health
+  for unit_id, skip in fleet_delta['skip'].items():
+    manifest[unit_id]['skip'] = skip
+
+  formation = fleet['formation']
+  for row_idx, unit_idx in fleet_delta['removed']:
+    formation[row_idx][unit_idx] = None
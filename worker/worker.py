@@ -1,22 +1,50 @@
 #!/usr/bin/env python3
 
+import io
+import os
 import json
 import uuid
 import copy
-
+import time
+import shutil
+import argparse
+import tempfile
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
 from pathlib import Path
 from typing import NamedTuple
 
-from constants import MOD_OPERATOR_FUNCTIONS, UNIT_TYPE_SPECS
+from fleet_arrays import EMPTY_SLOT, fleet_to_arrays
+from kernel import KERNEL_MIN_ROW_WIDTH, RowCollisions, collide_rows, fleet_views, is_kernel_available
+from metrics import (PHASE_LOAD, PHASE_VALIDATE, PHASE_INIT, PHASE_FINAL_STATES, PHASE_SERIALIZE, PHASE_WRITE, VIEW_PHASES,
+  BattleMetrics, copied_size, timed, timed_waves)
+from result_encoding import RESULT_ENCODING_JSON, JsonResultStream, choose_result_encoding, encode_battle_result, open_result_stream
+from rules import COMPILED_UNIT_SPECS, interpret_damage
+from validation import InvalidBattleError, normalize_battle, normalize_fleets
+from waves import WAVE_FORMAT_SNAPSHOT, WAVE_FORMAT_DELTA, WAVE_FORMATS, KILLED_LABELS, new_fleet_delta
 
 ENCODING = "utf-8"
 
 FLEETS_PATH = Path("/golem/input/fleets.json")
 RESULT_PATH = Path("/golem/output/result.json")
 
+# The metrics of the battle, if its fleets file asks for them with 'collectMetrics' (see metrics.py)
+METRICS_PATH = Path("/golem/output/metrics.json")
+
+# Batches of battles, one JSON object per line, keyed by challenge id
+BATTLES_PATH = Path("/golem/input/battles.jsonl")
+RESULTS_PATH = Path("/golem/output/results.jsonl")
+
 # FOR TESTING
 #FLEETS_PATH = Path("../test/data/fleets.json")
 #RESULT_PATH = Path("../test/data/result.json")
+#BATTLES_PATH = Path("../test/data/battles.jsonl")
+#RESULTS_PATH = Path("../test/data/results.jsonl")
+
+# Battles with fewer units than this are processed faster in a single process, since starting processes has a cost
+PARALLEL_VIEWS_MIN_UNITS = 10000
 
 
 class FleetBattleResult(NamedTuple):
@@ -32,47 +60,380 @@ class FleetBattleResult(NamedTuple):
   defending_fleet_civilian_kills: int
 
 
-def determine_battle_result(challenger_fleet, challengee_fleet):
-  """ Determines the result of a battle between two fleets """
+def determine_battle_result(challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT, shared_pass=True, vectorized=True, metrics=None):
+  """ Determines the result of a battle between two fleets, collecting its metrics if it's given them (see metrics.py) """
 
-  # Save the initial state of the fleets
-  initial = {
-    'challenger': copy.deepcopy(challenger_fleet),
-    'challengee': copy.deepcopy(challengee_fleet)
-  }
+  with timed(metrics, PHASE_VALIDATE):
+    challenger_fleet, challengee_fleet = normalize_fleets(challenger_fleet, challengee_fleet)
 
-  # Get the unit lookup tables for each fleet
-  challenger_fleet_unit_map = challenger_fleet.get('manifest')
-  challengee_fleet_unit_map = challengee_fleet.get('manifest')
-  
-  # Get the formations
-  challenger_fleet_formation = challenger_fleet.get('formation')
-  challengee_fleet_formation = challengee_fleet.get('formation')
-
-   # Set initial values of all comsumable properties of all units in both fleets
-  for unit_key in challenger_fleet_unit_map.keys():
-    challenger_fleet_unit_map[unit_key]['health'] = UNIT_TYPE_SPECS[challenger_fleet_unit_map[unit_key]['type']]['stats']['health']
-    challenger_fleet_unit_map[unit_key]['skip'] = UNIT_TYPE_SPECS[challenger_fleet_unit_map[unit_key]['type']]['stats'].get('skip', 0)
-  for unit_key in challengee_fleet_unit_map.keys():
-    challengee_fleet_unit_map[unit_key]['health'] = UNIT_TYPE_SPECS[challengee_fleet_unit_map[unit_key]['type']]['stats']['health']
-    challengee_fleet_unit_map[unit_key]['skip'] = UNIT_TYPE_SPECS[challengee_fleet_unit_map[unit_key]['type']]['stats'].get('skip', 0)
-
-  challenger_view_battle_result = process_fleet_to_fleet_action(
-    attacking_fleet_formation=copy.deepcopy(challenger_fleet_formation), 
-    attacking_fleet_unit_map=copy.deepcopy(challenger_fleet_unit_map), 
-    defending_fleet_formation=copy.deepcopy(challengee_fleet_formation), 
-    defending_fleet_unit_map=copy.deepcopy(challengee_fleet_unit_map), 
-    attacking_fleet_is_challenger=True)
-
-  challengee_view_battle_result = process_fleet_to_fleet_action(
-    attacking_fleet_formation=copy.deepcopy(challengee_fleet_formation), 
-    attacking_fleet_unit_map=copy.deepcopy(challengee_fleet_unit_map), 
-    defending_fleet_formation=copy.deepcopy(challenger_fleet_formation), 
-    defending_fleet_unit_map=copy.deepcopy(challenger_fleet_unit_map), 
-    attacking_fleet_is_challenger=False)
+  with timed(metrics, PHASE_INIT):
+    challenger_fleet_arrays, challengee_fleet_arrays = battle_fleets_to_arrays(challenger_fleet, challengee_fleet, wave_format)
+
+    # Save the initial state of the fleets.
+    # Delta encoded waves only hold changes to the consumable properties, so their initial values are saved too
+    if wave_format == WAVE_FORMAT_DELTA:
+      initial = {
+        'challenger': challenger_fleet_arrays.to_fleet(),
+        'challengee': challengee_fleet_arrays.to_fleet()
+      }
+    else:
+      initial = {
+        'challenger': copy.deepcopy(challenger_fleet),
+        'challengee': copy.deepcopy(challengee_fleet)
+      }
+
+  if metrics is not None:
+    count_battle_units(metrics, challenger_fleet, challengee_fleet)
+    if wave_format != WAVE_FORMAT_DELTA:
+      metrics.counts['deepcopyBytes'] += copied_size(initial)
+
+  challenger_view_battle_result, challengee_view_battle_result = process_battle_views(
+    challenger_fleet_arrays, challengee_fleet_arrays, wave_format, shared_pass, vectorized, metrics=metrics)
+  battle_summary = build_battle_summary(challenger_view_battle_result, challengee_view_battle_result)
 
   return {
+    'waveFormat': wave_format,
     'initial': initial,
+    'final': battle_summary['final'],
+    'waves': {
+      'challenger': challenger_view_battle_result.attacking_fleet_waves,
+      'challengee': challengee_view_battle_result.attacking_fleet_waves
+    },
+    'score': battle_summary['score'],
+    'winner': battle_summary['winner']
+  }
+
+
+
+def write_battle_result(result_file, challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT, shared_pass=True, vectorized=True, processes=1,
+  metrics=None):
+  """
+  Determines the result of a battle between two fleets and writes it to a file as JSON, one wave at a time.
+  The result is the same as from determine_battle_result, but only a single wave is kept in memory.
+  With more than one process, the views of a large battle are processed at the same time.
+  """
+  write_battle_result_stream(JsonResultStream(result_file), challenger_fleet, challengee_fleet, wave_format, shared_pass, vectorized, processes, metrics)
+
+
+
+def write_encoded_battle_result(result_file, challenger_fleet, challengee_fleet, result_encoding, wave_format=WAVE_FORMAT_SNAPSHOT,
+  shared_pass=True, vectorized=True, processes=1, metrics=None):
+  """ Like write_battle_result, but writes the result to a binary file in any of the result encodings """
+
+  # Compressed results are finished when the stream is closed, which is part of encoding them
+  with timed(metrics, PHASE_SERIALIZE), open_result_stream(result_file, result_encoding) as result_stream:
+    write_battle_result_stream(result_stream, challenger_fleet, challengee_fleet, wave_format, shared_pass, vectorized, processes, metrics)
+
+
+
+def write_battle_result_stream(result_stream, challenger_fleet, challengee_fleet, wave_format=WAVE_FORMAT_SNAPSHOT, shared_pass=True, vectorized=True, processes=1,
+  metrics=None):
+  """ Determines the result of a battle between two fleets and writes it to a result stream (see result_encoding.py), one wave at a time """
+
+  with timed(metrics, PHASE_VALIDATE):
+    challenger_fleet, challengee_fleet = normalize_fleets(challenger_fleet, challengee_fleet)
+
+  with timed(metrics, PHASE_INIT):
+    challenger_fleet_arrays, challengee_fleet_arrays = battle_fleets_to_arrays(challenger_fleet, challengee_fleet, wave_format)
+    if wave_format == WAVE_FORMAT_DELTA:
+      initial = {'challenger': challenger_fleet_arrays.to_fleet(), 'challengee': challengee_fleet_arrays.to_fleet()}
+    else:
+      initial = {'challenger': challenger_fleet, 'challengee': challengee_fleet}
+
+  if metrics is not None:
+    count_battle_units(metrics, challenger_fleet, challengee_fleet)
+
+  with timed(metrics, PHASE_SERIALIZE):
+    result_stream.write_start(wave_format, initial, {'challenger': challenger_fleet_arrays.unit_ids, 'challengee': challengee_fleet_arrays.unit_ids})
+
+  if processes > 1 and len(challenger_fleet_arrays.unit_ids) + len(challengee_fleet_arrays.unit_ids) >= PARALLEL_VIEWS_MIN_UNITS:
+    challenger_view_battle_result, challengee_view_battle_result = write_battle_views_in_parallel(
+      result_stream, challenger_fleet_arrays, challengee_fleet_arrays, wave_format, vectorized, metrics)
+  else:
+    challenger_view_battle_result, challengee_view_battle_result = write_battle_views(
+      result_stream, challenger_fleet_arrays, challengee_fleet_arrays, wave_format, shared_pass, vectorized, metrics)
+
+  # The rest of the result is only known once the battle is over
+  battle_summary = build_battle_summary(challenger_view_battle_result, challengee_view_battle_result)
+  with timed(metrics, PHASE_SERIALIZE):
+    result_stream.write_summary(battle_summary)
+
+
+
+def count_battle_units(metrics, challenger_fleet, challengee_fleet):
+  metrics.counts['units'] += len(challenger_fleet['manifest']) + len(challengee_fleet['manifest'])
+
+
+
+def write_battle_views(result_stream, challenger_fleet_arrays, challengee_fleet_arrays, wave_format, shared_pass=True, vectorized=True, metrics=None):
+  """ Processes both views of a battle, one after the other, writing their waves to a result stream as they are built """
+
+  # Snapshot waves hold the final manifests of the fleets, so those have to be known before any wave can be written.
+  # They come from processing the battle once without keeping its waves. The cheaper delta format gives the same final states.
+  challenger_view_unit_maps = challengee_view_unit_maps = (None, None)
+  if wave_format == WAVE_FORMAT_SNAPSHOT:
+    with timed(metrics, PHASE_FINAL_STATES):
+      challenger_view_battle_result, challengee_view_battle_result = process_battle_views(
+        challenger_fleet_arrays.copy(), challengee_fleet_arrays.copy(), WAVE_FORMAT_DELTA, shared_pass, vectorized,
+        challenger_view_waves=deque(maxlen=0), challengee_view_waves=deque(maxlen=0))
+    challenger_view_unit_maps = (challenger_view_battle_result.final_attacking_fleet_unit_map, challenger_view_battle_result.final_defending_fleet_unit_map)
+    challengee_view_unit_maps = (challengee_view_battle_result.final_attacking_fleet_unit_map, challengee_view_battle_result.final_defending_fleet_unit_map)
+
+  challenger_view_waves, challengee_view_waves = (timed_waves(waves, metrics) for waves in result_stream.view_wave_writers())
+  challenger_view_battle_result, challengee_view_battle_result = process_battle_views(
+    challenger_fleet_arrays, challengee_fleet_arrays, wave_format, shared_pass, vectorized,
+    challenger_view_waves=challenger_view_waves, challengee_view_waves=challengee_view_waves,
+    challenger_view_unit_maps=challenger_view_unit_maps, challengee_view_unit_maps=challengee_view_unit_maps, metrics=metrics)
+
+  return challenger_view_battle_result, challengee_view_battle_result
+
+
+
+def write_battle_views_in_parallel(result_stream, challenger_fleet_arrays, challengee_fleet_arrays, wave_format, vectorized=True, metrics=None):
+  """
+  Processes both views of a battle at the same time, in their own processes, then writes their waves to a result stream.
+  Each view is processed in full, since the challengee's view can't be replayed until the challenger's view is done.
+  """
+
+  # Each view's waves are written the way the result stream writes them, to be copied into it in order
+  result_stream_type = type(result_stream)
+  unit_ids = {'challenger': challenger_fleet_arrays.unit_ids, 'challengee': challengee_fleet_arrays.unit_ids}
+
+  with tempfile.TemporaryDirectory() as waves_dir, ProcessPoolExecutor(max_workers=2) as pool:
+    challenger_view_waves_path = os.path.join(waves_dir, 'challenger')
+    challengee_view_waves_path = os.path.join(waves_dir, 'challengee')
+    challenger_view_future = pool.submit(write_battle_view_waves,
+      challenger_fleet_arrays, challengee_fleet_arrays, wave_format, vectorized, challenger_view_waves_path,
+      'challenger', result_stream_type, unit_ids, metrics is not None)
+    challengee_view_future = pool.submit(write_battle_view_waves,
+      challengee_fleet_arrays, challenger_fleet_arrays, wave_format, vectorized, challengee_view_waves_path,
+      'challengee', result_stream_type, unit_ids, metrics is not None)
+    challenger_view_battle_result, challenger_view_metrics = challenger_view_future.result()
+    challengee_view_battle_result, challengee_view_metrics = challengee_view_future.result()
+
+    # Each view was timed in its own process
+    if metrics is not None:
+      metrics.merge(challenger_view_metrics)
+      metrics.merge(challengee_view_metrics)
+
+    with timed(metrics, PHASE_WRITE), open_waves_file(challenger_view_waves_path, result_stream.binary) as challenger_view_waves_file, \
+      open_waves_file(challengee_view_waves_path, result_stream.binary) as challengee_view_waves_file:
+      result_stream.write_view_waves(challenger_view_waves_file, challengee_view_waves_file)
+
+  return challenger_view_battle_result, challengee_view_battle_result
+
+
+
+def open_waves_file(waves_path, binary, mode="r"):
+  """ Opens a file of the waves of a view, which is binary for the result streams that are """
+  if binary:
+    return open(waves_path, mode=mode + "b")
+  return open(waves_path, mode=mode, encoding=ENCODING)
+
+
+
+def write_battle_view_waves(attacking_fleet, defending_fleet, wave_format, vectorized, waves_path, view, result_stream_type, unit_ids,
+  collect_metrics=False):
+  """
+  Processes a view of a battle, writing its waves to a file the way a type of result stream writes them.
+  Returns the result of the view without its waves, and the metrics of the view if they're collected.
+  """
+
+  # The collisions of the battle are only counted once, from the challenger's view
+  metrics = BattleMetrics() if collect_metrics else None
+  view_metrics = metrics if view == 'challenger' else None
+
+  # Snapshot waves hold the final manifests of the fleets, which come from processing the view once without its waves
+  unit_maps = (None, None)
+  if wave_format == WAVE_FORMAT_SNAPSHOT:
+    with timed(metrics, PHASE_FINAL_STATES):
+      view_battle_result = process_fleet_arrays_action(attacking_fleet.copy(), defending_fleet.copy(), WAVE_FORMAT_DELTA,
+        vectorized=vectorized, waves=deque(maxlen=0))
+    unit_maps = (view_battle_result.final_attacking_fleet_unit_map, view_battle_result.final_defending_fleet_unit_map)
+
+  with open_waves_file(waves_path, result_stream_type.binary, mode="w") as waves_file, timed(metrics, VIEW_PHASES[view]):
+    view_battle_result = process_fleet_arrays_action(attacking_fleet, defending_fleet, wave_format,
+      vectorized=vectorized, waves=timed_waves(result_stream_type.view_waves_file_writer(waves_file, view, unit_ids), metrics),
+      unit_maps=unit_maps, metrics=view_metrics)
+
+  return view_battle_result._replace(attacking_fleet_waves=None), metrics
+
+
+
+def write_battle_batch_results(battles_file, results_file, processes=1):
+  """
+  Determines the results of a batch of battles and writes them to a file, one JSON object per line.
+  Every line of the battles file holds the 'id' of a battle with its 'challenger' and 'challengee' fleets, and optionally
+  a 'waveFormat', the 'resultEncodings' it accepts, the 'terms' of its challenge (see validation.py) and 'collectMetrics'.
+  Each line of the results holds the 'id' with either the 'result' or the 'error' of the battle, along with the 'problems'
+  found in fleets that can't battle, and the 'metrics' of battles that asked for them (see metrics.py).
+  With more than one process, battles are processed at the same time and their results are written in order.
+  """
+
+  # Battles are parsed as they're run, so the time it takes is part of their metrics
+  battle_lines = [line for line in battles_file if line.strip()]
+
+  # A single battle can still use every process for its views
+  if processes <= 1 or len(battle_lines) == 1:
+    for battle_line in battle_lines:
+      write_battle_result_line(results_file, battle_line, processes)
+    return len(battle_lines)
+
+  with tempfile.TemporaryDirectory() as results_dir, ProcessPoolExecutor(max_workers=processes) as pool:
+    results_paths = pool.map(write_battle_result_line_file, battle_lines, [results_dir] * len(battle_lines))
+    for results_path in results_paths:
+      with open(results_path, encoding=ENCODING) as battle_results_file:
+        shutil.copyfileobj(battle_results_file, results_file)
+      os.remove(results_path)
+
+  return len(battle_lines)
+
+
+
+def write_battle_result_line(results_file, battle_line, processes=1):
+  """ Writes the result of the battle in a line of a batch to a file as a single line """
+
+  load_start = time.perf_counter()
+  battle = json.loads(battle_line)
+  metrics = None
+  if battle.get('collectMetrics'):
+    metrics = BattleMetrics()
+    metrics.add_phase_seconds(PHASE_LOAD, time.perf_counter() - load_start)
+
+  # A battle that fails is replaced with its error, so the rest of the batch still gets results
+  line_start = results_file.tell()
+  try:
+    with timed(metrics, PHASE_VALIDATE):
+      battle = normalize_battle(battle)
+    result_encoding = choose_result_encoding(battle.get('resultEncodings'))
+    if result_encoding == RESULT_ENCODING_JSON:
+      results_file.write('{"id": ' + json.dumps(battle.get('id')) + ', "result": ')
+      write_battle_result(
+        results_file,
+        challenger_fleet=battle.get('challenger'),
+        challengee_fleet=battle.get('challengee'),
+        wave_format=battle.get('waveFormat', WAVE_FORMAT_SNAPSHOT),
+        processes=processes,
+        metrics=metrics)
+
+    # Results in other encodings are binary, so they're written to the line once they're done
+    else:
+      encoded_result = io.BytesIO()
+      write_encoded_battle_result(
+        encoded_result,
+        challenger_fleet=battle.get('challenger'),
+        challengee_fleet=battle.get('challengee'),
+        result_encoding=result_encoding,
+        wave_format=battle.get('waveFormat', WAVE_FORMAT_SNAPSHOT),
+        processes=processes,
+        metrics=metrics)
+      with timed(metrics, PHASE_WRITE):
+        encoded_line = json.dumps(encode_battle_result(battle.get('id'), encoded_result.getvalue(), result_encoding))
+        results_file.write(encoded_line[:-1])
+
+    # The line is left open until the battle is over, so its metrics can be added
+    if metrics is not None:
+      results_file.write(', "metrics": ' + json.dumps(metrics.to_dict()))
+    results_file.write('}\n')
+  except Exception as e:
+    results_file.seek(line_start)
+    results_file.truncate()
+    battle_error = build_battle_error(battle.get('id'), e)
+    if metrics is not None:
+      battle_error['metrics'] = metrics.to_dict()
+    json.dump(battle_error, results_file)
+    results_file.write('\n')
+
+
+
+def build_battle_error(battle_id, error):
+  """ Builds a line of batch results for a battle that failed. Battles with fleets that can't battle get every problem found in them. """
+  battle_error = {'id': battle_id, 'error': f'{type(error).__name__}: {error}'}
+  if isinstance(error, InvalidBattleError):
+    battle_error['problems'] = error.problem_dicts()
+  return battle_error
+
+
+
+def write_battle_result_line_file(battle_line, results_dir):
+  """ Writes the result of the battle in a line of a batch to its own file in a directory, returning the path of the file """
+  with tempfile.NamedTemporaryFile(mode="w", encoding=ENCODING, dir=results_dir, suffix='.jsonl', delete=False) as results_file:
+    write_battle_result_line(results_file, battle_line)
+  return results_file.name
+
+
+
+def available_cpu_count():
+  """ Returns the number of cores this process can run on """
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+
+def battle_fleets_to_arrays(challenger_fleet, challengee_fleet, wave_format):
+  """ Converts both fleets of a battle to arrays, with all consumable properties of all units set to their initial values """
+
+  if wave_format not in WAVE_FORMATS:
+    raise ValueError(f'unknown wave format {wave_format}')
+
+  return (
+    fleet_to_arrays(challenger_fleet.get('formation'), challenger_fleet.get('manifest'), reset_consumables=True),
+    fleet_to_arrays(challengee_fleet.get('formation'), challengee_fleet.get('manifest'), reset_consumables=True)
+  )
+
+
+
+def process_battle_views(challenger_fleet_arrays, challengee_fleet_arrays, wave_format, shared_pass=True, vectorized=True,
+  challenger_view_waves=None, challengee_view_waves=None, challenger_view_unit_maps=(None, None), challengee_view_unit_maps=(None, None),
+  metrics=None):
+  """
+  Processes the battle from the view of each fleet, using up the fleet arrays.
+  With metrics, each view is timed and the collisions of the battle are counted from the challenger's view.
+  """
+
+  # Both views of the battle have the same units colliding in the same order, so when the fleets allow it
+  # the battle is only processed once and the challengee's view is replayed from the logged collisions
+  collision_log = {} if shared_pass and can_share_battle_pass(challenger_fleet_arrays, challengee_fleet_arrays) else None
+
+  with timed(metrics, VIEW_PHASES['challenger']):
+    challenger_view_battle_result = process_fleet_arrays_action(
+      attacking_fleet=challenger_fleet_arrays.copy(),
+      defending_fleet=challengee_fleet_arrays.copy(),
+      wave_format=wave_format,
+      collision_log=collision_log,
+      vectorized=vectorized,
+      waves=challenger_view_waves,
+      unit_maps=challenger_view_unit_maps,
+      metrics=metrics)
+
+  # This is the last use of the fleet arrays, so they don't need to be copied
+  with timed(metrics, VIEW_PHASES['challengee']):
+    if collision_log is not None:
+      challengee_view_battle_result = replay_fleet_arrays_action(
+        attacking_fleet=challengee_fleet_arrays,
+        defending_fleet=challenger_fleet_arrays,
+        collision_log=collision_log,
+        wave_format=wave_format,
+        waves=challengee_view_waves,
+        unit_maps=challengee_view_unit_maps)
+    else:
+      challengee_view_battle_result = process_fleet_arrays_action(
+        attacking_fleet=challengee_fleet_arrays,
+        defending_fleet=challenger_fleet_arrays,
+        wave_format=wave_format,
+        vectorized=vectorized,
+        waves=challengee_view_waves,
+        unit_maps=challengee_view_unit_maps)
+
+  return challenger_view_battle_result, challengee_view_battle_result
+
+
+
+def build_battle_summary(challenger_view_battle_result, challengee_view_battle_result):
+  """ Builds the parts of a battle result that come from the end of the battle """
+
+  return {
     'final': {
       'challenger': {
         'formation': challenger_view_battle_result.final_attacking_fleet_formation,
@@ -83,10 +444,6 @@ def determine_battle_result(challenger_fleet, challengee_fleet):
         'manifest': challengee_view_battle_result.final_attacking_fleet_unit_map
       }
     },
-    'waves': {
-      'challenger': challenger_view_battle_result.attacking_fleet_waves,
-      'challengee': challengee_view_battle_result.attacking_fleet_waves
-    },
     'score': {
       'challenger': {
         'kills': challenger_view_battle_result.attacking_fleet_enemy_kills,
@@ -102,87 +459,390 @@ def determine_battle_result(challenger_fleet, challengee_fleet):
 
 
 
-def process_fleet_to_fleet_action (attacking_fleet_formation, attacking_fleet_unit_map, defending_fleet_formation, defending_fleet_unit_map, attacking_fleet_is_challenger=True):
+def can_share_battle_pass(challenger_fleet, challengee_fleet):
+  """ Checks if both views of a battle can be built from a single pass over the unit collisions """
+
+  # Units only meet the same opponents in the same order from both views if every row is the same width
+  row_widths = set(len(row) for row in challenger_fleet.grid) | set(len(row) for row in challengee_fleet.grid)
+  if len(row_widths) > 1:
+    return False
+
+  # Each unit can only be in one slot, otherwise its state would be shared between collisions
+  return challenger_fleet.has_unique_units() and challengee_fleet.has_unique_units()
+
+
+
+def process_fleet_to_fleet_action (attacking_fleet_formation, attacking_fleet_unit_map, defending_fleet_formation, defending_fleet_unit_map, attacking_fleet_is_challenger=True, wave_format=WAVE_FORMAT_SNAPSHOT, collision_log=None):
   """ Processes the interactions between two fleets in waves  """
 
+  return process_fleet_arrays_action(
+    attacking_fleet=fleet_to_arrays(attacking_fleet_formation, attacking_fleet_unit_map),
+    defending_fleet=fleet_to_arrays(defending_fleet_formation, defending_fleet_unit_map),
+    wave_format=wave_format,
+    collision_log=collision_log)
+
+
+
+def process_fleet_arrays_action(attacking_fleet, defending_fleet, wave_format=WAVE_FORMAT_SNAPSHOT, collision_log=None, vectorized=True,
+  waves=None, unit_maps=(None, None), checkpoints=None, metrics=None):
+  """
+  Processes the interactions between two fleets, stored as arrays, in waves.
+  Waves are appended to a list, unless something else to append them to is given.
+  With checkpoints (see incremental.py), the battle carries on from the last wave they hold, with the fleets in their
+  state after that wave and the earlier waves already in the list, and every new wave is checkpointed.
+  With metrics (see metrics.py), the collisions, skipped interactions and kills are counted.
+  """
 
   # We will save the results of each round as a wave
-  waves = []
+  waves = [] if waves is None else waves
+  previous_wave = None
   defender_enemy_kills = 0
   defender_civ_kills = 0
   attacker_enemy_kills = 0
   attacker_civ_kills = 0
+  civilian_code = COMPILED_UNIT_SPECS.type_codes.get('civilian')
+
+  # A resumed battle starts with the kills from the waves before it
+  first_wave = 0
+  if checkpoints is not None and checkpoints.wave_count:
+    first_wave = checkpoints.wave_count
+    previous_wave = waves[first_wave - 1]
+    attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills = checkpoints.kills[-1]
+
+  # Snapshot waves share the manifests of both fleets, which are filled in once the battle is over unless they are given
+  attacking_fleet_unit_map, defending_fleet_unit_map = ({} if unit_map is None else unit_map for unit_map in unit_maps)
+
+  # Whole rows can battle at once if the kernel is available and every unit has its own slot
+  if vectorized and is_kernel_available() and attacking_fleet.has_unique_units() and defending_fleet.has_unique_units():
+    attacking_fleet_views = fleet_views(attacking_fleet)
+    defending_fleet_views = fleet_views(defending_fleet)
+  else:
+    attacking_fleet_views = defending_fleet_views = None
+
+  # Keep count of the units left in each row, so rows without units don't need to be searched for battles
+  atr_row_unit_counts = attacking_fleet.count_row_units()
+  dfr_row_unit_counts = defending_fleet.count_row_units()
+  dfr_fleet_unit_count = sum(dfr_row_unit_counts)
 
   # Go through each row in the attacking fleet. Starting with the front one.
-  for atr_fl_row_idx, atr_fl_row in enumerate(attacking_fleet_formation):
+  for atr_fl_row_idx in range(first_wave, len(attacking_fleet.grid)):
+    atr_fl_row = attacking_fleet.grid[atr_fl_row_idx]
 
     # We will save interactions between units in the wave
     interactions = []
+
+    # The defending rows the wave could have reached, which is all of them unless the attacking row runs out of units
+    dfr_rows_reached = None
+
+    # Delta encoded waves only save the changes made to each fleet in the wave
+    attacking_fleet_delta = new_fleet_delta()
+    defending_fleet_delta = new_fleet_delta()
   
-    # Go through each row in the challengee fleet, front to back, with the same challenger fleet row.
-    for dfr_fl_row_idx in range(len(defending_fleet_formation)):
-
-      # Get a reversed row of the defender formation since they are coming AT the attacker fleet
-      reversed_dfr_row = copy.deepcopy(defending_fleet_formation[dfr_fl_row_idx])
-      reversed_dfr_row.reverse()
-
-      # Go through each unit in the row and have them battle the unit in the same spot in the row
-      for unit_idx, atr_fl_unit_id in enumerate(atr_fl_row):
-
-        # Get the cooresponding unit in the defending fleet
-        dfr_fl_unit_id = reversed_dfr_row[unit_idx]
-
-        # Get data on both units via their ids
-        atr_fl_unit = attacking_fleet_unit_map.get(atr_fl_unit_id, {})
-        dfr_fl_unit = defending_fleet_unit_map.get(dfr_fl_unit_id, {})
-      
-        # Have the two ships battle and get their new states
-        atr_fl_unit, dfr_fl_unit = process_unit_to_unit_action(atr_fl_unit, dfr_fl_unit)
-        
-        # Check for destroyed ships, count them, and remove them from the formations
-        killed = None
-        if (atr_fl_unit and atr_fl_unit['health'] <= 0):
-          atr_fl_unit['health'] = 0
+    # Go through each row in the defending fleet, front to back, with the same attacking fleet row.
+    for dfr_fl_row_idx in range(len(defending_fleet.grid)):
+
+      # Once either side has no units left there are no more battles in this wave, but the wave is still saved
+      if not atr_row_unit_counts[atr_fl_row_idx]:
+        dfr_rows_reached = dfr_fl_row_idx
+        break
+      if not dfr_fleet_unit_count:
+        break
+      if not dfr_row_unit_counts[dfr_fl_row_idx]:
+        continue
+
+      # Have the rows battle all at once when they can be vectorized, otherwise one unit at a time
+      row_collisions = None
+      if attacking_fleet_views and KERNEL_MIN_ROW_WIDTH <= len(atr_fl_row) == len(defending_fleet.grid[dfr_fl_row_idx]):
+        row_collisions = collide_rows(
+          attacking_fleet_views, attacking_fleet_views.grid[atr_fl_row_idx],
+          defending_fleet_views, defending_fleet_views.grid[dfr_fl_row_idx])
+      if row_collisions is None:
+        row_collisions = process_row_to_row_action(attacking_fleet, atr_fl_row_idx, defending_fleet, dfr_fl_row_idx)
+
+      if not row_collisions.atr_units:
+        continue
+      if checkpoints is not None:
+        checkpoints.record_collisions(atr_fl_row_idx, dfr_fl_row_idx, row_collisions)
+
+      atr_killed_count = sum(row_collisions.atr_killed)
+      dfr_killed_count = sum(row_collisions.dfr_killed)
+      atr_row_unit_counts[atr_fl_row_idx] -= atr_killed_count
+      dfr_row_unit_counts[dfr_fl_row_idx] -= dfr_killed_count
+      dfr_fleet_unit_count -= dfr_killed_count
+      if metrics is not None:
+        metrics.count_collisions(row_collisions, atr_killed_count + dfr_killed_count)
+
+      # Count destroyed ships, which have been removed from the formations
+      for unit_idx, atr_fl_unit in compress(zip(row_collisions.atr_slots, row_collisions.atr_units), row_collisions.atr_killed):
+        defender_enemy_kills += 1
+        defender_civ_kills += (1 if attacking_fleet.types[atr_fl_unit] == civilian_code else 0)
+        attacking_fleet_delta['removed'].append([atr_fl_row_idx, unit_idx])
+      for dfr_unit_index, dfr_fl_unit in compress(zip(row_collisions.dfr_slots, row_collisions.dfr_units), row_collisions.dfr_killed):
+        attacker_enemy_kills += 1
+        attacker_civ_kills += (1 if defending_fleet.types[dfr_fl_unit] == civilian_code else 0)
+        defending_fleet_delta['removed'].append([dfr_fl_row_idx, dfr_unit_index])
+
+      # Save the interactions between the units
+      killed = [KILLED_LABELS[atr_killed + 2 * dfr_killed] for atr_killed, dfr_killed in zip(row_collisions.atr_killed, row_collisions.dfr_killed)]
+      interactions.extend(
+        {
+          'attackerUnit': attacking_fleet.unit_ids[atr_fl_unit],
+          'defenderUnit': defending_fleet.unit_ids[dfr_fl_unit],
+          'killed': unit_killed
+        }
+        for atr_fl_unit, dfr_fl_unit, unit_killed in zip(row_collisions.atr_units, row_collisions.dfr_units, killed)
+      )
+
+      if wave_format == WAVE_FORMAT_DELTA:
+        record_unit_changes(attacking_fleet_delta, attacking_fleet, row_collisions.atr_units,
+          row_collisions.atr_previous_health, row_collisions.atr_previous_skip, row_collisions.atr_health, row_collisions.atr_skip)
+        record_unit_changes(defending_fleet_delta, defending_fleet, row_collisions.dfr_units,
+          row_collisions.dfr_previous_health, row_collisions.dfr_previous_skip, row_collisions.dfr_health, row_collisions.dfr_skip)
+
+      # Log the outcome of the collisions so the opposing view can be replayed from them
+      if collision_log is not None:
+        collision_log[(atr_fl_row_idx, dfr_fl_row_idx)] = list(zip(
+          row_collisions.atr_slots,
+          row_collisions.atr_units, row_collisions.atr_health, row_collisions.atr_skip,
+          row_collisions.dfr_units, row_collisions.dfr_health, row_collisions.dfr_skip,
+          killed
+        ))
+
+    previous_wave = build_wave(atr_fl_row_idx, attacking_fleet, attacking_fleet_unit_map, attacking_fleet_delta,
+      defending_fleet, defending_fleet_unit_map, defending_fleet_delta, interactions, wave_format, previous_wave)
+    waves.append(previous_wave)
+
+    if checkpoints is not None:
+      checkpoints.end_wave(dfr_rows_reached, (attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills))
+
+  if hasattr(waves, 'close'):
+    waves.close()
+
+  return build_fleet_battle_result(
+    attacking_fleet, attacking_fleet_unit_map, defending_fleet, defending_fleet_unit_map, waves,
+    attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills)
+
+
+
+def process_row_to_row_action(attacking_fleet, atr_fl_row_idx, defending_fleet, dfr_fl_row_idx):
+  """ Has every unit in a row of the attacking fleet battle the unit coming at it in a row of the defending fleet, one at a time """
+
+  atr_fl_row = attacking_fleet.grid[atr_fl_row_idx]
+  dfr_fl_row = defending_fleet.grid[dfr_fl_row_idx]
+  row_collisions = RowCollisions(*([] for _ in RowCollisions._fields))
+
+  if len(atr_fl_row) > len(dfr_fl_row):
+    raise IndexError(f'attacking row {atr_fl_row_idx} is wider than defending row {dfr_fl_row_idx}')
+
+  # The defender formation is reversed since they are coming AT the attacker fleet,
+  # so each unit battles the unit in the mirrored slot of the defending row
+  mirrored_slot_offset = len(dfr_fl_row) - 1
+
+  # Go through each unit in the row and have them battle the unit in the same spot in the row
+  for unit_idx, atr_fl_unit in enumerate(atr_fl_row):
+
+    # Get the cooresponding unit in the defending fleet
+    dfr_unit_index = mirrored_slot_offset - unit_idx
+    dfr_fl_unit = dfr_fl_row[dfr_unit_index]
+
+    # If either unit doesn't exist, there is no battle
+    if not attacking_fleet.is_unit(atr_fl_unit) or not defending_fleet.is_unit(dfr_fl_unit):
+      continue
+
+    # Keep the consumable properties from before the battle so changes can be saved
+    row_collisions.atr_previous_health.append(attacking_fleet.health[atr_fl_unit])
+    row_collisions.atr_previous_skip.append(attacking_fleet.skip[atr_fl_unit])
+    row_collisions.dfr_previous_health.append(defending_fleet.health[dfr_fl_unit])
+    row_collisions.dfr_previous_skip.append(defending_fleet.skip[dfr_fl_unit])
+
+    # Have the two ships battle
+    process_unit_arrays_action(attacking_fleet, atr_fl_unit, defending_fleet, dfr_fl_unit)
+
+    # Check for destroyed ships and remove them from the formations
+    atr_fl_unit_killed = attacking_fleet.health[atr_fl_unit] <= 0
+    if atr_fl_unit_killed:
+      attacking_fleet.health[atr_fl_unit] = 0
+      atr_fl_row[unit_idx] = EMPTY_SLOT
+    dfr_fl_unit_killed = defending_fleet.health[dfr_fl_unit] <= 0
+    if dfr_fl_unit_killed:
+      defending_fleet.health[dfr_fl_unit] = 0
+      dfr_fl_row[dfr_unit_index] = EMPTY_SLOT
+
+    row_collisions.atr_slots.append(unit_idx)
+    row_collisions.dfr_slots.append(dfr_unit_index)
+    row_collisions.atr_units.append(atr_fl_unit)
+    row_collisions.dfr_units.append(dfr_fl_unit)
+    row_collisions.atr_killed.append(atr_fl_unit_killed)
+    row_collisions.dfr_killed.append(dfr_fl_unit_killed)
+
+  # Save the new states of the units once the rows have battled
+  row_collisions.atr_health.extend(attacking_fleet.health[atr_fl_unit] for atr_fl_unit in row_collisions.atr_units)
+  row_collisions.atr_skip.extend(attacking_fleet.skip[atr_fl_unit] for atr_fl_unit in row_collisions.atr_units)
+  row_collisions.dfr_health.extend(defending_fleet.health[dfr_fl_unit] for dfr_fl_unit in row_collisions.dfr_units)
+  row_collisions.dfr_skip.extend(defending_fleet.skip[dfr_fl_unit] for dfr_fl_unit in row_collisions.dfr_units)
+
+  return row_collisions
+
+
+
+def replay_fleet_arrays_action(attacking_fleet, defending_fleet, collision_log, wave_format=WAVE_FORMAT_SNAPSHOT, waves=None, unit_maps=(None, None),
+  checkpoints=None):
+  """
+  Builds the waves of the opposing view of a battle from the collisions logged while processing it.
+  With checkpoints (see incremental.py), the replay carries on from the last wave they hold, like processing a battle
+  does, and every new wave is checkpointed.
+  """
+
+  waves = [] if waves is None else waves
+  previous_wave = None
+  defender_enemy_kills = 0
+  defender_civ_kills = 0
+  attacker_enemy_kills = 0
+  attacker_civ_kills = 0
+  civilian_code = COMPILED_UNIT_SPECS.type_codes.get('civilian')
+  attacking_fleet_unit_map, defending_fleet_unit_map = ({} if unit_map is None else unit_map for unit_map in unit_maps)
+
+  # The fleet attacking in this view was the defending fleet when the collisions were logged
+  swapped_killed = {None: None, 'attacker': 'defender', 'defender': 'attacker', 'both': 'both'}
+
+  # A resumed replay starts with the kills from the waves before it
+  first_wave = 0
+  if checkpoints is not None and checkpoints.wave_count:
+    first_wave = checkpoints.wave_count
+    previous_wave = waves[first_wave - 1]
+    attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills = checkpoints.kills[-1]
+
+  # Go through each row in the attacking fleet. Starting with the front one.
+  for atr_fl_row_idx in range(first_wave, len(attacking_fleet.grid)):
+    atr_fl_row = attacking_fleet.grid[atr_fl_row_idx]
+
+    interactions = []
+    attacking_fleet_delta = new_fleet_delta()
+    defending_fleet_delta = new_fleet_delta()
+
+    # The defending rows the wave could have reached, which is all of them unless the attacking row runs out of units.
+    # Rows it didn't battle weren't logged, so it's worked out from the units the row has left.
+    atr_row_unit_count = len(atr_fl_row) - atr_fl_row.count(EMPTY_SLOT)
+    dfr_rows_reached = 0 if not atr_row_unit_count and defending_fleet.grid else None
+
+    # Go through each row in the defending fleet, front to back, with the same attacking fleet row.
+    for dfr_fl_row_idx in range(len(defending_fleet.grid)):
+
+      logged_collisions = collision_log.get((dfr_fl_row_idx, atr_fl_row_idx))
+      if not logged_collisions:
+        continue
+
+      # Slots were logged from the other side of the row, so they are replayed in reverse
+      dfr_slots, dfr_units, dfr_health, dfr_skip, atr_units, atr_health, atr_skip, logged_killed = zip(*reversed(logged_collisions))
+      atr_slots = [len(atr_fl_row) - 1 - dfr_unit_index for dfr_unit_index in dfr_slots]
+      killed = [swapped_killed[unit_killed] for unit_killed in logged_killed]
+
+      if wave_format == WAVE_FORMAT_DELTA:
+        record_unit_changes(attacking_fleet_delta, attacking_fleet, atr_units,
+          [attacking_fleet.health[unit] for unit in atr_units], [attacking_fleet.skip[unit] for unit in atr_units], atr_health, atr_skip)
+        record_unit_changes(defending_fleet_delta, defending_fleet, dfr_units,
+          [defending_fleet.health[unit] for unit in dfr_units], [defending_fleet.skip[unit] for unit in dfr_units], dfr_health, dfr_skip)
+
+      # Set the new states of the units from the logged collisions
+      for atr_fl_unit, unit_health, unit_skip in zip(atr_units, atr_health, atr_skip):
+        attacking_fleet.health[atr_fl_unit] = unit_health
+        attacking_fleet.skip[atr_fl_unit] = unit_skip
+      for dfr_fl_unit, unit_health, unit_skip in zip(dfr_units, dfr_health, dfr_skip):
+        defending_fleet.health[dfr_fl_unit] = unit_health
+        defending_fleet.skip[dfr_fl_unit] = unit_skip
+
+      # Count destroyed ships and remove them from the formations
+      for unit_idx, atr_fl_unit, unit_killed in zip(atr_slots, atr_units, killed):
+        if unit_killed in ('attacker', 'both'):
           defender_enemy_kills += 1
-          defender_civ_kills += (1 if atr_fl_unit['type'] == 'civilian' else 0)
-          attacking_fleet_formation[atr_fl_row_idx][unit_idx] = None
-          killed = 'attacker'
-        if (dfr_fl_unit and dfr_fl_unit['health'] <= 0):
-          dfr_fl_unit['health'] = 0
+          defender_civ_kills += (1 if attacking_fleet.types[atr_fl_unit] == civilian_code else 0)
+          atr_fl_row[unit_idx] = EMPTY_SLOT
+          attacking_fleet_delta['removed'].append([atr_fl_row_idx, unit_idx])
+          atr_row_unit_count -= 1
+      for dfr_unit_index, dfr_fl_unit, unit_killed in zip(dfr_slots, dfr_units, killed):
+        if unit_killed in ('defender', 'both'):
           attacker_enemy_kills += 1
-          attacker_civ_kills += (1 if dfr_fl_unit['type'] == 'civilian' else 0)
-          dfr_unit_index = [dfr_unit_id for dfr_unit_id in defending_fleet_formation[dfr_fl_row_idx]].index(dfr_fl_unit_id)
-          defending_fleet_formation[dfr_fl_row_idx][dfr_unit_index] = None
-          killed = 'defender' if not killed else 'both'
-
-        if (atr_fl_unit and dfr_fl_unit):
-          interactions.append(
-            {
-              'attackerUnit': atr_fl_unit_id,
-              'defenderUnit': dfr_fl_unit_id,
-              'killed': killed
-            }
-          )
-
-    waves.append(
-      {
-        'attackerRow': atr_fl_row_idx,
-        'attackerFleet': {
-          'manifest': attacking_fleet_unit_map,
-          'formation': copy.deepcopy(attacking_fleet_formation)
-        },
-        'defenderFleet': {
-          'manifest': defending_fleet_unit_map,
-          'formation': copy.deepcopy(defending_fleet_formation)
-        },
-        'interactions': interactions
-      }
-    )
+          attacker_civ_kills += (1 if defending_fleet.types[dfr_fl_unit] == civilian_code else 0)
+          defending_fleet.grid[dfr_fl_row_idx][dfr_unit_index] = EMPTY_SLOT
+          defending_fleet_delta['removed'].append([dfr_fl_row_idx, dfr_unit_index])
+      if not atr_row_unit_count and dfr_fl_row_idx + 1 < len(defending_fleet.grid):
+        dfr_rows_reached = dfr_fl_row_idx + 1
+
+      # Save the interactions between the units
+      interactions.extend(
+        {
+          'attackerUnit': attacking_fleet.unit_ids[atr_fl_unit],
+          'defenderUnit': defending_fleet.unit_ids[dfr_fl_unit],
+          'killed': unit_killed
+        }
+        for atr_fl_unit, dfr_fl_unit, unit_killed in zip(atr_units, dfr_units, killed)
+      )
+
+    previous_wave = build_wave(atr_fl_row_idx, attacking_fleet, attacking_fleet_unit_map, attacking_fleet_delta,
+      defending_fleet, defending_fleet_unit_map, defending_fleet_delta, interactions, wave_format, previous_wave)
+    waves.append(previous_wave)
+
+    if checkpoints is not None:
+      checkpoints.end_wave(dfr_rows_reached, (attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills))
+
+  if hasattr(waves, 'close'):
+    waves.close()
+
+  return build_fleet_battle_result(
+    attacking_fleet, attacking_fleet_unit_map, defending_fleet, defending_fleet_unit_map, waves,
+    attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills)
+
+
+
+def build_wave(atr_fl_row_idx, attacking_fleet, attacking_fleet_unit_map, attacking_fleet_delta,
+  defending_fleet, defending_fleet_unit_map, defending_fleet_delta, interactions, wave_format, previous_wave=None):
+  """ Builds the record of a wave in the requested wave format. Formations that didn't change are shared with the previous wave. """
+
+  if wave_format == WAVE_FORMAT_DELTA:
+    return {
+      'attackerRow': atr_fl_row_idx,
+      'attackerFleet': attacking_fleet_delta,
+      'defenderFleet': defending_fleet_delta,
+      'interactions': interactions
+    }
+
+  # Formations only change when units are removed from them
+  if previous_wave and not attacking_fleet_delta['removed']:
+    attacking_fleet_formation = previous_wave['attackerFleet']['formation']
+  else:
+    attacking_fleet_formation = attacking_fleet.to_formation()
+  if previous_wave and not defending_fleet_delta['removed']:
+    defending_fleet_formation = previous_wave['defenderFleet']['formation']
+  else:
+    defending_fleet_formation = defending_fleet.to_formation()
+
+  return {
+    'attackerRow': atr_fl_row_idx,
+    'attackerFleet': {
+      'manifest': attacking_fleet_unit_map,
+      'formation': attacking_fleet_formation
+    },
+    'defenderFleet': {
+      'manifest': defending_fleet_unit_map,
+      'formation': defending_fleet_formation
+    },
+    'interactions': interactions
+  }
+
+
+
+def build_fleet_battle_result(attacking_fleet, attacking_fleet_unit_map, defending_fleet, defending_fleet_unit_map, waves,
+  attacker_enemy_kills, attacker_civ_kills, defender_enemy_kills, defender_civ_kills):
+  """ Converts the final state of both fleets back to the JSON fleet format and builds the result of a view of a battle """
+
+  # Fill in the manifests shared by all snapshot waves with the final state of the fleets
+  attacking_fleet_unit_map.update(attacking_fleet.to_manifest())
+  defending_fleet_unit_map.update(defending_fleet.to_manifest())
 
   return FleetBattleResult(
-    final_attacking_fleet_formation=attacking_fleet_formation,
+    final_attacking_fleet_formation=attacking_fleet.to_formation(),
     final_attacking_fleet_unit_map=attacking_fleet_unit_map,
-    final_defending_fleet_formation=defending_fleet_formation,
+    final_defending_fleet_formation=defending_fleet.to_formation(),
     final_defending_fleet_unit_map=defending_fleet_unit_map,
     attacking_fleet_waves=waves,
     attacking_fleet_enemy_kills=attacker_enemy_kills,
@@ -190,7 +850,50 @@ def process_fleet_to_fleet_action (attacking_fleet_formation, attacking_fleet_un
     defending_fleet_enemy_kills=defender_enemy_kills,
     defending_fleet_civilian_kills=defender_civ_kills
   )
-        
+
+
+
+def record_unit_changes(fleet_delta, fleet, units, previous_health, previous_skip, health, skip):
+  """ Saves any changes to the consumable properties of units to the changes made to their fleet in a wave """
+  for unit, unit_previous_health, unit_health in zip(units, previous_health, health):
+    if unit_health != unit_previous_health:
+      fleet_delta['health'][fleet.unit_ids[unit]] = unit_health
+  for unit, unit_previous_skip, unit_skip in zip(units, previous_skip, skip):
+    if unit_skip != unit_previous_skip:
+      fleet_delta['skip'][fleet.unit_ids[unit]] = unit_skip
+
+
+
+def process_unit_arrays_action(fleet1, unit1, fleet2, unit2):
+  """ Determines the result of a battle between two units, stored in fleet arrays """
+
+  unit1_code = fleet1.types[unit1]
+  unit2_code = fleet2.types[unit2]
+
+  # Check if either unit will avoid battle with a 'skip' 
+  unit1_skips = fleet1.skip[unit1]
+  unit2_skips = fleet2.skip[unit2]
+
+  if unit1_skips > 0 or unit2_skips > 0:
+
+    # If either unit can skip battle, decrement the skip property on both units
+    fleet1.skip[unit1] = unit1_skips - 1 if unit1_skips > 0 else 0
+    fleet2.skip[unit2] = unit2_skips - 1 if unit2_skips > 0 else 0
+
+  else:
+
+    # Look up the damage each unit takes, interpreting the unit specs if it depends on more than the unit types
+    unit1_damage = COMPILED_UNIT_SPECS.damage[unit2_code][unit1_code]
+    unit2_damage = COMPILED_UNIT_SPECS.damage[unit1_code][unit2_code]
+    if unit1_damage is None:
+      unit1_damage = interpret_damage(fleet2.to_unit(unit2), fleet1.to_unit(unit1))
+    if unit2_damage is None:
+      unit2_damage = interpret_damage(fleet1.to_unit(unit1), fleet2.to_unit(unit2))
+
+    # Set the new health values
+    fleet1.health[unit1] = (fleet1.health[unit1] or COMPILED_UNIT_SPECS.health[unit1_code]) - unit1_damage
+    fleet2.health[unit2] = (fleet2.health[unit2] or COMPILED_UNIT_SPECS.health[unit2_code]) - unit2_damage
+
 
 
 def process_unit_to_unit_action(unit1, unit2):
@@ -200,13 +903,9 @@ def process_unit_to_unit_action(unit1, unit2):
   if (not unit1 or not unit2):
     return (unit1, unit2)
 
-  # Retrieve the stats of the two units
-  unit1_stats = UNIT_TYPE_SPECS[unit1.get('type')]['stats']
-  unit2_stats = UNIT_TYPE_SPECS[unit2.get('type')]['stats']
-  
-  # Calculate the base damage each unit could take
-  unit1_damage = unit2_stats['base_dmg']
-  unit2_damage = unit1_stats['base_dmg']
+  # Look up the type codes of the two units in the compiled unit specs
+  unit1_code = COMPILED_UNIT_SPECS.type_codes[unit1.get('type')]
+  unit2_code = COMPILED_UNIT_SPECS.type_codes[unit2.get('type')]
 
   # Check if either unit will avoid battle with a 'skip' 
   unit1_skips = unit1.get('skip')
@@ -220,25 +919,18 @@ def process_unit_to_unit_action(unit1, unit2):
 
   else:
   
-    # Calculate the attack modifier effects
-    for attack_modifier in unit1_stats['modifiers']['attack']:
-      if MOD_OPERATOR_FUNCTIONS[attack_modifier['operator']](unit2[attack_modifier['property']], attack_modifier['match']):
-        unit2_damage = MOD_OPERATOR_FUNCTIONS[attack_modifier['action']['operator']](unit2_damage, attack_modifier['action']['value'])
-    for attack_modifier in unit2_stats['modifiers']['attack']:
-      if MOD_OPERATOR_FUNCTIONS[attack_modifier['operator']](unit1[attack_modifier['property']], attack_modifier['match']):
-        unit1_damage = MOD_OPERATOR_FUNCTIONS[attack_modifier['action']['operator']](unit1_damage, attack_modifier['action']['value'])
-        
-    # Calculate the defense modifier effects
-    for defense_modifier in unit1_stats['modifiers']['defense']:
-      if MOD_OPERATOR_FUNCTIONS[defense_modifier['operator']](unit2[defense_modifier['property']], defense_modifier['match']):
-        unit1_damage = MOD_OPERATOR_FUNCTIONS[defense_modifier['action']['operator']](unit1_damage, defense_modifier['action']['value'])
-    for defense_modifier in unit2_stats['modifiers']['defense']:
-      if MOD_OPERATOR_FUNCTIONS[defense_modifier['operator']](unit1[defense_modifier['property']], defense_modifier['match']):
-        unit2_damage = MOD_OPERATOR_FUNCTIONS[defense_modifier['action']['operator']](unit2_damage, defense_modifier['action']['value'])
+    # Look up the damage each unit takes, with all modifier effects applied.
+    # Damage that depends on more than the unit types has to be interpreted from the unit specs.
+    unit1_damage = COMPILED_UNIT_SPECS.damage[unit2_code][unit1_code]
+    unit2_damage = COMPILED_UNIT_SPECS.damage[unit1_code][unit2_code]
+    if unit1_damage is None:
+      unit1_damage = interpret_damage(unit2, unit1)
+    if unit2_damage is None:
+      unit2_damage = interpret_damage(unit1, unit2)
     
     # Set the new health values
-    unit1_previous_health = unit1.get('health') or unit1_stats.get('health')
-    unit2_previous_health = unit2.get('health') or unit2_stats.get('health')
+    unit1_previous_health = unit1.get('health') or COMPILED_UNIT_SPECS.health[unit1_code]
+    unit2_previous_health = unit2.get('health') or COMPILED_UNIT_SPECS.health[unit2_code]
     unit1['health'] = unit1_previous_health - unit1_damage
     unit2['health'] = unit2_previous_health - unit2_damage
   
@@ -250,11 +942,39 @@ def process_unit_to_unit_action(unit1, unit2):
 
 
 if __name__ == "__main__":
-  result = ""
+  parser = argparse.ArgumentParser(description='Determines the results of fleet battles')
+  parser.add_argument('--batch', action='store_true', help=f'process every battle in {BATTLES_PATH} instead of the single battle in {FLEETS_PATH}')
+  parser.add_argument('--processes', type=int, default=available_cpu_count(), help='the number of processes battles are spread across (default: the number of cores)')
+  args = parser.parse_args()
 
-  with FLEETS_PATH.open() as f:
-    fleets = json.load(f)
-    result = determine_battle_result(challenger_fleet=fleets.get('challenger'), challengee_fleet=fleets.get('challengee'))
-    
-  with RESULT_PATH.open(mode="w", encoding=ENCODING) as f:
-    json.dump(result, f)
+  if args.batch:
+    with BATTLES_PATH.open(encoding=ENCODING) as battles_file, RESULTS_PATH.open(mode="w", encoding=ENCODING) as results_file:
+      write_battle_batch_results(battles_file, results_file, processes=args.processes)
+
+  else:
+    load_start = time.perf_counter()
+    with FLEETS_PATH.open() as f:
+      fleets = json.load(f)
+    metrics = None
+    if fleets.get('collectMetrics'):
+      metrics = BattleMetrics()
+      metrics.add_phase_seconds(PHASE_LOAD, time.perf_counter() - load_start)
+
+    with timed(metrics, PHASE_VALIDATE):
+      fleets = normalize_battle(fleets)
+
+    # The result is written as the battle is processed, so large battles don't have to fit in memory
+    with RESULT_PATH.open(mode="wb") as f:
+      write_encoded_battle_result(
+        f,
+        challenger_fleet=fleets.get('challenger'),
+        challengee_fleet=fleets.get('challengee'),
+        result_encoding=choose_result_encoding(fleets.get('resultEncodings')),
+        wave_format=fleets.get('waveFormat', WAVE_FORMAT_SNAPSHOT),
+        processes=args.processes,
+        metrics=metrics)
+
+    # The metrics are kept out of the result, so results are the same whether they're collected or not
+    if metrics is not None:
+      with METRICS_PATH.open(mode="w", encoding=ENCODING) as f:
+        json.dump(metrics.to_dict(), f)